@@ -2,7 +2,6 @@ import streamlit as st
 from vanna_calls import (
     generate_sql_cached,
     is_sql_valid_cached,
-    run_sql_cached,
     generate_plotly_code_cached,
     generate_plot_cached,
     generate_summary_cached,
@@ -16,7 +15,14 @@ from pandas.api.types import (
     is_numeric_dtype,
     is_object_dtype,
 )
+import re
+import time
 import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from query_planner import QueryNeedsConfirmation
+from athena_executor import query_executor, set_current_session
+from aws_clients import aws_client, config
+from engine_registry import get_engine
 
 
 def filter_dataframe(df: pd.DataFrame, key) -> pd.DataFrame:
@@ -101,7 +107,19 @@ def filter_dataframe(df: pd.DataFrame, key) -> pd.DataFrame:
     return df
 
 
+def cancel_early_run():
+    # the user moved on, so stop the previous question's query, or keep it
+    # from starting if it is still waiting for validation or a worker
+    query_executor.cancel_session(st.session_state.get("session_id"))
+    df_future = st.session_state.get("df_future")
+    if df_future is not None:
+        df_future.cancel()
+        st.session_state.df_future = None
+
+
 def new_convo():
+    cancel_early_run()
+    st.session_state.generated_sql = {}
     st.session_state.messages = [
         {
             "role": "assistant",
@@ -127,6 +145,19 @@ def set_user_question(question):
     )
 
 
+def regenerate_sql(question):
+    # the reused query did not fit, ask the LLM this time
+    st.session_state.skip_semantic_cache.add(question)
+    st.session_state.generated_sql.pop(question, None)
+    set_user_question(question)
+
+
+def confirm_sql(sql, question):
+    # ask the question again, this time allowing the expensive query to run
+    st.session_state.confirmed_sql.add(sql)
+    set_user_question(question)
+
+
 def handle_text(content):
     content
 
@@ -140,7 +171,20 @@ def handle_error(content):
     st.error(content)
 
 
+def truncation_notice(df):
+    if not df.attrs.get("truncated"):
+        return None
+    row_limit = df.attrs.get("row_limit") or len(df)
+    return (
+        f"Results limited to {row_limit:,} rows. Add filters or an aggregation "
+        "to the question to see the rest."
+    )
+
+
 def handle_dataframe(content, key):
+    notice = truncation_notice(content)
+    if notice:
+        st.info(notice)
     st.dataframe(filter_dataframe(content, key))
 
 
@@ -148,6 +192,109 @@ def toggle_state(key):
     st.session_state[key] = not st.session_state[key]
 
 
+@st.cache_resource
+def get_early_run_pool():
+    # shared by all sessions, runs queries in the background so the script
+    # thread stays responsive, starting them while the LLM is still writing
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="early-run")
+
+
+def wait_for(future, poll_seconds=0.5):
+    """
+    Wait for a background result from the script thread.
+
+    Streamlit only stops a script run for a new question or a button
+    callback when the script next sends it an element, so the wait does that
+    between short waits. The run started by the new question then cancels the
+    session's queries instead of finding them already finished.
+    """
+    placeholder = st.empty()
+    while True:
+        try:
+            return future.result(timeout=poll_seconds)
+        except TimeoutError:
+            placeholder.empty()
+
+
+def run_in_session(sql, question, confirmed, session_id, submitted_at):
+    # runs outside the script thread, so the session is set again for it
+    set_current_session(session_id)
+    if query_executor.session_cancelled_since(session_id, submitted_at):
+        return None
+    return get_engine().run_sql(sql=sql, question=question, confirmed=confirmed)
+
+
+def validate_and_run(sql, question, confirmed, session_id, submitted_at, validated):
+    # runs outside the script thread, so the session is set again for it
+    set_current_session(session_id)
+    engine = get_engine()
+    try:
+        is_valid = engine.is_sql_valid(sql, question)
+    except Exception as e:
+        validated.set_exception(e)
+        raise
+    validated.set_result(is_valid)
+    if not is_valid or query_executor.session_cancelled_since(session_id, submitted_at):
+        return None
+    return engine.run_sql(sql=sql, question=question, confirmed=confirmed)
+
+
+def stream_sql(question, render_interval=0.1):
+    """
+    Stream the LLM response into the chat, and start validating and running
+    the SQL as soon as its closing tag arrives, while the explanation is
+    still being generated.
+
+    The streamed text is redrawn at most every render_interval seconds
+    rather than on every token, since each redraw sends the whole text.
+
+    Returns:
+        tuple: (sql, explanation, clarification_request, df_future), with
+            sql and df_future None when no valid SQL was generated.
+    """
+    stream_container = st.empty()
+    stream_text = stream_container.chat_message("assistant", avatar=ai_icon).empty()
+    text = ""
+    values = {}
+    validated = Future()
+    df_future = None
+    rendered_at = 0
+    for event, value in get_engine().generate_sql_stream(
+        question, use_semantic_cache=False
+    ):
+        if event == "token":
+            text += value
+            if time.monotonic() - rendered_at >= render_interval:
+                stream_text.markdown(re.sub(r"</?\w+>", "", text))
+                rendered_at = time.monotonic()
+            continue
+        values[event] = value
+        if event == "sql_query" and df_future is None:
+            df_future = get_early_run_pool().submit(
+                validate_and_run,
+                value,
+                question,
+                value in st.session_state.confirmed_sql,
+                st.session_state.session_id,
+                time.monotonic(),
+                validated,
+            )
+            st.session_state.df_future = df_future
+    # the SQL and explanation are shown as separate messages below
+    stream_container.empty()
+
+    sql = values.get("sql_query")
+    explanation = values.get("explanation")
+    try:
+        is_valid = df_future is not None and wait_for(validated)
+    except Exception as e:
+        print(f"Failed to validate SQL: {e}")
+        is_valid, explanation = False, "Error generating SQL prompt"
+    if not is_valid:
+        sql, df_future = None, None
+    return sql, explanation, values.get("clarification_request"), df_future
+
+
 if "show_sql" not in st.session_state.keys():
     st.session_state.show_sql = True
 
@@ -166,6 +313,24 @@ if "show_summary" not in st.session_state.keys():
 if "show_followup" not in st.session_state.keys():
     st.session_state.show_followup = False
 
+if "confirmed_sql" not in st.session_state.keys():
+    st.session_state.confirmed_sql = set()
+
+if "stream_responses" not in st.session_state.keys():
+    st.session_state.stream_responses = config.get("llm", {}).get("stream", True)
+
+if "generated_sql" not in st.session_state.keys():
+    st.session_state.generated_sql = {}
+
+if "skip_semantic_cache" not in st.session_state.keys():
+    st.session_state.skip_semantic_cache = set()
+
+if "session_id" not in st.session_state.keys():
+    st.session_state.session_id = str(uuid.uuid4())
+
+# queries started by this script run can be cancelled with the session
+set_current_session(st.session_state.session_id)
+
 # st.write(st.session_state)
 
 st.sidebar.title("Output Settings")
@@ -206,12 +371,20 @@ st.sidebar.checkbox(
     on_change=toggle_state,
     args=("show_followup",),
 )
+st.sidebar.checkbox(
+    "Stream Responses",
+    value=st.session_state.stream_responses,
+    on_change=toggle_state,
+    args=("stream_responses",),
+)
 st.sidebar.button(
     "Clear Chat History", on_click=new_convo, use_container_width=True, type="primary"
 )
 
 st.title("AI Data Explorer")
 st.sidebar.write(st.session_state)
+with st.sidebar.expander("AWS connection pools"):
+    st.json(aws_client.pool_metrics())
 
 # if "explanation_status" not in st.session_state:
 #     st.session_state.explanation_status = False
@@ -223,6 +396,8 @@ if "messages" not in st.session_state.keys():
 
 # Initialize the prompt status if it doesn't exist
 if prompt := st.chat_input("Your question"):
+    # stop any query still running for the previous question
+    cancel_early_run()
     set_user_question(prompt)
 
 
@@ -253,9 +428,39 @@ if st.session_state.messages[-1]["role"] != "assistant":
     with st.spinner("Thinking..."):
         my_question = st.session_state.messages[-1]["content"]
         # display the sql
-        sql, sql_explanation, clarification_request = generate_sql_cached(
-            question=my_question, explain=True
-        )
+        df_future = None
+        cache_hit = None
+        generated = st.session_state.generated_sql.get(my_question)
+        if generated is None and my_question not in st.session_state.skip_semantic_cache:
+            # verified SQL of a near-identical question needs no LLM call or check
+            cache_hit = get_engine().lookup_cached_sql(my_question)
+            if cache_hit is not None:
+                generated = (
+                    cache_hit["sql"],
+                    get_engine().cached_sql_explanation(cache_hit),
+                    None,
+                    cache_hit,
+                )
+                st.session_state.generated_sql[my_question] = generated
+        if generated is not None:
+            # asked again, e.g. after "Run anyway", so reuse the same SQL
+            sql, sql_explanation, clarification_request, cache_hit = generated
+        elif st.session_state.stream_responses:
+            sql, sql_explanation, clarification_request, df_future = stream_sql(
+                my_question
+            )
+            # failed generations are not kept, asking again calls the LLM again
+            if sql:
+                st.session_state.generated_sql[my_question] = (
+                    sql,
+                    sql_explanation,
+                    clarification_request,
+                    None,
+                )
+        else:
+            sql, sql_explanation, clarification_request = generate_sql_cached(
+                question=my_question, explain=True, use_semantic_cache=False
+            )
         if sql:
             if st.session_state.get("show_sql", True):
                 assistant_message_sql = st.chat_message("assistant", avatar=ai_icon)
@@ -270,6 +475,13 @@ if st.session_state.messages[-1]["role"] != "assistant":
                 )
                 # print explanation of sql
                 assistant_message_sql.write(sql_explanation)
+                if cache_hit is not None:
+                    assistant_message_sql.button(
+                        "Regenerate",
+                        on_click=regenerate_sql,
+                        args=(my_question,),
+                        help="Ask the LLM for a new query instead of reusing this one",
+                    )
                 st.session_state.messages.append(
                     {
                         "role": "assistant",
@@ -300,9 +512,44 @@ if st.session_state.messages[-1]["role"] != "assistant":
             #     st.stop()
 
             # display the table
-            df = run_sql_cached(sql=sql, question=my_question)
+            try:
+                if df_future is None:
+                    df_future = get_early_run_pool().submit(
+                        run_in_session,
+                        sql,
+                        my_question,
+                        sql in st.session_state.confirmed_sql,
+                        st.session_state.session_id,
+                        time.monotonic(),
+                    )
+                    st.session_state.df_future = df_future
+                # started while the explanation was still streaming, or just now
+                with st.spinner("Running SQL query ..."):
+                    df = wait_for(df_future)
+                st.session_state.df_future = None
+            except QueryNeedsConfirmation as e:
+                assistant_message_confirm = st.chat_message("assistant", avatar=ai_icon)
+                assistant_message_confirm.warning(str(e))
+                assistant_message_confirm.button(
+                    "Run anyway", on_click=confirm_sql, args=(sql, my_question)
+                )
+                st.session_state.messages.append(
+                    {
+                        "role": "assistant",
+                        "content": str(e),
+                        "avatar": ai_icon,
+                        "content_type": "error",
+                    }
+                )
+                st.stop()
             if df is not None:
                 st.session_state["df"] = df
+                # SQL that returned rows is reused for rephrasings of the
+                # question, reused SQL is not stored again under this one
+                if len(df) > 0 and cache_hit is None:
+                    get_engine().remember_sql(
+                        my_question, df.attrs.get("generated_sql", sql)
+                    )
 
             if st.session_state.get("df") is not None:
                 if st.session_state.get("show_table", True):
@@ -313,6 +560,9 @@ if st.session_state.messages[-1]["role"] != "assistant":
                     )
                     key = uuid.uuid4()
                     with assistant_message_table:
+                        notice = truncation_notice(df)
+                        if notice:
+                            st.info(notice)
                         st.dataframe(filter_dataframe(df, key))
                     st.session_state.messages.append(
                         {
@@ -6,112 +6,373 @@ import time
 import pandas as pd
 import io
 import traceback
-import sqlparse
+import uuid
 from aws_clients import aws_client, config
-from utils import get_value_from_text
-from prompt_chain import MinimalChainable
-from prompts import generate_sql_prompt, debug_sql_prompt, generate_plotly_code_prompt
+from engine_registry import get_engine
+from s3 import get_csv_results, read_parquet_results, delete_prefix
+from athena_executor import query_executor
+from sql_validator import (
+    validate_sql,
+    parse_sql,
+    describe_query,
+    get_referenced_tables,
+    VALID,
+    INVALID,
+)
+from result_cache import result_cache
+from glue import (
+    get_catalog_columns,
+    get_table,
+    get_table_statistics,
+    table_columns,
+    table_statistics,
+)
+from query_stats import record_execution, record_run, new_run_id, set_current_run
+from query_planner import (
+    plan_query,
+    check_scan_budget,
+    mark_row_limit,
+    QueryNeedsConfirmation,
+)
+from concurrent.futures import ThreadPoolExecutor
 
-# from orchestrator import engine
-from s3 import get_csv_results
+
+def split_s3_uri(uri):
+    bucket, _, prefix = uri[len("s3://") :].partition("/")
+    return bucket, prefix
+
+
+def estimate_result_bytes(sql, table_metadata=None):
+    """
+    Roughly estimate how large a query's result will be from Glue statistics.
+
+    Aggregates without GROUP BY return a single row and queries with a LIMIT
+    return at most LIMIT rows of the widest table. Everything else is bounded
+    by the total size of the tables it reads.
+
+    Args:
+        sql (str): The query.
+        table_metadata (dict): {table_name: Glue table} already fetched for
+            the query, e.g. by plan_query.
+
+    Returns:
+        float: The estimate in bytes, or None when it cannot be made.
+    """
+    tree = parse_sql(sql)
+    if tree is None:
+        return None
+    shape = describe_query(tree)
+    if shape["is_aggregate"]:
+        return 0
+    tables = get_referenced_tables(tree)
+    try:
+        if table_metadata and tables <= set(table_metadata):
+            statistics = {table: table_statistics(table_metadata[table]) for table in tables}
+        else:
+            statistics = get_table_statistics(tables)
+    except Exception as e:
+        print(f"Could not read table statistics: {e}")
+        return None
+    if not statistics:
+        return None
+    if shape["limit"] is not None:
+        record_sizes = [s["average_record_size"] for s in statistics.values()]
+        if None not in record_sizes:
+            return shape["limit"] * max(record_sizes)
+    sizes = [s["size_bytes"] for s in statistics.values()]
+    if None in sizes:
+        return None
+    return sum(sizes)
+
+
+def should_unload(sql, table_metadata=None):
+    """
+    Decide whether a query's result is large enough to fetch through UNLOAD.
+
+    UNLOAD writes its parts in parallel, so queries whose row order matters
+    always go through the regular CSV output.
+    """
+    tree = parse_sql(sql)
+    if tree is None:
+        return False
+    shape = describe_query(tree)
+    if not shape["is_select"] or shape["has_order_by"]:
+        return False
+    estimate = estimate_result_bytes(sql, table_metadata)
+    threshold = config["aws"]["athena"].get("unload_threshold_bytes", 100 * 1024 * 1024)
+    return estimate is not None and estimate >= threshold
+
+
+def build_unload_query(sql, location):
+    sql = sql.strip().rstrip(";")
+    return f"UNLOAD ({sql}) TO '{location}' WITH (format = 'PARQUET', compression = 'SNAPPY')"
+
+
+def get_unload_location():
+    athena_config = config["aws"]["athena"]
+    base = athena_config.get(
+        "unload_location", athena_config["output_location"].rstrip("/") + "/unload"
+    )
+    # UNLOAD requires an empty destination, so every query gets its own prefix
+    return f"{base.rstrip('/')}/{uuid.uuid4()}/"
+
+
+def delete_unload_results(location):
+    """
+    Remove an UNLOAD output prefix once it has been read or the query failed,
+    unless aws.athena.keep_unload_results is set.
+    """
+    if config["aws"]["athena"].get("keep_unload_results", False):
+        return
+    bucket, prefix = split_s3_uri(location)
+    try:
+        delete_prefix(bucket, prefix)
+    except Exception as e:
+        print(f"Failed to delete UNLOAD results under {location}: {e}")
+
+
+def get_unload_results(location):
+    athena_config = config["aws"]["athena"]
+    bucket, prefix = split_s3_uri(location)
+    try:
+        table, truncated = read_parquet_results(
+            bucket,
+            prefix,
+            max_rows=athena_config.get("max_result_rows", 1_000_000),
+            max_bytes=athena_config.get("max_result_bytes", 512 * 1024 * 1024),
+        )
+    finally:
+        delete_unload_results(location)
+    df = table.to_pandas()
+    df.attrs["truncated"] = truncated
+    print(f"Fetched {len(df)} rows from {location}")
+    return df
 
 
 def execute_query_with_autocorrect(
-    sql: str, question: str = "", max_attempts: int = 3
+    sql: str,
+    question: str = "",
+    max_attempts: int = 3,
+    result_format: str = "auto",
+    confirmed: bool = False,
+    plan: dict = None,
 ) -> pd.DataFrame:
-    athena_client = aws_client.get_athena_client()
+    """
+    Run a query, asking the LLM to repair it when Athena rejects it.
+
+    Every call is recorded in the query statistics store together with the
+    final SQL and the time spent in Athena, LLM repairs and result download.
+
+    Args:
+        sql (str): The query to run.
+        question (str): The question the query answers, used for repairs.
+        max_attempts (int): How many times the query may be repaired.
+        result_format (str): "csv" reads Athena's CSV output, "unload" wraps
+            the query in UNLOAD and reads the Parquet parts, "auto" picks
+            UNLOAD when the estimated result passes unload_threshold_bytes.
+        confirmed (bool): The user agreed to run the query even though it
+            scans more than confirm_scan_bytes.
+        plan (dict): The plan_query plan of sql when the caller already made
+            one, so the query is not planned twice.
+    """
+    run = {
+        "run_id": new_run_id(),
+        "final_sql": sql,
+        "attempts": 0,
+        "cache_hit": False,
+        "llm_repair_seconds": 0.0,
+        "download_seconds": 0.0,
+    }
+    start_time = time.monotonic()
+    error = None
+    set_current_run(run["run_id"])
+    try:
+        return _execute_query_with_autocorrect(
+            sql, question, max_attempts, result_format, confirmed, run, plan
+        )
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        set_current_run(None)
+        record_run(
+            question,
+            run["final_sql"],
+            succeeded=error is None,
+            run_id=run["run_id"],
+            cache_hit=run["cache_hit"],
+            attempts=run["attempts"],
+            wall_seconds=time.monotonic() - start_time,
+            llm_repair_seconds=run["llm_repair_seconds"],
+            download_seconds=run["download_seconds"],
+            error=error,
+        )
+
+
+def _execute_query_with_autocorrect(
+    sql, question, max_attempts, result_format, confirmed, run, plan=None
+):
+    # the query as generated or repaired, before planning may add a LIMIT
+    generated_sql = sql
+    plan = plan or plan_query(sql)
+    sql = plan["sql"]
+    run["final_sql"] = sql
+    if result_cache is not None:
+        df = result_cache.get(sql, plan["table_metadata"])
+        if df is not None:
+            run["cache_hit"] = True
+            df.attrs["sql"] = sql
+            df.attrs["generated_sql"] = generated_sql
+            return df
+    check_scan_budget(plan, confirmed)
+
     attempt = 0
-    output_location = config['aws']['athena']['output_location']
-    catalog = config["aws"]["athena"]["catalog"]
-    database = config["aws"]["glue"]["database"]
 
     while attempt < max_attempts:
         try:
             print(f"Attempt {attempt + 1}")
-            print(f"Executing: {sql}")
-            query_execution = athena_client.start_query_execution(
-                QueryString=sql,
-                ResultConfiguration={"OutputLocation": output_location},
-                QueryExecutionContext={"Catalog": catalog, "Database": database},
+            run["attempts"] += 1
+            if result_format == "auto":
+                use_unload = should_unload(sql, plan["table_metadata"])
+            else:
+                use_unload = result_format == "unload"
+            if use_unload:
+                unload_location = get_unload_location()
+                query_execution = query_executor.run(
+                    build_unload_query(sql, unload_location)
+                )
+            else:
+                query_execution = query_executor.run(sql)
+            if use_unload and query_execution["Status"]["State"] != "SUCCEEDED":
+                # failed or cancelled UNLOADs can leave partial parts behind
+                delete_unload_results(unload_location)
+            record_execution(
+                query_execution,
+                kind=("unload" if use_unload else "query") if attempt == 0 else "retry",
+                question=question,
+                attempt=attempt + 1,
+                run_id=run["run_id"],
             )
             execution_id = query_execution["QueryExecutionId"]
-
-            # wait for the query to complete
-            while True:
-                response = athena_client.get_query_execution(
-                    QueryExecutionId=execution_id
-                )
-                status = response["QueryExecution"]["Status"]["State"]
-                if status in ["SUCCEEDED", "FAILED", "CANCELLED"]:
-                    break
-                print(f"Query status: {status}. Waiting for completion...")
-                time.sleep(0.5)  # Wait before checking again
+            status = query_execution["Status"]["State"]
 
             if status == "SUCCEEDED":
                 break
+            elif status == "CANCELLED":
+                # stopped by a deadline or because the session moved on, so
+                # there is nothing for the LLM to fix
+                statistics = query_execution.get("Statistics", {})
+                raise Exception(
+                    f"Query was cancelled: {query_execution['Status'].get('StateChangeReason')} "
+                    f"(queued {statistics.get('QueryQueueTimeInMillis', 0) / 1000:.1f}s, "
+                    f"ran {statistics.get('EngineExecutionTimeInMillis', 0) / 1000:.1f}s)"
+                )
             # debug and validate query
             elif attempt + 1 <= max_attempts:
                 attempt += 1
                 # regenerate sql and iterate back over the while loop
-                error_message = response["QueryExecution"]["Status"][
-                    "StateChangeReason"
-                ]
-                from orchestrator import engine
-
+                error_message = query_execution["Status"]["StateChangeReason"]
+                engine = get_engine()
+                repair_start = time.monotonic()
                 sql = engine.debug_sql(
                     sql=sql, error_message=error_message, question=question, retry=True
                 )
-                if engine.is_sql_valid(sql, question):
+                # the repaired query is planned again so it stays within budget
+                generated_sql = sql
+                plan = plan_query(sql)
+                sql = plan["sql"]
+                run["final_sql"] = sql
+                check_scan_budget(plan, confirmed)
+                is_valid = engine.is_sql_valid(sql, question)
+                run["llm_repair_seconds"] += time.monotonic() - repair_start
+                if is_valid:
                     attempt += 1
                 else:
                     raise Exception(f"Query failed to fix the error after.")
             else:
-                error_message = response["QueryExecution"]["Status"][
-                    "StateChangeReason"
-                ]
+                error_message = query_execution["Status"]["StateChangeReason"]
                 raise Exception(
                     f"Query failed after {attempt} attempts with the following error: {error_message}"
                 )
 
+        except QueryNeedsConfirmation:
+            raise
         except Exception as e:
             print(traceback.format_exc())
             raise Exception(f"Query failed with error: {e}")
 
-    result_folder = config["aws"]["athena"]["output_location"].split("/")[3]
-    df = get_csv_results(execution_id, result_folder)
+    download_start = time.monotonic()
+    if use_unload:
+        df = get_unload_results(unload_location)
+    else:
+        result_folder = config["aws"]["athena"]["output_location"].split("/")[3]
+        df = get_csv_results(execution_id, result_folder)
+    run["download_seconds"] = time.monotonic() - download_start
+    # truncated results, by a result cap or the injected LIMIT, are not cached
+    mark_row_limit(df, plan)
+    # the SQL that produced the result, after any repairs
+    df.attrs["sql"] = sql
+    df.attrs["generated_sql"] = generated_sql
+    if result_cache is not None and not df.attrs.get("truncated"):
+        try:
+            result_cache.put(sql, df, plan["table_metadata"])
+        except Exception as e:
+            print(f"Failed to cache query result: {e}")
     return df
 
 
-def syntax_checker(query_string):
-    athena_client = aws_client.get_athena_client()
-    # print("Inside execute query", query_string)
-    output_location = config['aws']['athena']['output_location']
-    catalog = config["aws"]["athena"]["catalog"]
-    database = config["aws"]["glue"]["database"]
+def execute_queries(sqls: list) -> list:
+    """
+    Run several queries at once and return their results in the same order.
+
+    All queries are submitted together, so the slowest query sets the wall
+    clock time rather than the sum of all of them. Unlike
+    execute_query_with_autocorrect, failed queries are not sent back to the
+    LLM; their slot in the returned list holds the Exception instead.
+    """
+    result_folder = config["aws"]["athena"]["output_location"].split("/")[3]
+    futures = query_executor.submit_many(sqls)
+
+    def fetch(future):
+        try:
+            query_execution = future.result()
+            record_execution(query_execution, kind="query")
+            status = query_execution["Status"]
+            if status["State"] != "SUCCEEDED":
+                return Exception(
+                    f"Query {status['State'].lower()}: {status.get('StateChangeReason')}"
+                )
+            return get_csv_results(query_execution["QueryExecutionId"], result_folder)
+        except Exception as e:
+            return e
 
-    query_string = "Explain  " + query_string
-    print(f"Executing: {query_string}")
+    with ThreadPoolExecutor(max_workers=max(len(futures), 1)) as pool:
+        return list(pool.map(fetch, futures))
+
+
+def syntax_checker(query_string, question=""):
+    # most queries can be checked locally against the cached schema, only
+    # fall back to an Athena EXPLAIN when the local validator is unsure
+    verdict, message = validate_sql(query_string)
+    print(f"Local syntax check: {verdict} {message}")
+    if verdict == VALID:
+        return "Passed"
+    if verdict == INVALID:
+        return message
+
+    query_string = "EXPLAIN " + query_string
     try:
         print("Checking Query Syntax")
-        query_execution = athena_client.start_query_execution(
-            QueryString=query_string,
-            ResultConfiguration={"OutputLocation": output_location},
-            QueryExecutionContext={"Catalog": catalog, "Database": database},
-        )
-        execution_id = query_execution["QueryExecutionId"]
-        print(f"execution_id: {execution_id}")
-        time.sleep(3)
-        results = athena_client.get_query_execution(QueryExecutionId=execution_id)
-        # print(f"results: {results}")
-        status = results["QueryExecution"]["Status"]
+        query_execution = query_executor.run(query_string)
+        record_execution(query_execution, kind="explain", question=question)
+        status = query_execution["Status"]
         print("Status :", status)
         if status["State"] == "SUCCEEDED":
             return "Passed"
         else:
-            print(results["QueryExecution"]["Status"]["StateChangeReason"])
-            errmsg = results["QueryExecution"]["Status"]["StateChangeReason"]
+            errmsg = status.get("StateChangeReason", status["State"])
+            print(errmsg)
             return errmsg
-        # return results
     except Exception as e:
         print("Error in exception")
         msg = str(e)
@@ -119,46 +380,55 @@ def syntax_checker(query_string):
         return msg  #! doubke check this return statment
 
 
-def generate_database_ddl():
-    tables_query = f"""
-    SELECT table_name
-    FROM information_schema.tables
-    WHERE table_schema = '{config['aws']['glue']['database']}'
+def generate_database_ddl(database_name=None):
     """
+    Build a CREATE TABLE statement for every table in the database.
 
-    # Execute the query and load the results into a DataFrame
-    tables_df = execute_query_with_autocorrect(tables_query)
-    # Iterate over all tables and generate DDL
-    ddl_statements = {}
-    for table_name in tables_df["table_name"]:
-        ddl_statements[table_name] = generate_table_ddl(table_name)
+    The columns of all tables come from a single paginated Glue GetTables
+    listing and the statements are assembled in one vectorized pass.
 
-    return ddl_statements
+    Returns:
+        dict: {table_name: ddl}
+    """
+    columns_df = pd.DataFrame(
+        get_catalog_columns(database_name),
+        columns=["table_name", "column_name", "data_type", "is_partition_key"],
+    )
+    if columns_df.empty:
+        return {}
+
+    column_defs = (
+        "  "
+        + columns_df["column_name"]
+        + " "
+        + columns_df["data_type"]
+        + columns_df["is_partition_key"].map({True: " partition key", False: ""})
+    )
+    column_lists = column_defs.groupby(columns_df["table_name"], sort=False).agg(
+        ",\n".join
+    )
+    return {
+        table: f"CREATE TABLE {table} (\n{column_list}\n);"
+        for table, column_list in column_lists.items()
+    }
 
 
-def generate_table_ddl(table):
-    # Query to get the columns information for the current table
-    columns_query = f"""
-    SELECT column_name, data_type, is_nullable, column_default, extra_info
-    FROM information_schema.columns
-    WHERE table_schema = '{config['aws']['glue']['database']}' AND table_name = '{table}'
+def generate_table_ddl(table, database_name=None):
     """
+    Build the CREATE TABLE statement of one table from its own GetTable call,
+    in the same format as generate_database_ddl.
 
-    # Execute the query and load the results into a DataFrame
-    columns_df = execute_query_with_autocorrect(columns_query)
-
-    # Construct the CREATE TABLE statement
-    ddl = f"CREATE TABLE {table} (\n"
-    for index, row in columns_df.iterrows():
-        column_def = f"  {row['column_name']} {row['data_type']}"
-        if row["is_nullable"] == "NO":
-            column_def += " NOT NULL"
-        if pd.notna(row["column_default"]):
-            column_def += f" DEFAULT {row['column_default']}"
-        if pd.notna(row["extra_info"]):
-            column_def += f" {row['extra_info']}"
-        column_def += ",\n"
-        ddl += column_def
-    ddl = ddl.rstrip(",\n") + "\n);"
-
-    return ddl
+    Returns:
+        str: The DDL, or None when the table does not exist.
+    """
+    glue_client = aws_client.get_glue_client()
+    try:
+        columns = table_columns(get_table(table, database_name))
+    except glue_client.exceptions.EntityNotFoundException:
+        return None
+    column_list = ",\n".join(
+        f"  {column['column_name']} {column['data_type']}"
+        + (" partition key" if column["is_partition_key"] else "")
+        for column in columns
+    )
+    return f"CREATE TABLE {table} (\n{column_list}\n);"
@@ -0,0 +1,342 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from aws_clients import aws_client, config
+
+TERMINAL_STATES = ("SUCCEEDED", "FAILED", "CANCELLED")
+
+# batch_get_query_execution accepts at most 50 ids per call
+MAX_BATCH_SIZE = 50
+
+_local = threading.local()
+
+
+def set_current_session(session_id):
+    """
+    Tag queries submitted from this thread with a session id, so they can be
+    cancelled together with AthenaQueryExecutor.cancel_session.
+    """
+    _local.session_id = session_id
+
+
+def get_current_session():
+    return getattr(_local, "session_id", None)
+
+
+def next_poll_delay(query_execution, elapsed, min_delay=0.2, max_delay=5.0):
+    """
+    Work out how long to wait before polling a query again.
+
+    Queries that have been queued or running for a long time are unlikely to
+    finish in the next few hundred milliseconds, so the delay grows with the
+    time Athena reports the query has already spent in its current state.
+
+    Args:
+        query_execution (dict): The QueryExecution block from Athena.
+        elapsed (float): Seconds since the query was submitted, used when
+            Athena has not reported statistics yet.
+        min_delay (float): Lower bound for the delay in seconds.
+        max_delay (float): Upper bound for the delay in seconds.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    state = query_execution["Status"]["State"]
+    statistics = query_execution.get("Statistics", {})
+    if state == "QUEUED":
+        spent = statistics.get("QueryQueueTimeInMillis")
+    else:
+        spent = statistics.get("EngineExecutionTimeInMillis")
+    spent = elapsed if spent is None else spent / 1000
+
+    # poll again after roughly a quarter of the time already spent
+    return min(max(spent * 0.25, min_delay), max_delay)
+
+
+class AthenaQueryExecutor:
+    """
+    Submits Athena queries concurrently and tracks them with a single poller.
+
+    Each submitted query returns a future that resolves to its final
+    QueryExecution block once it reaches SUCCEEDED, FAILED or CANCELLED. All
+    in-flight queries are polled together with batch_get_query_execution, so
+    the number of control-plane calls does not grow with the number of
+    queries.
+
+    Queries past their deadline, and queries of a session that has been
+    cancelled, are stopped with StopQueryExecution so they no longer hold
+    Athena concurrency slots. Their future resolves to the CANCELLED
+    QueryExecution, whose Statistics hold the time spent so far.
+    """
+
+    def __init__(
+        self,
+        max_concurrent_queries=5,
+        min_poll_interval=0.2,
+        max_poll_interval=5.0,
+        query_timeout=None,
+        cancelled_session_ttl=600,
+    ):
+        self.max_concurrent_queries = max_concurrent_queries
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.query_timeout = query_timeout
+        self.cancelled_session_ttl = cancelled_session_ttl
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_concurrent_queries, thread_name_prefix="athena-query"
+        )
+        self._condition = threading.Condition()
+        # execution_id -> {"event", "submitted_at", "next_poll_at", "deadline",
+        #                  "session_id", "stop_reason", "result"}
+        self._pending = {}
+        # session_id -> time of the last cancel_session call
+        self._cancelled_sessions = {}
+        self._poller = None
+
+    def submit(self, sql, database=None, timeout=None, session_id=None):
+        """
+        Start a query and return a future for its final QueryExecution.
+
+        Args:
+            sql (str): The SQL statement to run.
+            database (str): The Glue database, defaults to the configured one.
+            timeout (float): Seconds before the query is stopped, defaults to
+                the executor's query_timeout.
+            session_id (str): Groups queries for cancel_session, defaults to
+                the calling thread's current session.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the QueryExecution dict.
+        """
+        if timeout is None:
+            timeout = self.query_timeout
+        if session_id is None:
+            session_id = get_current_session()
+        return self._pool.submit(
+            self._run, sql, database, timeout, session_id, time.monotonic()
+        )
+
+    def submit_many(self, sqls, database=None, timeout=None, session_id=None):
+        if session_id is None:
+            session_id = get_current_session()
+        return [self.submit(sql, database, timeout, session_id) for sql in sqls]
+
+    def run(self, sql, database=None, timeout=None, session_id=None):
+        return self.submit(sql, database, timeout, session_id).result()
+
+    def cancel(self, execution_id, reason="Cancelled by user"):
+        """
+        Stop a running query. Its future resolves once Athena reports it as
+        CANCELLED.
+        """
+        with self._condition:
+            entry = self._pending.get(execution_id)
+            if entry is not None:
+                entry["stop_reason"] = entry["stop_reason"] or reason
+                # check back soon for the CANCELLED state
+                entry["next_poll_at"] = time.monotonic() + self.min_poll_interval
+                self._condition.notify()
+        self._stop(execution_id)
+
+    def cancel_session(self, session_id):
+        """
+        Stop every in-flight query of a session, including queries that are
+        still being submitted.
+
+        Returns:
+            list: The execution ids that were stopped.
+        """
+        if session_id is None:
+            return []
+        now = time.monotonic()
+        with self._condition:
+            # a cancellation only matters to queries submitted before it that
+            # are still starting, so old entries can go
+            self._cancelled_sessions = {
+                cancelled_id: cancelled_at
+                for cancelled_id, cancelled_at in self._cancelled_sessions.items()
+                if now - cancelled_at < self.cancelled_session_ttl
+            }
+            self._cancelled_sessions[session_id] = now
+            execution_ids = [
+                execution_id
+                for execution_id, entry in self._pending.items()
+                if entry["session_id"] == session_id
+            ]
+        for execution_id in execution_ids:
+            self.cancel(execution_id, reason="Session moved on")
+        return execution_ids
+
+    def session_cancelled_since(self, session_id, since):
+        """
+        Tell whether cancel_session was called for a session after since, a
+        time.monotonic() value, e.g. to skip work started for a question the
+        user has moved on from.
+        """
+        with self._condition:
+            cancelled_at = self._cancelled_sessions.get(session_id)
+        return cancelled_at is not None and cancelled_at >= since
+
+    def running_queries(self, session_id=None):
+        with self._condition:
+            return [
+                execution_id
+                for execution_id, entry in self._pending.items()
+                if session_id is None or entry["session_id"] == session_id
+            ]
+
+    def _stop(self, execution_id):
+        athena_client = aws_client.get_athena_client()
+        try:
+            athena_client.stop_query_execution(QueryExecutionId=execution_id)
+            print(f"Stopped query {execution_id}")
+        except Exception as e:
+            print(f"Failed to stop query {execution_id}: {e}")
+
+    def start(self, sql, database=None):
+        athena_client = aws_client.get_athena_client()
+        query_execution = athena_client.start_query_execution(
+            QueryString=sql,
+            ResultConfiguration={
+                "OutputLocation": config["aws"]["athena"]["output_location"]
+            },
+            QueryExecutionContext={
+                "Catalog": config["aws"]["athena"]["catalog"],
+                "Database": database or config["aws"]["glue"]["database"],
+            },
+        )
+        return query_execution["QueryExecutionId"]
+
+    def wait(self, execution_id, timeout=None, session_id=None, submitted_at=None):
+        """
+        Block until the given execution reaches a terminal state.
+
+        Returns:
+            dict: The final QueryExecution block. Queries stopped by the
+                executor carry the reason in Status.StateChangeReason.
+        """
+        now = time.monotonic()
+        submitted_at = submitted_at or now
+        entry = {
+            "event": threading.Event(),
+            "submitted_at": submitted_at,
+            "next_poll_at": now + self.min_poll_interval,
+            "deadline": submitted_at + timeout if timeout else None,
+            "session_id": session_id,
+            "stop_reason": None,
+            "result": None,
+        }
+        with self._condition:
+            self._pending[execution_id] = entry
+            cancelled_at = self._cancelled_sessions.get(session_id)
+            if cancelled_at is not None and cancelled_at >= submitted_at:
+                entry["stop_reason"] = "Session moved on"
+            self._ensure_poller()
+            self._condition.notify()
+        if entry["stop_reason"]:
+            self._stop(execution_id)
+        entry["event"].wait()
+        return entry["result"]
+
+    def _run(self, sql, database, timeout, session_id, submitted_at):
+        print(f"Executing: {sql}")
+        execution_id = self.start(sql, database)
+        return self.wait(execution_id, timeout, session_id, submitted_at)
+
+    def _ensure_poller(self):
+        if self._poller is None or not self._poller.is_alive():
+            self._poller = threading.Thread(
+                target=self._poll_loop, name="athena-poller", daemon=True
+            )
+            self._poller.start()
+
+    def _poll_loop(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._pending:
+                        self._poller = None
+                        return
+                    now = time.monotonic()
+                    due = [
+                        execution_id
+                        for execution_id, entry in self._pending.items()
+                        if entry["next_poll_at"] <= now
+                        or (entry["deadline"] and entry["deadline"] <= now)
+                    ]
+                    if due:
+                        break
+                    next_at = min(
+                        min(e["next_poll_at"], e["deadline"] or e["next_poll_at"])
+                        for e in self._pending.values()
+                    )
+                    self._condition.wait(timeout=next_at - now)
+
+            for i in range(0, len(due), MAX_BATCH_SIZE):
+                self._poll_batch(due[i : i + MAX_BATCH_SIZE])
+
+    def _poll_batch(self, execution_ids):
+        athena_client = aws_client.get_athena_client()
+        try:
+            response = athena_client.batch_get_query_execution(
+                QueryExecutionIds=execution_ids
+            )
+        except Exception as e:
+            print(f"Failed to poll query executions: {e}")
+            response = {"QueryExecutions": []}
+
+        now = time.monotonic()
+        expired = []
+        with self._condition:
+            for query_execution in response["QueryExecutions"]:
+                execution_id = query_execution["QueryExecutionId"]
+                entry = self._pending.get(execution_id)
+                if entry is None:
+                    continue
+                state = query_execution["Status"]["State"]
+                if state in TERMINAL_STATES:
+                    if state == "CANCELLED" and entry["stop_reason"]:
+                        query_execution["Status"]["StateChangeReason"] = entry[
+                            "stop_reason"
+                        ]
+                    entry["result"] = query_execution
+                    del self._pending[execution_id]
+                    entry["event"].set()
+                    continue
+                if entry["deadline"] and entry["deadline"] <= now:
+                    if not entry["stop_reason"]:
+                        elapsed = now - entry["submitted_at"]
+                        entry["stop_reason"] = f"Timed out after {elapsed:.0f}s"
+                        expired.append(execution_id)
+                    # check back soon for the CANCELLED state
+                    entry["deadline"] = None
+                    entry["next_poll_at"] = now + self.min_poll_interval
+                    continue
+                delay = next_poll_delay(
+                    query_execution,
+                    now - entry["submitted_at"],
+                    self.min_poll_interval,
+                    self.max_poll_interval,
+                )
+                print(f"Query {execution_id} status: {state}. Next check in {delay:.1f}s")
+                entry["next_poll_at"] = now + delay
+
+            # ids Athena did not return are retried at the maximum interval
+            for execution_id in execution_ids:
+                entry = self._pending.get(execution_id)
+                if entry is not None and entry["next_poll_at"] <= now:
+                    entry["next_poll_at"] = now + self.max_poll_interval
+
+        for execution_id in expired:
+            self._stop(execution_id)
+
+
+executor_config = config["aws"]["athena"].get("executor", {})
+
+query_executor = AthenaQueryExecutor(
+    max_concurrent_queries=executor_config.get("max_concurrent_queries", 5),
+    min_poll_interval=executor_config.get("min_poll_interval", 0.2),
+    max_poll_interval=executor_config.get("max_poll_interval", 5.0),
+    query_timeout=executor_config.get("query_timeout", 300),
+    cancelled_session_ttl=executor_config.get("cancelled_session_ttl", 600),
+)
@@ -1,6 +1,7 @@
 import boto3
 from botocore.config import Config
 import logging
+import threading
 import yaml
 
 logger = logging.getLogger(__name__)
@@ -8,33 +9,144 @@ logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler())
 import os
 
-# retry_config = Config(
-#     region_name="us-east-1", retries={"max_attempts": 10, "mode": "standard"}
-# )
-
 
 class AWSClients:
-    s3_client = None
-    athena_client = None
-    glue_client = None
-
-    @classmethod
-    def get_s3_client(cls):
-        if cls.s3_client is None:
-            cls.s3_client = boto3.client("s3")
-        return cls.s3_client
-
-    @classmethod
-    def get_athena_client(cls):
-        if cls.athena_client is None:
-            cls.athena_client = boto3.client("athena")
-        return cls.athena_client
-
-    @classmethod
-    def get_glue_client(cls):
-        if cls.glue_client is None:
-            cls.glue_client = boto3.client("glue")
-        return cls.glue_client
+    """
+    Builds one boto3 client per service and shares it between threads.
+
+    boto3 clients are thread-safe but sessions are not, so clients are
+    created under a lock from a single session per process. A process forked
+    from one that already holds clients builds its own, since connections
+    cannot be shared across processes.
+
+    Connection pool size, retry mode, timeouts and region come from the
+    aws.clients section of config.yaml, with per-service overrides:
+
+        aws:
+          clients:
+            region: us-east-1
+            max_pool_connections: 50
+            retry_mode: adaptive
+            max_attempts: 10
+            connect_timeout: 5
+            read_timeout: 60
+            athena:
+              read_timeout: 30
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._session = None
+        self._clients = {}
+        # service -> {"in_flight", "peak_in_flight", "requests"}
+        self._counters = {}
+
+    def client_config(self, service):
+        clients_config = config["aws"].get("clients", {})
+        settings = {
+            key: value for key, value in clients_config.items() if not isinstance(value, dict)
+        }
+        settings.update(clients_config.get(service, {}))
+
+        pool_size = settings.get("max_pool_connections", 50)
+        if service == "s3":
+            # the client is shared by parallel uploads, each running several
+            # multipart threads, so the pool has to cover all of them
+            transfer = config["aws"]["s3"].get("transfer", {})
+            pool_size = max(
+                pool_size, transfer.get("max_files", 4) * transfer.get("max_concurrency", 8)
+            )
+        return Config(
+            region_name=settings.get("region"),
+            max_pool_connections=pool_size,
+            connect_timeout=settings.get("connect_timeout", 5),
+            read_timeout=settings.get("read_timeout", 60),
+            retries={
+                "mode": settings.get("retry_mode", "adaptive"),
+                "max_attempts": settings.get("max_attempts", 10),
+            },
+        )
+
+    def get_client(self, service):
+        pid = os.getpid()
+        client = self._clients.get(service)
+        if client is not None and self._pid == pid:
+            return client
+        with self._lock:
+            if self._pid != pid:
+                self._session = boto3.session.Session()
+                self._clients = {}
+                self._counters = {}
+                self._pid = pid
+            client = self._clients.get(service)
+            if client is None:
+                client = self._session.client(service, config=self.client_config(service))
+                self._track(service, client)
+                self._clients[service] = client
+            return client
+
+    def get_s3_client(self):
+        return self.get_client("s3")
+
+    def get_athena_client(self):
+        return self.get_client("athena")
+
+    def get_glue_client(self):
+        return self.get_client("glue")
+
+    def get_sqs_client(self):
+        return self.get_client("sqs")
+
+    def _track(self, service, client):
+        counters = {"in_flight": 0, "peak_in_flight": 0, "requests": 0}
+        self._counters[service] = counters
+        counter_lock = threading.Lock()
+
+        def before_send(**kwargs):
+            with counter_lock:
+                counters["requests"] += 1
+                counters["in_flight"] += 1
+                counters["peak_in_flight"] = max(
+                    counters["peak_in_flight"], counters["in_flight"]
+                )
+
+        def response_received(**kwargs):
+            with counter_lock:
+                counters["in_flight"] -= 1
+
+        client.meta.events.register("before-send", before_send)
+        client.meta.events.register("response-received", response_received)
+
+    def pool_metrics(self):
+        """
+        Report connection pool usage per client, to size max_pool_connections
+        for the concurrency the app runs at.
+
+        Returns:
+            dict: {service: {max_pool_connections, requests, in_flight,
+                peak_in_flight, connections_created, idle_connections}}. A
+                peak_in_flight at max_pool_connections means requests waited
+                for or discarded connections.
+        """
+        metrics = {}
+        with self._lock:
+            clients = dict(self._clients)
+        for service, client in clients.items():
+            entry = {
+                "max_pool_connections": client.meta.config.max_pool_connections,
+                **self._counters.get(service, {}),
+            }
+            try:
+                # botocore keeps one urllib3 pool per endpoint host
+                manager = client._endpoint.http_session._manager
+                pools = [manager.pools[key] for key in manager.pools.keys()]
+                entry["connections_created"] = sum(pool.num_connections for pool in pools)
+                entry["idle_connections"] = sum(pool.pool.qsize() for pool in pools)
+            except Exception:
+                pass
+            metrics[service] = entry
+        return metrics
 
 
 def load_config(config_file="config.yaml"):
@@ -0,0 +1,321 @@
+"""
+Small-file compaction for ingested tables.
+
+Partitioned uploads write a part file per partition and size cap, and
+Athena pays a per-file cost for each of them. Compaction merges a table's
+files into target-sized Parquet files written under a fresh prefix outside
+the crawled parquet_data/ tree,
+
+    compacted/<db>/<table>/<timestamp>/<partition path>/
+
+then points the Glue table and its partitions at that prefix. Partitions are
+moved in batches, so during the swap some partitions already read the new
+files while others still read the old ones; each partition reads one or the
+other, never both, and the old files are only deleted once every partition
+has moved.
+
+    python compaction.py --dry-run
+    python compaction.py --table orders --target-mb 256
+"""
+
+import argparse
+import os
+import statistics
+import time
+from io import BytesIO
+import pyarrow.parquet as pq
+from aws_clients import aws_client, config
+from glue import get_table, get_partitions, invalidate_schema_cache
+from s3 import upload_to_s3, delete_keys, get_transfer_config
+
+
+def split_s3_uri(uri):
+    bucket, _, prefix = uri[len("s3://") :].partition("/")
+    return bucket, prefix.rstrip("/") + "/"
+
+
+def list_data_files(bucket, prefix):
+    """
+    List the Parquet files under a prefix, grouped by the directory they sit
+    in relative to the prefix ("" for an unpartitioned table).
+
+    Returns:
+        dict: {relative directory: [(key, size), ...]}
+    """
+    s3_client = aws_client.get_s3_client()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    groups = {}
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            relative = obj["Key"][len(prefix) :]
+            directory, _, file_name = relative.rpartition("/")
+            # hidden and marker files are ignored by Athena as well
+            if file_name.startswith(("_", ".")) or not file_name.endswith(".parquet"):
+                continue
+            groups.setdefault(directory, []).append((obj["Key"], obj["Size"]))
+    return groups
+
+
+def copy_file(bucket, key, new_key):
+    # managed copy, split into multipart UploadPartCopy calls for files over
+    # the 5 GB copy_object limit
+    s3_client = aws_client.get_s3_client()
+    s3_client.copy(
+        {"Bucket": bucket, "Key": key}, bucket, new_key, Config=get_transfer_config()
+    )
+
+
+def describe_files(groups, small_file_bytes):
+    sizes = [size for files in groups.values() for _, size in files]
+    if not sizes:
+        return {"files": 0, "directories": 0, "small_files": 0, "total_mb": 0}
+    return {
+        "files": len(sizes),
+        "directories": len(groups),
+        "small_files": sum(size < small_file_bytes for size in sizes),
+        "total_mb": round(sum(sizes) / 1024**2, 2),
+        "min_mb": round(min(sizes) / 1024**2, 2),
+        "median_mb": round(statistics.median(sizes) / 1024**2, 2),
+        "max_mb": round(max(sizes) / 1024**2, 2),
+    }
+
+
+def needs_compaction(groups, small_file_bytes):
+    return any(
+        sum(size < small_file_bytes for _, size in files) > 1
+        for files in groups.values()
+    )
+
+
+def compact_directory(files, bucket, new_prefix, target_bytes, row_group_size):
+    """
+    Rewrite one directory's files as target-sized files under new_prefix.
+
+    Files at least target_bytes large are copied as they are. Smaller files
+    are read one at a time and appended to the current output, which is
+    uploaded once it reaches the target size.
+
+    Returns:
+        tuple: (new keys, bytes written)
+    """
+    s3_client = aws_client.get_s3_client()
+    new_keys = []
+    written_bytes = 0
+    writer = None
+    buffer = None
+    pending_bytes = 0
+
+    def flush():
+        nonlocal writer, buffer, pending_bytes, written_bytes
+        if writer is None:
+            return
+        writer.close()
+        key = f"{new_prefix}compacted-{len(new_keys)}.parquet"
+        written_bytes += upload_to_s3(buffer, bucket, key)["bytes"]
+        new_keys.append(key)
+        writer, buffer, pending_bytes = None, None, 0
+
+    for key, size in sorted(files):
+        if size >= target_bytes:
+            new_key = f"{new_prefix}{os.path.basename(key)}"
+            copy_file(bucket, key, new_key)
+            written_bytes += size
+            new_keys.append(new_key)
+            continue
+
+        obj = s3_client.get_object(Bucket=bucket, Key=key)
+        table = pq.read_table(BytesIO(obj["Body"].read()))
+        if writer is not None and not table.schema.equals(writer.schema):
+            flush()
+        if writer is None:
+            buffer = BytesIO()
+            writer = pq.ParquetWriter(buffer, table.schema, compression="zstd")
+        writer.write_table(table, row_group_size=row_group_size)
+        pending_bytes += size
+        if pending_bytes >= target_bytes:
+            flush()
+    flush()
+    return new_keys, written_bytes
+
+
+def compact_table(
+    table_name,
+    target_mb=None,
+    small_file_mb=None,
+    row_group_size=None,
+    dry_run=False,
+    keep_old=False,
+    database_name=None,
+):
+    """
+    Compact one table's small files and swap the table over to them.
+
+    Args:
+        table_name (str): The Glue table to compact.
+        target_mb (int): Target size of the compacted files, defaults to the
+            compaction.target_mb setting or 256.
+        small_file_mb (int): Files below this size are merged, defaults to
+            the compaction.small_file_mb setting or half the target size.
+        row_group_size (int): Rows per row group in the compacted files,
+            defaults to the compaction.row_group_size setting or 500,000.
+        dry_run (bool): Only report file counts and sizes.
+        keep_old (bool): Leave the old files in place after the swap.
+        database_name (str): The Glue database, defaults to the configured one.
+
+    Returns:
+        dict: The file statistics before (and after, unless dry_run).
+    """
+    database_name = database_name or config["aws"]["glue"]["database"]
+    compaction_config = config.get("compaction", {})
+    target_mb = target_mb or compaction_config.get("target_mb", 256)
+    small_file_mb = small_file_mb or compaction_config.get("small_file_mb", target_mb / 2)
+    row_group_size = row_group_size or compaction_config.get("row_group_size", 500_000)
+    target_bytes = target_mb * 1024**2
+    small_file_bytes = small_file_mb * 1024**2
+
+    table = get_table(table_name, database_name)
+    location = table["StorageDescriptor"]["Location"]
+    bucket, prefix = split_s3_uri(location)
+    groups = list_data_files(bucket, prefix)
+    report = {
+        "table": table_name,
+        "location": location,
+        "before": describe_files(groups, small_file_bytes),
+    }
+    if dry_run or not needs_compaction(groups, small_file_bytes):
+        report["compacted"] = False
+        return report
+
+    base_prefix = compaction_config.get("prefix", "compacted").strip("/")
+    new_prefix = f"{base_prefix}/{database_name}/{table_name}/{int(time.time())}/"
+    total_bytes = 0
+    for directory, files in groups.items():
+        directory_prefix = f"{new_prefix}{directory}/" if directory else new_prefix
+        _, written_bytes = compact_directory(
+            files, bucket, directory_prefix, target_bytes, row_group_size
+        )
+        total_bytes += written_bytes
+
+    # files ingested while compacting are carried over as they are, so the
+    # swap does not leave them behind at the old location
+    compacted = {key for files in groups.values() for key, _ in files}
+    for directory, files in list_data_files(bucket, prefix).items():
+        directory_prefix = f"{new_prefix}{directory}/" if directory else new_prefix
+        for key, size in files:
+            if key in compacted:
+                continue
+            copy_file(bucket, key, f"{directory_prefix}{os.path.basename(key)}")
+            total_bytes += size
+            compacted.add(key)
+
+    swap_locations(table, f"s3://{bucket}/{new_prefix}", total_bytes, database_name)
+
+    if not keep_old:
+        delete_keys(bucket, sorted(compacted))
+    report["after"] = describe_files(
+        list_data_files(bucket, new_prefix), small_file_bytes
+    )
+    report["compacted"] = True
+    return report
+
+
+def swap_locations(table, new_location, size_bytes, database_name):
+    """
+    Point the table, and each of its partitions, at the compacted files.
+
+    The table is updated first and the partitions follow in batches of 100,
+    so the swap is not atomic: until the last batch, partitions still at the
+    old location read the old files. Callers must keep the old files until
+    this returns.
+
+    The row count is unchanged by compaction, only sizeKey is updated.
+    """
+    glue_client = aws_client.get_glue_client()
+    old_location = table["StorageDescriptor"]["Location"].rstrip("/") + "/"
+    table_input = {
+        key: table[key]
+        for key in ["Name", "TableType", "Parameters", "StorageDescriptor", "PartitionKeys"]
+        if key in table
+    }
+    table_input["StorageDescriptor"] = {
+        **table["StorageDescriptor"],
+        "Location": new_location,
+    }
+    table_input["Parameters"] = {
+        **table.get("Parameters", {}),
+        "sizeKey": str(int(size_bytes)),
+    }
+    record_count = int(table_input["Parameters"].get("recordCount", 0) or 0)
+    if record_count:
+        table_input["Parameters"]["averageRecordSize"] = str(
+            int(size_bytes / record_count)
+        )
+    glue_client.update_table(DatabaseName=database_name, TableInput=table_input)
+
+    if table.get("PartitionKeys"):
+        entries = []
+        for partition in get_partitions(table["Name"], database_name=database_name):
+            storage = partition["StorageDescriptor"]
+            relative = storage["Location"].rstrip("/") + "/"
+            relative = relative[len(old_location) :] if relative.startswith(old_location) else ""
+            entries.append(
+                {
+                    "PartitionValueList": partition["Values"],
+                    "PartitionInput": {
+                        "Values": partition["Values"],
+                        "StorageDescriptor": {
+                            **storage,
+                            "Location": f"{new_location}{relative}",
+                        },
+                    },
+                }
+            )
+        # batch_update_partition accepts at most 100 partitions per call
+        for i in range(0, len(entries), 100):
+            response = glue_client.batch_update_partition(
+                DatabaseName=database_name,
+                TableName=table["Name"],
+                Entries=entries[i : i + 100],
+            )
+            for error in response.get("Errors", []):
+                raise Exception(
+                    f"Failed to move partition {error['PartitionValueList']}: "
+                    f"{error['ErrorDetail']['ErrorMessage']}"
+                )
+    invalidate_schema_cache(database_name)
+
+
+def compact_database(database_name=None, **kwargs):
+    database_name = database_name or config["aws"]["glue"]["database"]
+    glue_client = aws_client.get_glue_client()
+    paginator = glue_client.get_paginator("get_tables")
+    reports = []
+    for page in paginator.paginate(DatabaseName=database_name):
+        for table in page["TableList"]:
+            reports.append(compact_table(table["Name"], database_name=database_name, **kwargs))
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact small Parquet files.")
+    parser.add_argument("--table", help="Compact one table instead of the database")
+    parser.add_argument("--target-mb", type=int)
+    parser.add_argument("--small-file-mb", type=int)
+    parser.add_argument("--row-group-size", type=int)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--keep-old", action="store_true")
+    args = parser.parse_args()
+
+    options = {
+        "target_mb": args.target_mb,
+        "small_file_mb": args.small_file_mb,
+        "row_group_size": args.row_group_size,
+        "dry_run": args.dry_run,
+        "keep_old": args.keep_old,
+    }
+    if args.table:
+        reports = [compact_table(args.table, **options)]
+    else:
+        reports = compact_database(**options)
+    for report in reports:
+        print(report)
@@ -0,0 +1,403 @@
+import json
+import os
+import shutil
+import threading
+import time
+from functools import partial
+from aws_clients import aws_client, config
+from glue import get_table
+from sql_validator import parse_sql, describe_query, get_referenced_tables
+from query_planner import plan_query, mark_row_limit
+from query_stats import record_run, new_run_id
+
+try:
+    import duckdb
+except ImportError:  # every query goes to Athena
+    duckdb = None
+
+try:
+    import sqlglot
+    from sqlglot import exp
+except ImportError:
+    sqlglot = None
+    exp = None
+
+ATHENA = "athena"
+DUCKDB = "duckdb"
+AUTO = "auto"
+
+# written into each version directory: {relative path: {"size", "etag"}}
+OBJECTS_FILE = "_objects.json"
+
+
+def _quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class DuckDBExecutor:
+    """
+    Runs Athena queries on an embedded DuckDB over the tables' Parquet files.
+
+    Every table is exposed as a view over read_parquet. By default a table's
+    files are mirrored from its Glue location into
+    cache_dir/<table>/version-<n>/ and synced again only when the table's
+    Glue version changes, so repeated questions read local files. Each sync
+    writes a new version directory, hard-linking the files that did not
+    change, and the view is switched to it under the lock. Older versions
+    are deleted once no running query reads them. With read_direct the
+    views read the S3 location through the httpfs extension instead.
+
+    In offline mode neither Glue nor S3 is contacted and the views are built
+    over whatever is in cache_dir, the newest version directory of a table
+    if it has any, which makes the executor a stand-in for Athena without
+    AWS access. Queries are translated from Trino to DuckDB
+    with sqlglot when it is installed.
+    """
+
+    def __init__(
+        self,
+        cache_dir,
+        threads=None,
+        memory_limit=None,
+        read_direct=False,
+        offline=False,
+    ):
+        self.cache_dir = cache_dir
+        self.read_direct = read_direct
+        self.offline = offline
+        self._lock = threading.Lock()
+        # table name -> Glue version the view was built for
+        self._versions = {}
+        # table name -> version directory the view reads
+        self._directories = {}
+        # version directory -> queries reading it
+        self._readers = {}
+        # version directories to delete once nothing reads them
+        self._retired = set()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._connection = duckdb.connect(":memory:")
+        if threads:
+            self._connection.execute(f"SET threads = {int(threads)}")
+        if memory_limit:
+            self._connection.execute(f"SET memory_limit = {_quote(memory_limit)}")
+        if read_direct:
+            for statement in [
+                "INSTALL httpfs",
+                "LOAD httpfs",
+                "INSTALL aws",
+                "LOAD aws",
+                "CREATE OR REPLACE SECRET s3_credentials (TYPE S3, PROVIDER CREDENTIAL_CHAIN)",
+            ]:
+                self._connection.execute(statement)
+
+    def table_dir(self, table_name):
+        return os.path.join(self.cache_dir, table_name)
+
+    def version_dirs(self, table_name):
+        """
+        Return the synced version directories of a table, oldest first.
+        """
+        directory = self.table_dir(table_name)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(
+            os.path.join(directory, name)
+            for name in os.listdir(directory)
+            if name.startswith("version-")
+        )
+
+    def sync_table(self, location, directory, previous=None):
+        """
+        Mirror the Parquet files under a table's S3 location into a new
+        directory. Files whose ETag and size match the copy in the previous
+        version directory are hard-linked from it instead of downloaded again;
+        a file rewritten at the same key with the same size has a new ETag.
+        The ETags are kept in the directory's OBJECTS_FILE for the next sync.
+        """
+        s3_client = aws_client.get_s3_client()
+        bucket, _, prefix = location[len("s3://") :].partition("/")
+        prefix = prefix.rstrip("/") + "/"
+        os.makedirs(directory, exist_ok=True)
+        previous_objects = {}
+        if previous is not None:
+            try:
+                with open(os.path.join(previous, OBJECTS_FILE)) as file:
+                    previous_objects = json.load(file)
+            except (OSError, ValueError):
+                # an older or interrupted sync, download everything again
+                previous_objects = {}
+        objects = {}
+
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                relative = obj["Key"][len(prefix) :]
+                file_name = os.path.basename(relative)
+                if file_name.startswith(("_", ".")) or not file_name.endswith(".parquet"):
+                    continue
+                path = os.path.join(directory, *relative.split("/"))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                objects[relative] = {"size": obj["Size"], "etag": obj["ETag"]}
+                old_path = os.path.join(previous or "", *relative.split("/"))
+                if previous_objects.get(relative) == objects[relative] and os.path.exists(
+                    old_path
+                ):
+                    try:
+                        os.link(old_path, path)
+                    except OSError:
+                        shutil.copyfile(old_path, path)
+                    continue
+                s3_client.download_file(bucket, obj["Key"], path)
+
+        with open(os.path.join(directory, OBJECTS_FILE), "w") as file:
+            json.dump(objects, file)
+
+    def _remove_unused(self):
+        for directory in list(self._retired):
+            if directory not in self._readers:
+                shutil.rmtree(directory, ignore_errors=True)
+                self._retired.discard(directory)
+
+    def _create_view(self, table_name, source, partitioned):
+        self._connection.execute(
+            f'CREATE OR REPLACE VIEW "{table_name}" AS SELECT * FROM read_parquet('
+            f"{_quote(source)}, hive_partitioning = {str(partitioned).lower()}, "
+            "union_by_name = true)"
+        )
+
+    def prepare(self, tables):
+        """
+        Make sure every table has an up to date view.
+
+        Args:
+            tables (dict): {table_name: Glue table}, ignored in offline mode
+                where only the table names are used.
+        """
+        with self._lock:
+            self._prepare(tables)
+
+    def _prepare(self, tables):
+        for table_name, table in tables.items():
+            if self.offline:
+                if table_name in self._versions:
+                    continue
+                directory = self.table_dir(table_name)
+                if not os.path.isdir(directory):
+                    raise Exception(f"No local data for table {table_name}")
+                versions = self.version_dirs(table_name)
+                if versions:
+                    directory = versions[-1]
+                partitioned = any("=" in name for name in os.listdir(directory))
+                source = os.path.join(directory, "**", "*.parquet")
+                self._create_view(table_name, source, partitioned)
+                self._versions[table_name] = None
+                continue
+
+            version = table.get("VersionId") or str(table.get("UpdateTime"))
+            if table_name in self._versions and self._versions[table_name] == version:
+                continue
+            location = table["StorageDescriptor"]["Location"]
+            partitioned = bool(table.get("PartitionKeys"))
+            if self.read_direct:
+                source = f"{location.rstrip('/')}/**/*.parquet"
+                self._create_view(table_name, source, partitioned)
+                self._versions[table_name] = version
+                continue
+
+            existing = self.version_dirs(table_name)
+            # a version left by an earlier process still saves downloads
+            previous = self._directories.get(table_name) or (
+                existing[-1] if existing else None
+            )
+            directory = os.path.join(
+                self.table_dir(table_name), f"version-{time.time_ns():020d}"
+            )
+            start_time = time.monotonic()
+            try:
+                self.sync_table(location, directory, previous)
+            except Exception:
+                shutil.rmtree(directory, ignore_errors=True)
+                raise
+            print(f"Synced {table_name} to {directory} in {time.monotonic() - start_time:.1f}s")
+            self._create_view(
+                table_name, os.path.join(directory, "**", "*.parquet"), partitioned
+            )
+            self._versions[table_name] = version
+            self._directories[table_name] = directory
+            self._retired.update(path for path in existing if path != directory)
+            self._remove_unused()
+
+    def translate(self, sql):
+        if sqlglot is None:
+            return sql
+        return sqlglot.transpile(sql, read="trino", write="duckdb")[0]
+
+    def run(self, sql, tables):
+        """
+        Run an Athena query on DuckDB.
+
+        Returns:
+            pd.DataFrame: The query result.
+        """
+        with self._lock:
+            self._prepare(tables)
+            # the version directories read stay until the query is done
+            directories = [
+                self._directories[table_name]
+                for table_name in tables
+                if table_name in self._directories
+            ]
+            for directory in directories:
+                self._readers[directory] = self._readers.get(directory, 0) + 1
+        # a cursor is a separate connection to the same database, so
+        # concurrent sessions do not share statement state
+        cursor = self._connection.cursor()
+        try:
+            return cursor.execute(self.translate(sql)).df()
+        finally:
+            cursor.close()
+            with self._lock:
+                for directory in directories:
+                    self._readers[directory] -= 1
+                    if not self._readers[directory]:
+                        del self._readers[directory]
+                self._remove_unused()
+
+
+def route_query(sql, max_table_bytes=None, table_metadata=None):
+    """
+    Decide whether a query can run on DuckDB.
+
+    Only SELECTs over tables whose Glue sizeKey adds up to at most
+    max_table_bytes go to DuckDB. Queries using functions sqlglot does not
+    know stay on Athena, since they could not be translated. Tables missing
+    from table_metadata, e.g. a plan_query plan's, are fetched from Glue.
+
+    Returns:
+        tuple: (backend, reason, tables) where tables maps the referenced
+            table names to their Glue tables when the backend is DuckDB.
+    """
+    if duckdb_executor is None:
+        return ATHENA, "DuckDB is not available", {}
+    tree = parse_sql(sql)
+    if tree is None:
+        return ATHENA, "the query could not be parsed", {}
+    if not describe_query(tree)["is_select"]:
+        return ATHENA, "only SELECT queries run locally", {}
+    unknown = tree.find(exp.Anonymous)
+    if unknown is not None:
+        return ATHENA, f"function {unknown.name} has no DuckDB translation", {}
+
+    table_names = sorted(get_referenced_tables(tree))
+    if duckdb_executor.offline:
+        return DUCKDB, "offline", {table_name: None for table_name in table_names}
+
+    if max_table_bytes is None:
+        max_table_bytes = duckdb_config.get("max_table_bytes", 512 * 1024**2)
+    tables = {}
+    total = 0
+    table_metadata = table_metadata or {}
+    for table_name in table_names:
+        table = table_metadata.get(table_name) or get_table(table_name)
+        size = table.get("Parameters", {}).get("sizeKey")
+        if size is None:
+            return ATHENA, f"table {table_name} has no size statistics", {}
+        total += float(size)
+        if total > max_table_bytes:
+            return ATHENA, f"tables are larger than {max_table_bytes} bytes", {}
+        tables[table_name] = table
+    return DUCKDB, f"tables hold {total / 1024**2:.1f} MB", tables
+
+
+def execute_query(
+    sql: str,
+    question: str = "",
+    max_attempts: int = 3,
+    result_format: str = "auto",
+    confirmed: bool = False,
+    backend: str = AUTO,
+):
+    """
+    Run a query on the backend picked for it.
+
+    With backend "auto", queries over small tables run on DuckDB and the rest
+    go to Athena through execute_query_with_autocorrect. A query that fails
+    on DuckDB is handed to Athena, which also takes care of LLM repairs.
+    With backend "duckdb" every query runs on DuckDB and errors are raised.
+    """
+    from athena import execute_query_with_autocorrect
+
+    plan = None
+    if backend != ATHENA and duckdb_executor is not None:
+        plan = plan_query(sql)
+        if backend == DUCKDB:
+            tables = {
+                table_name: None
+                if duckdb_executor.offline
+                else plan["table_metadata"].get(table_name) or get_table(table_name)
+                for table_name in plan["tables"]
+            }
+            reason = "DuckDB backend selected"
+        else:
+            backend_choice, reason, tables = route_query(
+                plan["sql"], table_metadata=plan["table_metadata"]
+            )
+        if backend == DUCKDB or backend_choice == DUCKDB:
+            print(f"Running on DuckDB: {reason}")
+            start_time = time.monotonic()
+            error = None
+            try:
+                df = mark_row_limit(duckdb_executor.run(plan["sql"], tables), plan)
+                df.attrs["sql"] = plan["sql"]
+                df.attrs["generated_sql"] = sql
+                return df
+            except Exception as e:
+                error = str(e)
+                if backend == DUCKDB:
+                    raise
+                print(f"DuckDB failed, running on Athena instead: {e}")
+            finally:
+                record_run(
+                    question,
+                    plan["sql"],
+                    succeeded=error is None,
+                    run_id=new_run_id(),
+                    attempts=1,
+                    wall_seconds=time.monotonic() - start_time,
+                    error=f"duckdb: {error}" if error else None,
+                )
+        else:
+            print(f"Running on Athena: {reason}")
+
+    return execute_query_with_autocorrect(
+        sql,
+        question=question,
+        max_attempts=max_attempts,
+        result_format=result_format,
+        confirmed=confirmed,
+        plan=plan,
+    )
+
+
+def get_run_sql(backend=None):
+    """
+    Return the run_sql function for a backend: athena, duckdb or auto,
+    defaulting to the duckdb.backend setting.
+    """
+    return partial(execute_query, backend=backend or duckdb_config.get("backend", AUTO))
+
+
+duckdb_config = config.get("duckdb", {})
+
+duckdb_executor = None
+if duckdb is not None and duckdb_config.get("enabled", True):
+    duckdb_executor = DuckDBExecutor(
+        cache_dir=duckdb_config.get(
+            "cache_dir",
+            os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "duckdb"),
+        ),
+        threads=duckdb_config.get("threads"),
+        memory_limit=duckdb_config.get("memory_limit"),
+        read_direct=duckdb_config.get("read_direct", False),
+        offline=duckdb_config.get("offline", False),
+    )
@@ -0,0 +1,204 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from aws_clients import config
+
+
+class EmbeddingCache:
+    """
+    Two-level cache of text embeddings.
+
+    Recently used embeddings are kept in an in-memory LRU of up to
+    max_memory_entries. Every embedding is also appended to a float32 vector
+    file per embedding model, read back through a memory map, with a SQLite
+    index from (model id, text hash) to the row holding the vector. Entries
+    are keyed by the model id so switching models never returns vectors from
+    another embedding space.
+    """
+
+    def __init__(self, path, max_memory_entries=10_000):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        # model id -> (dimension, file name, memory map or None)
+        self._models = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS models (
+                    model_id TEXT PRIMARY KEY,
+                    file_name TEXT NOT NULL,
+                    dimension INTEGER NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    model_id TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    row INTEGER NOT NULL,
+                    PRIMARY KEY (model_id, text_hash)
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        # a sqlite3 connection's own context manager only commits or rolls
+        # back, it never closes the connection
+        conn = sqlite3.connect(os.path.join(self.path, "index.sqlite"), timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _model(self, conn, model_id, dimension=None):
+        model = self._models.get(model_id)
+        if model is not None:
+            return model
+        row = conn.execute(
+            "SELECT file_name, dimension FROM models WHERE model_id = ?", (model_id,)
+        ).fetchone()
+        if row is None:
+            if dimension is None:
+                return None
+            file_name = f"{hashlib.sha256(model_id.encode('utf-8')).hexdigest()[:16]}.f32"
+            conn.execute(
+                "INSERT INTO models VALUES (?, ?, ?)", (model_id, file_name, dimension)
+            )
+            row = (file_name, dimension)
+        model = {"file_name": row[0], "dimension": row[1], "vectors": None}
+        self._models[model_id] = model
+        return model
+
+    def _read_row(self, model, row):
+        vectors = model["vectors"]
+        if vectors is None or row >= vectors.shape[0]:
+            # the file grew since it was mapped
+            file_path = os.path.join(self.path, model["file_name"])
+            rows = os.path.getsize(file_path) // (4 * model["dimension"])
+            if row >= rows:
+                return None
+            vectors = np.memmap(
+                file_path, dtype=np.float32, mode="r", shape=(rows, model["dimension"])
+            )
+            model["vectors"] = vectors
+        return vectors[row].tolist()
+
+    def _remember(self, key, embedding):
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, text, model_id):
+        """
+        Return the cached embedding of a text as a list of floats, or None.
+        """
+        key = (model_id, self.text_hash(text))
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return embedding
+            with self._connect() as conn:
+                model = self._model(conn, model_id)
+                found = None
+                if model is not None:
+                    found = conn.execute(
+                        "SELECT row FROM entries WHERE model_id = ? AND text_hash = ?",
+                        key,
+                    ).fetchone()
+            embedding = self._read_row(model, found[0]) if found else None
+            if embedding is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, embedding)
+            return embedding
+
+    def put(self, text, model_id, embedding):
+        key = (model_id, self.text_hash(text))
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        with self._lock:
+            with self._connect() as conn:
+                model = self._model(conn, model_id, dimension=vector.shape[0])
+                if vector.shape[0] != model["dimension"]:
+                    raise Exception(
+                        f"Embedding of {vector.shape[0]} dimensions does not match "
+                        f"the {model['dimension']} of model {model_id}"
+                    )
+                if conn.execute(
+                    "SELECT 1 FROM entries WHERE model_id = ? AND text_hash = ?", key
+                ).fetchone() is None:
+                    with open(os.path.join(self.path, model["file_name"]), "ab") as file:
+                        row = file.tell() // (4 * model["dimension"])
+                        file.write(vector.tobytes())
+                    conn.execute("INSERT INTO entries VALUES (?, ?, ?)", (*key, row))
+            self._remember(key, vector.tolist())
+
+    def get_or_compute(self, text, model_id, compute):
+        """
+        Return the embedding of a text, calling compute(text) and caching the
+        result on a miss.
+        """
+        embedding = self.get(text, model_id)
+        if embedding is None:
+            embedding = compute(text)
+            try:
+                self.put(text, model_id, embedding)
+            except Exception as e:
+                print(f"Failed to cache embedding: {e}")
+            embedding = np.asarray(embedding, dtype=np.float32).reshape(-1).tolist()
+        return embedding
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else None,
+            "memory_entries": len(self._memory),
+        }
+
+    def clear(self):
+        with self._lock:
+            with self._connect() as conn:
+                for (file_name,) in conn.execute("SELECT file_name FROM models").fetchall():
+                    file_path = os.path.join(self.path, file_name)
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+                conn.execute("DELETE FROM entries")
+                conn.execute("DELETE FROM models")
+            self._memory.clear()
+            self._models.clear()
+
+
+embedding_cache_config = config.get("embedding_cache", {})
+
+embedding_cache = None
+if embedding_cache_config.get("enabled", True):
+    embedding_cache = EmbeddingCache(
+        path=embedding_cache_config.get(
+            "path",
+            os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "embeddings"),
+        ),
+        max_memory_entries=embedding_cache_config.get("max_memory_entries", 10_000),
+    )
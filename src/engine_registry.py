@@ -0,0 +1,24 @@
+"""
+Lazily built, process-wide LLM engine.
+
+Importing the orchestrator loads vanna, chromadb with its embedding model
+and the LLM client, so pages and worker processes import this module
+instead and only pay that cost when they first need the engine. The engine
+lives at module level, which Streamlit keeps across reruns and pages.
+"""
+
+import threading
+
+_engine = None
+_lock = threading.Lock()
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _lock:
+            if _engine is None:
+                from orchestrator import create_engine
+
+                _engine = create_engine()
+    return _engine
@@ -1,51 +1,597 @@
+import json
+import threading
 import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import unquote
+import pyarrow as pa
 from aws_clients import config, aws_client
 
 
-def create_glue_crawler(crawler_name, database_name, s3_target_path):
+def create_glue_crawler(
+    crawler_name, database_name, s3_target_path, new_folders_only=None
+):
+    """
+    Create a crawler, or point an existing one at new targets.
+
+    Args:
+        crawler_name (str): The crawler to create or update.
+        database_name (str): The Glue database it writes tables to.
+        s3_target_path (str | list): One s3:// path or a list of them, e.g.
+            only the table prefixes touched by an upload.
+        new_folders_only (bool): Only crawl folders added since the last
+            crawl. Defaults to True for a single path such as the whole
+            database prefix, and False for a list of per-table targets, since
+            the folders of re-uploaded tables are not new.
+    """
     glue_client = aws_client.get_glue_client()
+    paths = [s3_target_path] if isinstance(s3_target_path, str) else list(s3_target_path)
+    if new_folders_only is None:
+        new_folders_only = isinstance(s3_target_path, str)
+
+    if new_folders_only:
+        # incremental crawls can only log schema changes, not apply them
+        recrawl_policy = {"RecrawlBehavior": "CRAWL_NEW_FOLDERS_ONLY"}
+        schema_change_policy = {"UpdateBehavior": "LOG", "DeleteBehavior": "LOG"}
+    else:
+        recrawl_policy = {"RecrawlBehavior": "CRAWL_EVERYTHING"}
+        schema_change_policy = {
+            "UpdateBehavior": "UPDATE_IN_DATABASE",
+            "DeleteBehavior": "DEPRECATE_IN_DATABASE",
+        }
+    crawler_settings = {
+        "Name": crawler_name,
+        "Role": config["aws"]["glue"]["role"],
+        "DatabaseName": database_name,
+        "Targets": {"S3Targets": [{"Path": path} for path in paths]},
+        "TablePrefix": "",
+        "SchemaChangePolicy": schema_change_policy,
+        "RecrawlPolicy": recrawl_policy,
+    }
+
     try:
         glue_client.get_crawler(Name=crawler_name)
-        print(f"Crawler {crawler_name} already exists.")
-        return {"Status": "Crawler already exists"}
     except glue_client.exceptions.EntityNotFoundException:
-        pass  # Crawler does not exist, proceed to create it
-
-    response = glue_client.create_crawler(
-        Name=crawler_name,
-        Role=config["aws"]["glue"]["role"],
-        DatabaseName=database_name,
-        Targets={
-            "S3Targets": [
-                {
-                    "Path": s3_target_path,
-                }
-            ]
-        },
-        TablePrefix="",
-        SchemaChangePolicy={
-            "UpdateBehavior": "UPDATE_IN_DATABASE",
-            "DeleteBehavior": "DEPRECATE_IN_DATABASE",
-        },
-    )
+        return glue_client.create_crawler(**crawler_settings)
 
-    return response
+    print(f"Crawler {crawler_name} already exists, updating its targets.")
+    wait_for_crawler_ready(crawler_name)
+    return glue_client.update_crawler(**crawler_settings)
 
 
-def run_glue_crawler(crawler_name):
+def wait_for_crawler_ready(crawler_name, max_delay=10, timeout=3600):
     glue_client = aws_client.get_glue_client()
+    deadline = time.monotonic() + timeout
+    delay = 1
+    while glue_client.get_crawler(Name=crawler_name)["Crawler"]["State"] != "READY":
+        if time.monotonic() >= deadline:
+            raise Exception(f"Crawler {crawler_name} was not ready within {timeout}s.")
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+def run_glue_crawler(crawler_name, timeout=3600):
+    """
+    Start a crawler and block until its crawl has finished.
+
+    When aws.glue.crawler_event_queue_url is set, completion is taken from
+    the "Glue Crawler State Change" events EventBridge delivers to that SQS
+    queue, received with long polling. Otherwise the crawler is polled, with
+    each wait sized from the time Glue estimates the crawl has left.
+    """
+    glue_client = aws_client.get_glue_client()
+    previous_crawl = glue_client.get_crawler(Name=crawler_name)["Crawler"].get(
+        "LastCrawl", {}
+    )
+    started_at = datetime.now(timezone.utc)
     glue_client.start_crawler(Name=crawler_name)
     print(f"Started crawler: {crawler_name}")
 
-    # Wait for the crawler to finish
-    while True:
-        response = glue_client.get_crawler(Name=crawler_name)
-        state = response["Crawler"]["State"]
-        if state == "READY":  # change to stopping
-            print(f"Crawler {crawler_name} finished successfully.")
-            break
-        elif state == "FAILED":
-            raise Exception(f"Crawler {crawler_name} failed.")
+    queue_url = config["aws"]["glue"].get("crawler_event_queue_url")
+    if queue_url:
+        wait_for_crawler_event(crawler_name, queue_url, timeout, started_at)
+    else:
+        wait_for_crawler_poll(crawler_name, previous_crawl, timeout)
+
+    # the state change event and READY only say the crawl ended, LastCrawl
+    # says how it ended
+    last_crawl = glue_client.get_crawler(Name=crawler_name)["Crawler"].get(
+        "LastCrawl", {}
+    )
+    if last_crawl.get("Status") != "SUCCEEDED":
+        raise Exception(
+            f"Crawler {crawler_name} {last_crawl.get('Status', 'failed').lower()}: "
+            f"{last_crawl.get('ErrorMessage', '')}"
+        )
+    print(f"Crawler {crawler_name} finished successfully.")
+    invalidate_schema_cache()
+
+
+def wait_for_crawler_poll(crawler_name, previous_crawl, timeout):
+    glue_client = aws_client.get_glue_client()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        crawler = glue_client.get_crawler(Name=crawler_name)["Crawler"]
+        # right after start_crawler the crawler can still report READY
+        # from the previous crawl, so also wait for a new LastCrawl
+        if crawler["State"] == "READY" and crawler.get("LastCrawl", {}).get(
+            "StartTime"
+        ) != previous_crawl.get("StartTime"):
+            return
+
+        metrics = glue_client.get_crawler_metrics(CrawlerNameList=[crawler_name])
+        metrics = metrics["CrawlerMetricsList"]
+        time_left = metrics[0].get("TimeLeftSeconds", 0) if metrics else 0
+        delay = min(max(time_left / 2, 2), 30)
+        print(f"Crawler {crawler_name} is in state: {crawler['State']}. Next check in {delay:.0f}s")
+        time.sleep(delay)
+    raise Exception(f"Crawler {crawler_name} did not finish within {timeout}s.")
+
+
+def wait_for_crawler_event(crawler_name, queue_url, timeout, started_at, clock_skew=5):
+    """
+    Wait for the crawler's Succeeded or Failed event.
+
+    Events sent before started_at, less clock_skew seconds, belong to an
+    earlier crawl, e.g. one whose consumer gave up, and are dropped.
+    """
+    sqs_client = aws_client.get_sqs_client()
+    earliest = started_at - timedelta(seconds=clock_skew)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        response = sqs_client.receive_message(
+            QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=20
+        )
+        for message in response.get("Messages", []):
+            event = json.loads(message["Body"])
+            detail = event.get("detail", {})
+            if detail.get("crawlerName") != crawler_name:
+                # another crawler's event, leave it for its own consumer
+                continue
+            sqs_client.delete_message(
+                QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"]
+            )
+            event_time = datetime.fromisoformat(event["time"].replace("Z", "+00:00"))
+            if event_time < earliest:
+                print(f"Dropped stale crawler {crawler_name} event from {event['time']}")
+                continue
+            print(f"Crawler {crawler_name} event: {detail.get('state')}")
+            if detail.get("state") in ("Succeeded", "Failed"):
+                return
+    raise Exception(f"Crawler {crawler_name} did not finish within {timeout}s.")
+
+
+def list_tables(database_name=None):
+    """
+    List every table of a Glue database with the GetTables paginator, one
+    call per page of tables.
+    """
+    database_name = database_name or config["aws"]["glue"]["database"]
+    glue_client = aws_client.get_glue_client()
+    paginator = glue_client.get_paginator("get_tables")
+    return [
+        table
+        for page in paginator.paginate(DatabaseName=database_name)
+        for table in page["TableList"]
+    ]
+
+
+def table_columns(table):
+    """
+    Return the columns of a Glue table, partition keys last.
+
+    Returns:
+        list: One dict per column with table_name, column_name, data_type and
+            is_partition_key.
+    """
+    columns = [
+        (column, False) for column in table.get("StorageDescriptor", {}).get("Columns", [])
+    ] + [(column, True) for column in table.get("PartitionKeys", [])]
+    return [
+        {
+            "table_name": table["Name"],
+            "column_name": column["Name"],
+            "data_type": column["Type"],
+            "is_partition_key": is_partition_key,
+        }
+        for column, is_partition_key in columns
+    ]
+
+
+def get_catalog_columns(database_name=None):
+    """
+    List every column of every table in a Glue database.
+
+    The catalog is read with the GetTables paginator, so the whole database
+    costs one call per page of tables and no Athena queries at all.
+
+    Returns:
+        list: One dict per column with table_name, column_name, data_type and
+            is_partition_key, in catalog order.
+    """
+    return [
+        column for table in list_tables(database_name) for column in table_columns(table)
+    ]
+
+
+_schema_cache = {}
+_schema_cache_lock = threading.Lock()
+
+
+def get_table_schemas(database_name=None, max_age=None):
+    """
+    Return the columns of every table in a Glue database, cached in memory.
+
+    Args:
+        database_name (str): The Glue database, defaults to the configured one.
+        max_age (float): Seconds a cached copy stays valid, defaults to the
+            schema_cache_ttl setting.
+
+    Returns:
+        dict: {table_name: {column_name: data_type}} with lower-cased names.
+            Partition keys are included as columns, and tables without
+            columns map to an empty dict so they still count as existing.
+    """
+    database_name = database_name or config["aws"]["glue"]["database"]
+    if max_age is None:
+        max_age = config["aws"]["glue"].get("schema_cache_ttl", 300)
+
+    with _schema_cache_lock:
+        cached = _schema_cache.get(database_name)
+        if cached and time.monotonic() - cached["loaded_at"] < max_age:
+            return cached["schemas"]
+
+    schemas = {
+        table["Name"].lower(): {
+            column["column_name"].lower(): column["data_type"]
+            for column in table_columns(table)
+        }
+        for table in list_tables(database_name)
+    }
+
+    with _schema_cache_lock:
+        _schema_cache[database_name] = {
+            "schemas": schemas,
+            "loaded_at": time.monotonic(),
+        }
+    return schemas
+
+
+def invalidate_schema_cache(database_name=None):
+    with _schema_cache_lock:
+        if database_name is None:
+            _schema_cache.clear()
         else:
-            print(f"Crawler {crawler_name} is in state: {state}. Waiting...")
-            time.sleep(10)  # Wait for 10 seconds before checking again
+            _schema_cache.pop(database_name, None)
+
+
+def table_version(table):
+    """
+    Return the version id of a Glue table. It changes whenever a crawler or
+    UpdateTable modifies the table, which makes it a cheap way to tell
+    whether data derived from the table is still current.
+    """
+    return table.get("VersionId") or str(table.get("UpdateTime"))
+
+
+def table_statistics(table):
+    """
+    Read the size statistics stored in a Glue table's parameters.
+
+    Returns:
+        dict: size_bytes, record_count and average_record_size, None for any
+            statistic the table does not have.
+    """
+
+    def to_number(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    parameters = table.get("Parameters", {})
+    return {
+        "size_bytes": to_number(parameters.get("sizeKey")),
+        "record_count": to_number(parameters.get("recordCount")),
+        "average_record_size": to_number(parameters.get("averageRecordSize")),
+    }
+
+
+def get_table_versions(table_names, database_name=None):
+    """
+    Return the current Glue version id of each table.
+
+    Returns:
+        dict: {table_name: version_id}
+    """
+    tables = get_tables(table_names, database_name)
+    return {table_name: table_version(table) for table_name, table in tables.items()}
+
+
+def get_table_statistics(table_names, database_name=None):
+    """
+    Read the size statistics a crawler or register_table stores in each
+    table's parameters.
+
+    Returns:
+        dict: {table_name: {"size_bytes", "record_count", "average_record_size"}}
+            with None for any statistic the table does not have.
+    """
+    tables = get_tables(table_names, database_name)
+    return {table_name: table_statistics(table) for table_name, table in tables.items()}
+
+
+def get_table(table_name, database_name=None):
+    database_name = database_name or config["aws"]["glue"]["database"]
+    glue_client = aws_client.get_glue_client()
+    return glue_client.get_table(DatabaseName=database_name, Name=table_name)["Table"]
+
+
+def get_tables(table_names, database_name=None):
+    """
+    Fetch several tables with one GetTable call each.
+
+    Returns:
+        dict: {table_name: Glue table}
+    """
+    return {
+        table_name: get_table(table_name, database_name)
+        for table_name in sorted(set(table_names))
+    }
+
+
+def get_partitions(table_name, expression=None, database_name=None):
+    """
+    List a table's partitions, optionally filtered with a Glue partition
+    expression such as "year = '2024' AND month IN ('01', '02')".
+    """
+    database_name = database_name or config["aws"]["glue"]["database"]
+    glue_client = aws_client.get_glue_client()
+    paginator = glue_client.get_paginator("get_partitions")
+    kwargs = {"DatabaseName": database_name, "TableName": table_name}
+    if expression:
+        kwargs["Expression"] = expression
+    partitions = []
+    for page in paginator.paginate(**kwargs):
+        partitions.extend(page["Partitions"])
+    return partitions
+
+
+PARQUET_STORAGE = {
+    "InputFormat": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+    "OutputFormat": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+    "SerdeInfo": {
+        "SerializationLibrary": "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe",
+        "Parameters": {"serialization.format": "1"},
+    },
+}
+
+
+def arrow_type_to_glue(arrow_type):
+    """
+    Translate a pyarrow type to the Hive type name Glue and Athena expect.
+    """
+    if pa.types.is_boolean(arrow_type):
+        return "boolean"
+    if pa.types.is_int8(arrow_type):
+        return "tinyint"
+    if pa.types.is_int16(arrow_type):
+        return "smallint"
+    if pa.types.is_int32(arrow_type) or pa.types.is_uint8(arrow_type) or pa.types.is_uint16(arrow_type):
+        return "int"
+    if pa.types.is_integer(arrow_type):
+        return "bigint"
+    if pa.types.is_float16(arrow_type) or pa.types.is_float32(arrow_type):
+        return "float"
+    if pa.types.is_float64(arrow_type):
+        return "double"
+    if pa.types.is_decimal(arrow_type):
+        return f"decimal({arrow_type.precision},{arrow_type.scale})"
+    if pa.types.is_date(arrow_type):
+        return "date"
+    if pa.types.is_timestamp(arrow_type):
+        return "timestamp"
+    if pa.types.is_binary(arrow_type) or pa.types.is_large_binary(arrow_type):
+        return "binary"
+    if pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type):
+        return f"array<{arrow_type_to_glue(arrow_type.value_type)}>"
+    if pa.types.is_struct(arrow_type):
+        fields = ",".join(
+            f"{field.name}:{arrow_type_to_glue(field.type)}" for field in arrow_type
+        )
+        return f"struct<{fields}>"
+    return "string"
+
+
+def schema_to_glue_columns(schema):
+    return [
+        {"Name": field.name.lower(), "Type": arrow_type_to_glue(field.type)}
+        for field in schema
+    ]
+
+
+def register_table(
+    table_name,
+    location,
+    schema,
+    partition_schema=None,
+    partition_paths=None,
+    size_bytes=None,
+    record_count=None,
+    replace=True,
+    partition_statistics=None,
+    database_name=None,
+):
+    """
+    Create or update a Parquet table in the Glue catalog straight from its
+    Arrow schema, without running a crawler.
+
+    Args:
+        table_name (str): The table to create or update.
+        location (str): The s3:// prefix holding the table's files.
+        schema (pyarrow.Schema): The columns stored in the files.
+        partition_schema (pyarrow.Schema): Hive partition keys, if any.
+        partition_paths (list): Hive paths of the partitions to add relative
+            to location, e.g. "region=emea". Existing partitions are left
+            alone.
+        size_bytes (int): Bytes written, stored as the sizeKey statistic.
+        record_count (int): Rows written, stored as recordCount.
+        replace (bool): True when the written files replace the table's
+            data, which also drops the partitions not in partition_paths.
+            False when they were added to it.
+        partition_statistics (dict): {partition path: {"size_bytes",
+            "record_count"}}, stored on the partitions so scans of selected
+            partitions can be estimated without listing all of them.
+        database_name (str): The Glue database, defaults to the configured one.
+    """
+    database_name = database_name or config["aws"]["glue"]["database"]
+    glue_client = aws_client.get_glue_client()
+    location = location.rstrip("/") + "/"
+
+    try:
+        existing = glue_client.get_table(DatabaseName=database_name, Name=table_name)
+        existing = existing["Table"]
+    except glue_client.exceptions.EntityNotFoundException:
+        existing = None
+
+    parameters = {"classification": "parquet", "EXTERNAL": "TRUE"}
+    if size_bytes is not None and record_count is not None:
+        if existing is not None and not replace:
+            old = existing.get("Parameters", {})
+            size_bytes += float(old.get("sizeKey", 0))
+            record_count += float(old.get("recordCount", 0))
+        parameters["sizeKey"] = str(int(size_bytes))
+        parameters["recordCount"] = str(int(record_count))
+        if record_count:
+            parameters["averageRecordSize"] = str(int(size_bytes / record_count))
+
+    table_input = {
+        "Name": table_name,
+        "TableType": "EXTERNAL_TABLE",
+        "Parameters": parameters,
+        "StorageDescriptor": {
+            "Columns": schema_to_glue_columns(schema),
+            "Location": location,
+            **PARQUET_STORAGE,
+        },
+        "PartitionKeys": schema_to_glue_columns(partition_schema)
+        if partition_schema is not None
+        else [],
+    }
+    if existing is None:
+        glue_client.create_table(DatabaseName=database_name, TableInput=table_input)
+        print(f"Created table {table_name}")
+    else:
+        if replace and existing.get("PartitionKeys"):
+            keep = {
+                f"{location}{path.strip('/')}/" for path in partition_paths or []
+            }
+            delete_partitions(
+                table_name,
+                [
+                    partition
+                    for partition in get_partitions(table_name, database_name=database_name)
+                    if partition["StorageDescriptor"]["Location"].rstrip("/") + "/"
+                    not in keep
+                ],
+                database_name,
+            )
+        glue_client.update_table(DatabaseName=database_name, TableInput=table_input)
+        print(f"Updated table {table_name}")
+
+    if partition_schema is not None and partition_paths:
+        create_partitions(
+            table_name,
+            location,
+            schema,
+            partition_paths,
+            database_name,
+            partition_statistics=partition_statistics,
+        )
+    invalidate_schema_cache(database_name)
+
+
+def create_partitions(
+    table_name, location, schema, partition_paths, database_name=None, partition_statistics=None
+):
+    """
+    Add Hive-style partitions to a table, given their paths relative to the
+    table location such as "year=2024/month=05". Partitions that already
+    exist are updated, so their statistics and columns stay current.
+    """
+    database_name = database_name or config["aws"]["glue"]["database"]
+    glue_client = aws_client.get_glue_client()
+    partition_statistics = partition_statistics or {}
+    partition_inputs = []
+    for path in sorted(set(partition_paths)):
+        path = path.strip("/")
+        values = [unquote(part.split("=", 1)[1]) for part in path.split("/")]
+        partition_input = {
+            "Values": values,
+            "StorageDescriptor": {
+                "Columns": schema_to_glue_columns(schema),
+                "Location": f"{location.rstrip('/')}/{path}/",
+                **PARQUET_STORAGE,
+            },
+        }
+        statistics = partition_statistics.get(path)
+        if statistics:
+            partition_input["Parameters"] = {
+                "sizeKey": str(int(statistics["size_bytes"])),
+                "recordCount": str(int(statistics["record_count"])),
+            }
+        partition_inputs.append(partition_input)
+
+    # batch_create_partition accepts at most 100 partitions per call
+    existing = []
+    for i in range(0, len(partition_inputs), 100):
+        batch = partition_inputs[i : i + 100]
+        response = glue_client.batch_create_partition(
+            DatabaseName=database_name,
+            TableName=table_name,
+            PartitionInputList=batch,
+        )
+        for error in response.get("Errors", []):
+            if error["ErrorDetail"]["ErrorCode"] != "AlreadyExistsException":
+                raise Exception(
+                    f"Failed to create partition {error['PartitionValues']}: "
+                    f"{error['ErrorDetail']['ErrorMessage']}"
+                )
+            existing.extend(
+                partition_input
+                for partition_input in batch
+                if partition_input["Values"] == error["PartitionValues"]
+            )
+
+    for i in range(0, len(existing), 100):
+        response = glue_client.batch_update_partition(
+            DatabaseName=database_name,
+            TableName=table_name,
+            Entries=[
+                {"PartitionValueList": partition_input["Values"], "PartitionInput": partition_input}
+                for partition_input in existing[i : i + 100]
+            ],
+        )
+        for error in response.get("Errors", []):
+            raise Exception(
+                f"Failed to update partition {error['PartitionValueList']}: "
+                f"{error['ErrorDetail']['ErrorMessage']}"
+            )
+
+
+def delete_partitions(table_name, partitions, database_name=None):
+    database_name = database_name or config["aws"]["glue"]["database"]
+    glue_client = aws_client.get_glue_client()
+    # batch_delete_partition accepts at most 25 partitions per call
+    for i in range(0, len(partitions), 25):
+        response = glue_client.batch_delete_partition(
+            DatabaseName=database_name,
+            TableName=table_name,
+            PartitionsToDelete=[
+                {"Values": partition["Values"]} for partition in partitions[i : i + 25]
+            ],
+        )
+        for error in response.get("Errors", []):
+            raise Exception(
+                f"Failed to delete partition {error['PartitionValues']}: "
+                f"{error['ErrorDetail']['ErrorMessage']}"
+            )
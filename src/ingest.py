@@ -0,0 +1,487 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from botocore.exceptions import ClientError
+from aws_clients import aws_client, config
+import pyarrow.parquet as pq
+from glue import register_table, get_table
+from s3 import upload_to_s3, upload_many_to_s3, list_keys, delete_keys
+from utils import convert_csv_to_parquet, write_parquet_layout, profile_parquet
+
+# Worker processes import this module, so it must not pull in streamlit or
+# the orchestrator.
+
+
+def table_name_for(file_name):
+    return file_name.split(".")[0]
+
+
+def parquet_key(database, table_name):
+    return f"parquet_data/{database}/{table_name}/{table_name}.parquet"
+
+
+def table_prefix(database, table_name):
+    return f"parquet_data/{database}/{table_name}/"
+
+
+def current_table_prefix(bucket, database, table_name):
+    """
+    Return the key prefix a table's files currently live under: the table's
+    Glue location, which compaction may have moved, or the default prefix.
+    """
+    glue_client = aws_client.get_glue_client()
+    try:
+        location = get_table(table_name, database)["StorageDescriptor"]["Location"]
+    except glue_client.exceptions.EntityNotFoundException:
+        return table_prefix(database, table_name)
+    location_bucket, _, prefix = location[len("s3://") :].partition("/")
+    if location_bucket != bucket or not prefix:
+        return table_prefix(database, table_name)
+    return prefix.rstrip("/") + "/"
+
+
+def existing_table_keys(bucket, database, table_name):
+    """
+    List the Parquet files of earlier uploads of a table, under the default
+    prefix and, when compaction moved the table, under its current location.
+    """
+    old_keys = list_keys(bucket, table_prefix(database, table_name), ".parquet")
+    current_prefix = current_table_prefix(bucket, database, table_name)
+    if current_prefix != table_prefix(database, table_name):
+        old_keys += list_keys(bucket, current_prefix, ".parquet")
+    return old_keys
+
+
+def get_default_layout():
+    """
+    Return the file and row group caps from the ingest settings in config.yaml.
+    """
+    ingest_config = config.get("ingest", {})
+    return {
+        "max_rows_per_file": ingest_config.get("max_rows_per_file", 5_000_000),
+        "row_group_size": ingest_config.get("row_group_size", 500_000),
+    }
+
+
+def profile_heading(table_name):
+    return f"Column profile of table {table_name}"
+
+
+def profile_documentation(table_name, profile, max_value_length=40):
+    """
+    Render a column profile from utils.profile_parquet as a compact
+    documentation entry for SQL generation.
+    """
+
+    def show(value):
+        text = str(value)
+        if len(text) > max_value_length:
+            text = text[: max_value_length - 3] + "..."
+        return f"'{text}'" if isinstance(value, str) else text
+
+    lines = [f"{profile_heading(table_name)} ({profile['rows']:,} rows):"]
+    for column in profile["columns"]:
+        facts = []
+        if column["date_format"]:
+            facts.append(
+                f"dates stored as text, parse with date_parse({column['name']}, "
+                f"'{column['date_format']}')"
+            )
+        if column["min"] is not None:
+            facts.append(f"range {show(column['min'])} to {show(column['max'])}")
+        if column["distinct"] is not None:
+            more = "more than " if column["distinct_exceeds"] else ""
+            facts.append(f"{more}{column['distinct']:,} distinct values")
+        # listing values only helps for columns used as categories
+        if column["top_values"] and not column["distinct_exceeds"]:
+            if column["distinct"] <= len(column["top_values"]):
+                label = "values"
+            else:
+                label = "most common"
+            facts.append(
+                f"{label} " + ", ".join(show(value) for value, _ in column["top_values"])
+            )
+        if column["null_fraction"]:
+            facts.append(f"{column['null_fraction']:.1%} null")
+        lines.append(f"- {column['name']} ({column['type']}): " + "; ".join(facts))
+    return "\n".join(lines)
+
+
+def ingest_file(name, path, database, bucket, layout=None, register=True):
+    """
+    Convert one CSV file to Parquet and upload it. Runs in a worker process.
+
+    Without a layout the table is written as a single Parquet object. With a
+    partition_by or sort_by column it is written as Hive-partitioned,
+    size-capped files, see utils.write_parquet_layout. Either way the upload
+    replaces the table's data: once the new files are registered, every
+    other file under the table's prefix is deleted.
+
+    Args:
+        name (str): The original file name, which gives the table name.
+        path (str): Local path of the CSV file.
+        database (str): The Glue database the table belongs to.
+        bucket (str): The destination S3 bucket.
+        layout (dict): Optional partition_by, sort_by, max_rows_per_file and
+            row_group_size.
+        register (bool): Create or update the Glue table from the Arrow
+            schema once the upload is done, so no crawler is needed.
+
+    Returns:
+        dict: name, table, key (object key or table prefix), prefix (the
+            table location's key prefix), files, rows,
+            schema, partition_schema, partitions (relative Hive paths),
+            partition_statistics (bytes and rows per partition path),
+            registered, profile (see utils.profile_parquet, None when
+            disabled), convert_seconds and the upload totals bytes,
+            seconds and mb_per_second, or name, table and error on failure.
+    """
+    table_name = table_name_for(name)
+    layout = {**get_default_layout(), **(layout or {})}
+    ingest_config = config.get("ingest", {})
+    try:
+        start_time = time.monotonic()
+        with open(path, "rb") as file:
+            parquet_buffer, schema = convert_csv_to_parquet(file)
+
+        profile = None
+        if ingest_config.get("profile_columns", True):
+            # a profile is only a hint for SQL generation, never fail the upload
+            try:
+                profile = profile_parquet(
+                    parquet_buffer, top_k=ingest_config.get("profile_top_k", 5)
+                )
+            except Exception as e:
+                print(f"Could not profile {name}: {e}")
+            parquet_buffer.seek(0)
+
+        if not layout.get("partition_by") and not layout.get("sort_by"):
+            convert_seconds = time.monotonic() - start_time
+            key = parquet_key(database, table_name)
+            old_keys = existing_table_keys(bucket, database, table_name)
+            with parquet_buffer:
+                rows = pq.ParquetFile(parquet_buffer).metadata.num_rows
+                upload = upload_to_s3(parquet_buffer, bucket, key)
+            result = {
+                "name": name,
+                "table": table_name,
+                "files": 1,
+                "rows": rows,
+                "schema": schema,
+                "partition_schema": None,
+                "partitions": [],
+                "partition_statistics": {},
+                "profile": profile,
+                "prefix": table_prefix(database, table_name),
+                "convert_seconds": convert_seconds,
+                **upload,
+            }
+            # the single object replaces the table's previous data
+            return replace_table_data(result, bucket, database, register, old_keys, [key])
+
+        with parquet_buffer, tempfile.TemporaryDirectory() as out_dir:
+            paths, schema, partition_schema = write_parquet_layout(
+                parquet_buffer,
+                out_dir,
+                partition_by=layout.get("partition_by"),
+                sort_by=layout.get("sort_by"),
+                max_rows_per_file=layout["max_rows_per_file"],
+                row_group_size=layout["row_group_size"],
+                # unique per upload so the new files never overwrite the
+                # old ones while they are still being read
+                basename=f"part-{uuid.uuid4().hex[:12]}",
+            )
+            convert_seconds = time.monotonic() - start_time
+            # per-partition statistics let the planner size partition scans
+            partition_statistics = {}
+            for relative_path in paths:
+                local_path = os.path.join(out_dir, relative_path)
+                partition = os.path.dirname(relative_path).replace(os.sep, "/")
+                statistics = partition_statistics.setdefault(
+                    partition, {"size_bytes": 0, "record_count": 0}
+                )
+                statistics["size_bytes"] += os.path.getsize(local_path)
+                statistics["record_count"] += pq.ParquetFile(local_path).metadata.num_rows
+            rows = sum(
+                statistics["record_count"] for statistics in partition_statistics.values()
+            )
+
+            # new files always go under the default prefix, which is also
+            # the crawler target; a compacted location is replaced entirely
+            prefix = table_prefix(database, table_name)
+            old_keys = existing_table_keys(bucket, database, table_name)
+            # files are opened by upload_many_to_s3 as their upload starts
+            uploads = [
+                (
+                    os.path.join(out_dir, relative_path),
+                    prefix + relative_path.replace(os.sep, "/"),
+                )
+                for relative_path in paths
+            ]
+            upload_start = time.monotonic()
+            results = upload_many_to_s3(uploads, bucket)
+            upload_seconds = time.monotonic() - upload_start
+
+        errors = [result["error"] for result in results if "error" in result]
+        if errors:
+            # the partial upload must not be read next to the table's files
+            delete_keys(bucket, [result["key"] for result in results if "error" not in result])
+            raise Exception(f"{len(errors)} uploads failed, first error: {errors[0]}")
+        size = sum(result["bytes"] for result in results)
+        result = {
+            "name": name,
+            "table": table_name,
+            "key": prefix,
+            "prefix": prefix,
+            "files": len(paths),
+            "rows": rows,
+            "schema": schema,
+            "partition_schema": partition_schema,
+            "partitions": sorted(set(partition_statistics) - {""}),
+            "partition_statistics": partition_statistics,
+            "profile": profile,
+            "convert_seconds": convert_seconds,
+            "bytes": size,
+            "seconds": upload_seconds,
+            "mb_per_second": size / 1024**2 / upload_seconds if upload_seconds else None,
+        }
+        new_keys = [key for _, key in uploads]
+        return replace_table_data(result, bucket, database, register, old_keys, new_keys)
+    except Exception as e:
+        print(traceback.format_exc())
+        return {"name": name, "table": table_name, "error": str(e)}
+
+
+def replace_table_data(result, bucket, database, register, old_keys, new_keys):
+    """
+    Register the files of an upload and delete the files it replaces.
+
+    The new files are uploaded next to the old ones and the old ones are only
+    deleted once the table points at the new partitions, so a query running
+    meanwhile never finds the table empty.
+    """
+    result = register_result(result, bucket, database, register)
+    stale_keys = sorted(set(old_keys) - set(new_keys))
+    if stale_keys:
+        delete_keys(bucket, stale_keys)
+        print(f"Deleted {len(stale_keys)} files replaced by {result['name']}")
+    return result
+
+
+def register_result(result, bucket, database, register):
+    result["registered"] = False
+    if register:
+        register_table(
+            result["table"],
+            f"s3://{bucket}/{result['prefix']}",
+            result["schema"],
+            partition_schema=result["partition_schema"],
+            partition_paths=result["partitions"],
+            size_bytes=result["bytes"],
+            record_count=result["rows"],
+            replace=True,
+            partition_statistics=result["partition_statistics"],
+            database_name=database,
+        )
+        result["registered"] = True
+    return result
+
+
+def spool_to_disk(file, directory, chunk_size=8 * 1024 * 1024):
+    """
+    Copy an uploaded file to disk so worker processes can stream it instead
+    of receiving the whole content through a pipe, hashing it on the way.
+
+    Every copy gets a unique name, so uploads sharing a file name do not
+    overwrite each other.
+
+    Returns:
+        tuple: (path, sha256 hex digest of the content)
+    """
+    digest = hashlib.sha256()
+    file.seek(0)
+    with tempfile.NamedTemporaryFile(
+        dir=directory, suffix=f"-{os.path.basename(file.name)}", delete=False
+    ) as out:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+            out.write(chunk)
+    return out.name, digest.hexdigest()
+
+
+def manifest_key(database):
+    # kept outside parquet_data/ so crawlers never pick it up
+    return f"ingest_manifest/{database}.json"
+
+
+def load_manifest(bucket, database):
+    """
+    Read the ingest manifest, {table: {sha256, key, layout, schema,
+    ingested_at}}, recording what each table was last built from.
+
+    Returns:
+        tuple: (manifest, ETag of the object, None when there is none yet)
+    """
+    s3_client = aws_client.get_s3_client()
+    try:
+        obj = s3_client.get_object(Bucket=bucket, Key=manifest_key(database))
+    except s3_client.exceptions.NoSuchKey:
+        return {}, None
+    return json.loads(obj["Body"].read()), obj["ETag"]
+
+
+def update_manifest(updates, bucket, database, max_attempts=10):
+    """
+    Merge {table: entry} updates into the ingest manifest.
+
+    The manifest is written with a conditional put against the ETag it was
+    read with, so sessions ingesting at the same time do not drop each
+    other's entries; on a conflict it is read and merged again.
+    """
+    if not updates:
+        return
+    s3_client = aws_client.get_s3_client()
+    for attempt in range(max_attempts):
+        manifest, etag = load_manifest(bucket, database)
+        manifest.update(updates)
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=manifest_key(database),
+                Body=json.dumps(manifest, indent=2).encode("utf-8"),
+                ContentType="application/json",
+                **condition,
+            )
+            return
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise
+            print(f"Ingest manifest changed meanwhile, merging again ({code})")
+            time.sleep(min(0.1 * 2**attempt, 2))
+    raise Exception(f"Could not update the ingest manifest after {max_attempts} attempts")
+
+
+def normalize_layout(layout):
+    return {key: value for key, value in (layout or {}).items() if value is not None}
+
+
+def is_unchanged(entry, digest, layout):
+    return (
+        entry is not None
+        and entry["sha256"] == digest
+        and entry.get("layout") == normalize_layout(layout)
+    )
+
+
+def run_ingestion(
+    files, on_result=None, max_workers=None, layouts=None, register=None, force=False
+):
+    """
+    Convert and upload many files in parallel on a process pool.
+
+    A failure in one file is recorded in its result and does not stop the
+    rest of the batch. Files whose content hash and layout match the ingest
+    manifest are skipped entirely; their result has skipped set to True.
+
+    Args:
+        files (list): Binary file-like objects with a name attribute, such as
+            Streamlit UploadedFiles.
+        on_result (callable): Called in the calling thread with each result
+            as soon as its file is done, e.g. to report progress.
+        max_workers (int): Worker processes, defaults to the ingest.max_workers
+            setting or the number of CPUs.
+        layouts (dict): Optional {file name: layout} passed to ingest_file.
+        register (bool): Register tables in Glue directly, defaults to the
+            ingest.register_tables setting (on unless disabled).
+        force (bool): Ingest every file even if it is unchanged.
+
+    Returns:
+        list: The result of ingest_file for every file, in completion order.
+    """
+    if not files:
+        return []
+    database = config["aws"]["glue"]["database"]
+    bucket = config["aws"]["s3"]["bucket"]
+    if max_workers is None:
+        max_workers = config.get("ingest", {}).get("max_workers") or os.cpu_count()
+
+    layouts = layouts or {}
+    if register is None:
+        register = config.get("ingest", {}).get("register_tables", True)
+    manifest, _ = load_manifest(bucket, database)
+    # only the entries of this batch are written back, see update_manifest
+    updates = {}
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        digests = {}
+        for file in files:
+            path, digest = spool_to_disk(file, directory)
+            table_name = table_name_for(file.name)
+            entry = manifest.get(table_name)
+            if not force and is_unchanged(entry, digest, layouts.get(file.name)):
+                result = {
+                    "name": file.name,
+                    "table": table_name,
+                    "skipped": True,
+                    "key": entry["key"],
+                }
+                results.append(result)
+                if on_result is not None:
+                    on_result(result)
+                continue
+            digests[file.name] = digest
+            paths.append((file.name, path))
+
+        if not paths:
+            return results
+        # spawn rather than fork, forking a multi-threaded server is unsafe
+        with ProcessPoolExecutor(
+            max_workers=min(max_workers, len(paths)),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            futures = {
+                pool.submit(
+                    ingest_file,
+                    name,
+                    path,
+                    database,
+                    bucket,
+                    layouts.get(name),
+                    register,
+                ): name
+                for name, path in paths
+            }
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # the worker process itself died
+                    name = futures[future]
+                    result = {"name": name, "table": table_name_for(name), "error": str(e)}
+                result["skipped"] = False
+                results.append(result)
+                if "error" not in result:
+                    updates[result["table"]] = {
+                        "sha256": digests[result["name"]],
+                        "key": result["key"],
+                        "layout": normalize_layout(layouts.get(result["name"])),
+                        "schema": [
+                            {"name": field.name, "type": str(field.type)}
+                            for field in result["schema"]
+                        ],
+                        "ingested_at": time.time(),
+                    }
+                if on_result is not None:
+                    on_result(result)
+
+    update_manifest(updates, bucket, database)
+    return results
@@ -1,5 +1,5 @@
 import streamlit as st
-from orchestrator import engine
+from engine_registry import get_engine
 import pandas as pd
 from pandas.api.types import (
     is_categorical_dtype,
@@ -115,7 +115,7 @@ left.title("LLM Training Data")
 if right.button(label="Add Training Data", use_container_width=True, type="primary"):
     add_training_data()
 
-df = engine.get_training_data()
+df = get_engine().get_training_data()
 column_config = {
     "training_data_type": st.column_config.Column(
         "Training Data Type",
@@ -1,19 +1,20 @@
-from vanna.openai import OpenAI_Chat
 from vanna.anthropic import Anthropic_Chat
 from vanna.chromadb import ChromaDB_VectorStore
 import os
 import traceback
 import logging
 import pandas as pd
-from groqllm import GroqLLM
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Tuple
 import plotly
 from prompt_chain import MinimalChainable
 import json
 from prompts import generate_sql_prompt, debug_sql_prompt, generate_plotly_code_prompt
 import sqlparse
-from utils import get_value_from_text
+from utils import get_value_from_text, TagStreamParser
+from embedding_cache import embedding_cache
+from semantic_cache import semantic_cache
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -24,12 +25,113 @@ class Orchestrator(ChromaDB_VectorStore, Anthropic_Chat):
         # OpenAI_Chat.__init__(self, config=config)
         Anthropic_Chat.__init__(self, config=config)
         # GroqLLM.__init__(self, config=config)
+        self._retrieval_pool = ThreadPoolExecutor(
+            max_workers=3, thread_name_prefix="retrieval"
+        )
+
+    def embedding_model_id(self) -> str:
+        embedding_function = self.embedding_function
+        model_name = getattr(
+            embedding_function, "MODEL_NAME", getattr(embedding_function, "model_name", "")
+        )
+        return f"{type(embedding_function).__module__}.{type(embedding_function).__name__}:{model_name}"
+
+    def generate_embedding(self, data: str, **kwargs) -> list:
+        # used by the add_* training calls as well as retrieve_context
+        if embedding_cache is None:
+            return ChromaDB_VectorStore.generate_embedding(self, data, **kwargs)
+        return embedding_cache.get_or_compute(
+            data,
+            self.embedding_model_id(),
+            lambda text: ChromaDB_VectorStore.generate_embedding(self, text, **kwargs),
+        )
+
+    def retrieve_context(self, question: str) -> dict:
+        """
+        Fetch the similar question/SQL pairs, related DDL and related
+        documentation for a question in one go.
+
+        The question is embedded once and the three collections are queried
+        concurrently with that embedding, instead of each of
+        get_similar_question_sql, get_related_ddl and get_related_documentation
+        embedding the same text again.
+
+        Returns:
+            dict: question_sql, ddl and documentation lists.
+        """
+        embedding = self.generate_embedding(question)
+        n_results = getattr(self, "n_results", 10)
+        queries = {
+            "question_sql": (
+                self.sql_collection,
+                getattr(self, "n_results_sql", n_results),
+            ),
+            "ddl": (self.ddl_collection, getattr(self, "n_results_ddl", n_results)),
+            "documentation": (
+                self.documentation_collection,
+                getattr(self, "n_results_documentation", n_results),
+            ),
+        }
+        futures = {
+            key: self._retrieval_pool.submit(
+                collection.query, query_embeddings=[embedding], n_results=n
+            )
+            for key, (collection, n) in queries.items()
+        }
+        return {
+            key: ChromaDB_VectorStore._extract_documents(future.result())
+            for key, future in futures.items()
+        }
+
+    def remember_sql(self, question: str, sql: str) -> None:
+        """
+        Add a question and SQL that ran successfully for it to the semantic
+        cache, so rephrasings of the question can reuse the SQL.
+        """
+        if semantic_cache is None or not question or not sql:
+            return
+        try:
+            semantic_cache.add(
+                question, sql, self.generate_embedding(question), self.embedding_model_id()
+            )
+        except Exception as e:
+            print(f"Failed to add query to the semantic cache: {e}")
+
+    def lookup_cached_sql(self, question: str):
+        """
+        Find verified SQL of a near-identical earlier question.
+
+        Returns:
+            dict: question, sql and similarity of the earlier question, or None.
+        """
+        if semantic_cache is None:
+            return None
+        try:
+            return semantic_cache.lookup(
+                question, self.generate_embedding(question), self.embedding_model_id()
+            )
+        except Exception as e:
+            print(f"Semantic cache lookup failed: {e}")
+            return None
+
+    @staticmethod
+    def cached_sql_explanation(hit: dict) -> str:
+        return (
+            f"Reusing the query for the earlier question: {hit['question']} "
+            f"(similarity {hit['similarity']:.2f})"
+        )
+
+    def generate_sql(self, question: str, use_semantic_cache: bool = True, **kwargs) -> str:
+        # verified SQL of a near-identical question needs no LLM call or check
+        hit = self.lookup_cached_sql(question) if use_semantic_cache else None
+        if hit is not None:
+            return hit["sql"], self.cached_sql_explanation(hit), None
 
-    def generate_sql(self, question: str, **kwargs) -> str:
         try:
-            question_sql_list = self.get_similar_question_sql(question)
-            ddl_list = self.get_related_ddl(question)
-            doc_list = self.get_related_documentation(question)
+            context = self.retrieve_context(question)
+            question_sql_list = context["question_sql"]
+            ddl_list = context["ddl"]
+            doc_list = context["documentation"]
 
             result, filled_prompts = MinimalChainable.run(
                 context={
@@ -72,6 +174,70 @@ class Orchestrator(ChromaDB_VectorStore, Anthropic_Chat):
             else:
                 return None, f"Error generating SQL prompt", None
 
+    def submit_prompt_stream(self, prompt, **kwargs):
+        """
+        Like submit_prompt, but yield the response text as it is generated.
+        """
+        if prompt is None or len(prompt) == 0:
+            raise Exception("Prompt is empty")
+        # Claude takes the system message separately from the conversation
+        system_message = ""
+        messages = []
+        for message in prompt:
+            if message["role"] == "system":
+                system_message = message["content"]
+            else:
+                messages.append({"role": message["role"], "content": message["content"]})
+        with self.client.messages.stream(
+            model=self.config["model"],
+            messages=messages,
+            system=system_message,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+        ) as stream:
+            yield from stream.text_stream
+
+    def generate_sql_stream(self, question: str, use_semantic_cache: bool = True, **kwargs):
+        """
+        Stream SQL generation for a question.
+
+        Yields ("token", text) for every chunk of the response, and
+        (tag, content) for sql_query, explanation and clarification_request
+        as soon as the tag closes. The SQL is not validated, so callers can
+        start validating and running it while the explanation is still
+        being generated.
+        """
+        hit = self.lookup_cached_sql(question) if use_semantic_cache else None
+        if hit is not None:
+            yield "sql_query", hit["sql"]
+            yield "explanation", self.cached_sql_explanation(hit)
+            return
+
+        try:
+            context = self.retrieve_context(question)
+            parser = TagStreamParser()
+            for chunk in MinimalChainable.stream(
+                context={
+                    "user_question": question,
+                    "database_ddl": context["ddl"],
+                    "documentation": context["documentation"],
+                    "example_pairs": context["question_sql"],
+                },
+                model=self,
+                callable=self.submit_prompt_stream,
+                prompt=generate_sql_prompt,
+            ):
+                yield "token", chunk
+                for tag, content in parser.feed(chunk):
+                    if tag != "thinking":
+                        yield tag, content
+            print("########### SQL GEN RESPONSE FROM LLM ###########")
+            print(parser.text)
+        except Exception as e:
+            traceback_str = traceback.format_exc()
+            self.log(title="Failed to generate SQL prompt:", message=traceback_str)
+            yield "explanation", "Error generating SQL prompt"
+
     def debug_sql(self, sql: str, error_message: str, question: str, **kwargs) -> str:
         combined_question_error = (
             f"Question: {question}\nError Message: {error_message}"
@@ -81,9 +247,10 @@ class Orchestrator(ChromaDB_VectorStore, Anthropic_Chat):
         if kwargs.get("explain", False):
             sql = f"EXPLAIN {sql}"
 
-        question_sql_pairs = self.get_similar_question_sql(combined_question_error)
-        ddl_list = self.get_related_ddl(combined_question_error)
-        doc_list = self.get_related_documentation(combined_question_error)
+        context = self.retrieve_context(combined_question_error)
+        question_sql_pairs = context["question_sql"]
+        ddl_list = context["ddl"]
+        doc_list = context["documentation"]
         try:
             result, filled_prompts = MinimalChainable.run(
                 context={
@@ -120,7 +287,7 @@ class Orchestrator(ChromaDB_VectorStore, Anthropic_Chat):
         # 2. syntax_checker checks if the sql statement is syntactically correct
         while attempt <= max_attempts:
             if self.is_sql_select(sql):
-                syntax_feedback = syntax_checker(sql)
+                syntax_feedback = syntax_checker(sql, question)
                 if syntax_feedback == "Passed":
                     return True
                 else:
@@ -324,20 +491,31 @@ class Orchestrator(ChromaDB_VectorStore, Anthropic_Chat):
         return sql, df, fig
 
 
-def set_run_sql(engine):
-    from athena import (
-        execute_query_with_autocorrect,
+def set_run_sql(engine, backend=None):
+    """
+    Point engine.run_sql at an execution backend: "athena", "duckdb" or
+    "auto", which routes small queries to DuckDB. Defaults to the
+    duckdb.backend setting.
+    """
+    from duckdb_executor import (
+        get_run_sql,
     )  # Local import to avoid circular dependency
 
-    engine.run_sql = execute_query_with_autocorrect
+    engine.run_sql = get_run_sql(backend)
     engine.run_sql_is_set = True
 
 
-engine = Orchestrator(config={'api_key': os.getenv('ANTHROPIC_API_KEY'), 'model': 'claude-3-5-sonnet-20240620', 'max_tokens': 1500})
-# engine = Orchestrator(
-#     config={"api_key": os.getenv("OPENAI_API_KEY"), "model": "gpt-3.5-turbo"}
-# )
-# engine = Orchestrator(config={'api_key': os.getenv('GROQ_API_KEY'), 'model': 'llama3-8b-8192'})
-# engine = Orchestrator(config={'api_key': os.getenv('GROQ_API_KEY'), 'model': 'llama3-70b-8192'})
-
-set_run_sql(engine)
+def create_engine():
+    """
+    Build the engine with its execution backend. Use engine_registry.get_engine
+    to share one engine instead of calling this directly.
+    """
+    engine = Orchestrator(config={'api_key': os.getenv('ANTHROPIC_API_KEY'), 'model': 'claude-3-5-sonnet-20240620', 'max_tokens': 1500})
+    # engine = Orchestrator(
+    #     config={"api_key": os.getenv("OPENAI_API_KEY"), "model": "gpt-3.5-turbo"}
+    # )
+    # engine = Orchestrator(config={'api_key': os.getenv('GROQ_API_KEY'), 'model': 'llama3-8b-8192'})
+    # engine = Orchestrator(config={'api_key': os.getenv('GROQ_API_KEY'), 'model': 'llama3-70b-8192'})
+
+    set_run_sql(engine)
+    return engine
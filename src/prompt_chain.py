@@ -1,7 +1,7 @@
 import json
 import re
 import traceback
-from typing import Any, Callable, Dict, List, Union
+from typing import Any, Callable, Dict, Iterator, List, Union
 
 
 class MinimalChainable:
@@ -9,6 +9,53 @@ class MinimalChainable:
     Sequential prompt chaining with context and output back-references.
     """
 
+    @staticmethod
+    def fill_prompt(prompt: str, context: Dict[str, Any], output: List[Any]) -> str:
+        """
+        Substitute {{key}} context values and {{output[-j]}} references to the
+        outputs of earlier prompts in the chain.
+        """
+        i = len(output)
+        # Iterate over each key-value pair in the context
+        for key, value in context.items():
+            # Replace the key with its value
+            prompt = prompt.replace("{{" + key + "}}", str(value))
+
+        # Replace references to previous outputs
+        for j in range(i, 0, -1):
+            previous_output = output[i - j]
+            if isinstance(previous_output, dict):
+                if f"{{{{output[-{j}]}}}}" in prompt:
+                    print(
+                        f"Detected dict reference in prompt, replacing with {json.dumps(previous_output)}"
+                    )
+                    prompt = prompt.replace(
+                        f"{{{{output[-{j}]}}}}", json.dumps(previous_output)
+                    )
+                for key, value in previous_output.items():
+                    prompt = prompt.replace(
+                        f"{{{{output[-{j}].{key}}}}}", str(value)
+                    )
+            else:
+                prompt = prompt.replace(
+                    f"{{{{output[-{j}]}}}}", str(previous_output)
+                )
+        return prompt
+
+    @staticmethod
+    def stream(
+        context: Dict[str, Any], model: Any, callable: Callable, prompt: str
+    ) -> Iterator[str]:
+        """
+        Fill a single prompt and yield the response text as it streams in.
+
+        callable takes the structured prompt and returns an iterator of text
+        chunks, such as Orchestrator.submit_prompt_stream.
+        """
+        prompt = MinimalChainable.fill_prompt(prompt, context, [])
+        print(f"Prompt after output replacement 0: {prompt}")
+        yield from callable([model.user_message(prompt)])
+
     @staticmethod
     def run(
         context: Dict[str, Any], model: Any, callable: Callable, prompts: List[str]
@@ -19,30 +66,7 @@ class MinimalChainable:
 
         # Iterate over each prompt with its index
         for i, prompt in enumerate(prompts):
-            # Iterate over each key-value pair in the context
-            for key, value in context.items():
-                # Replace the key with its value
-                prompt = prompt.replace("{{" + key + "}}", str(value))
-
-            # Replace references to previous outputs
-            for j in range(i, 0, -1):
-                previous_output = output[i - j]
-                if isinstance(previous_output, dict):
-                    if f"{{{{output[-{j}]}}}}" in prompt:
-                        print(
-                            f"Detected dict reference in prompt, replacing with {json.dumps(previous_output)}"
-                        )
-                        prompt = prompt.replace(
-                            f"{{{{output[-{j}]}}}}", json.dumps(previous_output)
-                        )
-                    for key, value in previous_output.items():
-                        prompt = prompt.replace(
-                            f"{{{{output[-{j}].{key}}}}}", str(value)
-                        )
-                else:
-                    prompt = prompt.replace(
-                        f"{{{{output[-{j}]}}}}", str(previous_output)
-                    )
+            prompt = MinimalChainable.fill_prompt(prompt, context, output)
             print(f"Prompt after output replacement {i}: {prompt}")
 
             # json_prompt = model.system_message('Ensure your output is in JSON format with the correct keys and double qoutes around each key and value. For exmple: {"key": "value"}. NEVER forget to use the double qoutes as this will cause major errors! Use the escape character for any special characters like double qoutes and backslash. The json returned should be able to be parsed by the json.loads function.')
@@ -0,0 +1,209 @@
+from aws_clients import config
+from glue import get_tables, get_partitions
+from sql_validator import parse_sql, describe_query, get_referenced_tables
+
+try:
+    from sqlglot import exp
+except ImportError:
+    exp = None
+
+
+class QueryNeedsConfirmation(Exception):
+    """
+    Raised when a query would scan more than the confirmation threshold and
+    the user has not agreed to run it yet.
+    """
+
+    def __init__(self, message, plan):
+        super().__init__(message)
+        self.plan = plan
+
+
+def format_bytes(num_bytes):
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if num_bytes < 1024 or unit == "TB":
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _partition_filters(tree, partition_keys):
+    """
+    Collect the equality and IN filters on partition keys from the top-level
+    AND conjuncts of the WHERE clause, as Glue partition expressions. Values
+    containing a quote are left out, Glue expressions cannot escape them.
+    """
+    where = tree.args.get("where")
+    if where is None:
+        return []
+    conjuncts = list(where.this.flatten()) if isinstance(where.this, exp.And) else [where.this]
+    filters = []
+    for condition in conjuncts:
+        if isinstance(condition, exp.EQ):
+            column, value = condition.this, condition.expression
+            if isinstance(value, exp.Column):
+                column, value = value, column
+            if (
+                isinstance(column, exp.Column)
+                and column.name.lower() in partition_keys
+                and isinstance(value, exp.Literal)
+                and "'" not in value.name
+            ):
+                filters.append(f"{column.name} = '{value.name}'")
+        elif isinstance(condition, exp.In) and isinstance(condition.this, exp.Column):
+            values = condition.expressions
+            if condition.this.name.lower() in partition_keys and values and all(
+                isinstance(v, exp.Literal) and "'" not in v.name for v in values
+            ):
+                quoted = ", ".join(f"'{v.name}'" for v in values)
+                filters.append(f"{condition.this.name} IN ({quoted})")
+    return filters
+
+
+def estimate_table_scan_bytes(tree, table, referenced_columns):
+    """
+    Estimate the bytes a query reads from one table.
+
+    Starts from the crawler's sizeKey statistic, narrows it to the partitions
+    selected by literal filters on partition keys, and scales it by the share
+    of columns the query touches since the data is stored as Parquet.
+
+    Returns:
+        float: The estimate in bytes, or None when the table has no statistics.
+    """
+    table_name = table["Name"]
+    size = _to_number(table.get("Parameters", {}).get("sizeKey"))
+    if size is None:
+        return None
+
+    partition_keys = {key["Name"].lower() for key in table.get("PartitionKeys", [])}
+    filters = _partition_filters(tree, partition_keys) if partition_keys else []
+    if filters:
+        selected = get_partitions(table_name, expression=" AND ".join(filters))
+        selected_sizes = [
+            _to_number(p.get("Parameters", {}).get("sizeKey")) for p in selected
+        ]
+        if selected and None not in selected_sizes:
+            size = sum(selected_sizes)
+        else:
+            total = len(get_partitions(table_name))
+            if total:
+                size = size * len(selected) / total
+
+    columns = {
+        column["Name"].lower()
+        for column in table.get("StorageDescriptor", {}).get("Columns", [])
+    }
+    if columns and referenced_columns is not None:
+        used = len(columns & referenced_columns)
+        size = size * max(used, 1) / len(columns)
+    return size
+
+
+def plan_query(sql):
+    """
+    Inspect a query before it runs.
+
+    Injects a LIMIT into plain SELECTs and set operations that neither
+    aggregate nor limit their rows (LIMIT, LIMIT ALL or FETCH FIRST), and
+    estimates how many bytes the query will scan from Glue table
+    and partition statistics.
+
+    The Glue tables are fetched once and kept in the plan, so executing the
+    query does not look them up again.
+
+    Returns:
+        dict: sql (possibly rewritten), limit_injected, row_limit (the
+            injected LIMIT or None), estimated_scan_bytes (None when unknown),
+            tables and table_metadata ({table_name: Glue table}, empty when
+            the tables could not be read).
+    """
+    plan = {
+        "sql": sql,
+        "limit_injected": False,
+        "row_limit": None,
+        "estimated_scan_bytes": None,
+        "tables": [],
+        "table_metadata": {},
+    }
+    tree = parse_sql(sql)
+    if tree is None:
+        return plan
+
+    shape = describe_query(tree)
+    default_limit = config["aws"]["athena"].get("default_row_limit", 10000)
+    if (
+        default_limit
+        and shape["is_select"]
+        and not shape["is_aggregate"]
+        and not shape["has_group_by"]
+        and not shape["has_limit"]
+    ):
+        # added to the tree, so trailing comments cannot swallow it
+        plan["sql"] = tree.limit(default_limit).sql(dialect="trino")
+        plan["limit_injected"] = True
+        plan["row_limit"] = default_limit
+
+    tables = sorted(get_referenced_tables(tree))
+    plan["tables"] = tables
+    if tree.find(exp.Star) is not None:
+        referenced_columns = None
+    else:
+        referenced_columns = {c.name.lower() for c in tree.find_all(exp.Column)}
+
+    total = 0
+    try:
+        plan["table_metadata"] = get_tables(tables)
+        for table in plan["table_metadata"].values():
+            size = estimate_table_scan_bytes(tree, table, referenced_columns)
+            if size is None:
+                return plan
+            total += size
+    except Exception as e:
+        print(f"Could not estimate scanned bytes: {e}")
+        return plan
+    plan["estimated_scan_bytes"] = total
+    return plan
+
+
+def mark_row_limit(df, plan):
+    """
+    Flag a result that filled the LIMIT plan_query injected, since more rows
+    were probably cut off, in df.attrs["truncated"] and df.attrs["row_limit"].
+    """
+    if plan["limit_injected"] and len(df) >= plan["row_limit"]:
+        df.attrs["truncated"] = True
+        df.attrs["row_limit"] = plan["row_limit"]
+    return df
+
+
+def check_scan_budget(plan, confirmed=False):
+    """
+    Enforce the per-question scan budget on a plan from plan_query.
+
+    Queries above max_scan_bytes are refused outright. Queries above
+    confirm_scan_bytes raise QueryNeedsConfirmation unless confirmed is True.
+    """
+    estimate = plan["estimated_scan_bytes"]
+    if estimate is None:
+        return
+    athena_config = config["aws"]["athena"]
+    max_scan_bytes = athena_config.get("max_scan_bytes", 1024**4)
+    confirm_scan_bytes = athena_config.get("confirm_scan_bytes", 10 * 1024**3)
+    if max_scan_bytes is not None and estimate > max_scan_bytes:
+        raise Exception(
+            f"Query would scan about {format_bytes(estimate)}, more than the "
+            f"{format_bytes(max_scan_bytes)} allowed per question."
+        )
+    if not confirmed and confirm_scan_bytes is not None and estimate > confirm_scan_bytes:
+        raise QueryNeedsConfirmation(
+            f"This query will scan about {format_bytes(estimate)} of data. "
+            "Do you want to run it anyway?",
+            plan,
+        )
@@ -0,0 +1,290 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import pandas as pd
+from aws_clients import config
+from sql_validator import sql_pattern
+
+STATISTIC_KEYS = [
+    "DataScannedInBytes",
+    "EngineExecutionTimeInMillis",
+    "QueryQueueTimeInMillis",
+    "ServiceProcessingTimeInMillis",
+    "QueryPlanningTimeInMillis",
+    "TotalExecutionTimeInMillis",
+]
+
+# executions table columns for STATISTIC_KEYS, in the same order
+STATISTIC_COLUMNS = [
+    "data_scanned_bytes",
+    "engine_execution_ms",
+    "queue_ms",
+    "service_processing_ms",
+    "planning_ms",
+    "total_execution_ms",
+]
+
+_local = threading.local()
+
+
+def new_run_id():
+    return uuid.uuid4().hex
+
+
+def set_current_run(run_id):
+    """
+    Attribute executions recorded from this thread to a run, so EXPLAIN
+    checks made while repairing a query are counted towards it.
+    """
+    _local.run_id = run_id
+
+
+def get_current_run():
+    return getattr(_local, "run_id", None)
+
+
+class QueryStats:
+    """
+    Local SQLite store of Athena execution statistics.
+
+    Every execution is recorded in the executions table with its kind (query,
+    retry, explain or unload). Every call to execute_query_with_autocorrect is
+    recorded in the runs table with the final SQL and where its wall clock
+    time went: Athena, LLM repairs or result download. Executions made on
+    behalf of a run carry its run_id.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS executions (
+                    recorded_at REAL NOT NULL,
+                    run_id TEXT,
+                    execution_id TEXT,
+                    kind TEXT NOT NULL,
+                    attempt INTEGER,
+                    question TEXT,
+                    sql TEXT,
+                    pattern TEXT,
+                    state TEXT,
+                    data_scanned_bytes INTEGER,
+                    engine_execution_ms INTEGER,
+                    queue_ms INTEGER,
+                    service_processing_ms INTEGER,
+                    planning_ms INTEGER,
+                    total_execution_ms INTEGER
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS runs (
+                    recorded_at REAL NOT NULL,
+                    run_id TEXT,
+                    question TEXT,
+                    final_sql TEXT,
+                    pattern TEXT,
+                    succeeded INTEGER NOT NULL,
+                    cache_hit INTEGER NOT NULL,
+                    attempts INTEGER,
+                    wall_seconds REAL,
+                    llm_repair_seconds REAL,
+                    download_seconds REAL,
+                    error TEXT
+                )
+                """
+            )
+            # stores created before run ids were recorded
+            for table in ["executions", "runs"]:
+                columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+                if "run_id" not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN run_id TEXT")
+
+    @contextmanager
+    def _connect(self):
+        # a sqlite3 connection's own context manager only commits or rolls
+        # back, it never closes the connection
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _insert(self, table, row):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                f"INSERT INTO {table} ({', '.join(row)}) "
+                f"VALUES ({', '.join('?' * len(row))})",
+                list(row.values()),
+            )
+
+    def record_execution(
+        self, query_execution, kind, question="", attempt=None, run_id=None
+    ):
+        statistics = query_execution.get("Statistics", {})
+        sql = query_execution.get("Query", "")
+        row = {
+            "recorded_at": time.time(),
+            "run_id": run_id,
+            "execution_id": query_execution.get("QueryExecutionId"),
+            "kind": kind,
+            "attempt": attempt,
+            "question": question,
+            "sql": sql,
+            "pattern": sql_pattern(sql),
+            "state": query_execution.get("Status", {}).get("State"),
+        }
+        for column, key in zip(STATISTIC_COLUMNS, STATISTIC_KEYS):
+            row[column] = statistics.get(key)
+        self._insert("executions", row)
+
+    def record_run(
+        self,
+        question,
+        final_sql,
+        succeeded,
+        run_id=None,
+        cache_hit=False,
+        attempts=None,
+        wall_seconds=None,
+        llm_repair_seconds=None,
+        download_seconds=None,
+        error=None,
+    ):
+        self._insert(
+            "runs",
+            {
+                "recorded_at": time.time(),
+                "run_id": run_id,
+                "question": question,
+                "final_sql": final_sql,
+                "pattern": sql_pattern(final_sql),
+                "succeeded": int(succeeded),
+                "cache_hit": int(cache_hit),
+                "attempts": attempts,
+                "wall_seconds": wall_seconds,
+                "llm_repair_seconds": llm_repair_seconds,
+                "download_seconds": download_seconds,
+                "error": error,
+            },
+        )
+
+    def report(self, order_by="wall_seconds", limit=10):
+        """
+        Rank question patterns by their average cost.
+
+        Athena time per run is split into queueing and engine execution over
+        all of the run's executions, including retries and the EXPLAIN checks
+        made while repairing it, next to the time spent in LLM repairs and
+        result download. Executions are matched to runs by run_id; runs
+        recorded before run ids existed show no Athena time.
+
+        Args:
+            order_by (str): wall_seconds, scanned_mb, queue_seconds,
+                engine_seconds, llm_repair_seconds or download_seconds.
+            limit (int): Number of patterns to return.
+
+        Returns:
+            pd.DataFrame: One row per SQL pattern.
+        """
+        with self._lock, self._connect() as conn:
+            runs = pd.read_sql_query("SELECT * FROM runs", conn)
+            executions = pd.read_sql_query(
+                "SELECT * FROM executions WHERE run_id IS NOT NULL", conn
+            )
+        if runs.empty:
+            return pd.DataFrame()
+
+        athena = (
+            executions.groupby("run_id")
+            .agg(
+                executions=("execution_id", "count"),
+                scanned_mb=("data_scanned_bytes", lambda b: b.sum() / 1024**2),
+                queue_seconds=("queue_ms", lambda ms: ms.sum() / 1000),
+                engine_seconds=("engine_execution_ms", lambda ms: ms.sum() / 1000),
+            )
+            .reset_index()
+        )
+        per_run = runs.merge(athena, on="run_id", how="left")
+        # cache hits and DuckDB runs spend no time in Athena
+        columns = ["executions", "scanned_mb", "queue_seconds", "engine_seconds"]
+        has_id = per_run["run_id"].notna()
+        per_run.loc[has_id, columns] = per_run.loc[has_id, columns].fillna(0)
+        report = (
+            per_run.groupby("pattern")
+            .agg(
+                runs=("question", "count"),
+                example_question=("question", "first"),
+                success_rate=("succeeded", "mean"),
+                cache_hit_rate=("cache_hit", "mean"),
+                attempts=("attempts", "mean"),
+                executions=("executions", "mean"),
+                wall_seconds=("wall_seconds", "mean"),
+                queue_seconds=("queue_seconds", "mean"),
+                engine_seconds=("engine_seconds", "mean"),
+                llm_repair_seconds=("llm_repair_seconds", "mean"),
+                download_seconds=("download_seconds", "mean"),
+                scanned_mb=("scanned_mb", "mean"),
+            )
+            .reset_index()
+        )
+        return report.sort_values(order_by, ascending=False).head(limit)
+
+
+query_stats_config = config.get("query_stats", {})
+
+query_stats = None
+if query_stats_config.get("enabled", True):
+    query_stats = QueryStats(
+        path=query_stats_config.get(
+            "path",
+            os.path.join(
+                os.path.dirname(os.path.dirname(__file__)), "cache", "query_stats.sqlite"
+            ),
+        )
+    )
+
+
+def record_execution(query_execution, kind, question="", attempt=None, run_id=None):
+    if query_stats is None or query_execution is None:
+        return
+    try:
+        query_stats.record_execution(
+            query_execution, kind, question, attempt, run_id or get_current_run()
+        )
+    except Exception as e:
+        print(f"Failed to record query statistics: {e}")
+
+
+def record_run(question, final_sql, succeeded, **kwargs):
+    if query_stats is None:
+        return
+    try:
+        query_stats.record_run(question, final_sql, succeeded, **kwargs)
+    except Exception as e:
+        print(f"Failed to record query run: {e}")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if query_stats is None:
+        sys.exit("Query statistics are disabled (query_stats.enabled is false).")
+    order_by = sys.argv[1] if len(sys.argv) > 1 else "wall_seconds"
+    report = query_stats.report(order_by=order_by)
+    if report.empty:
+        sys.exit(f"No runs recorded yet in {query_stats.path}.")
+    pd.set_option("display.max_columns", None)
+    pd.set_option("display.width", 200)
+    print(f"Slowest question patterns by {order_by}:")
+    print(report.to_string(index=False))
+    print("\nMost expensive question patterns by scanned data:")
+    print(query_stats.report(order_by="scanned_mb").to_string(index=False))
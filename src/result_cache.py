@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import pyarrow as pa
+import pyarrow.feather as feather
+from aws_clients import config
+from glue import get_table_versions, table_version
+from sql_validator import normalize_sql
+
+
+class ResultCache:
+    """
+    Disk-backed cache of query results.
+
+    Results are stored as Arrow IPC files next to a SQLite index. Entries are
+    keyed by the normalized SQL together with the Glue version of every table
+    the query reads, so a crawler or UpdateTable on any of those tables makes
+    the old entries unreachable. The least recently used entries are evicted
+    once the cache grows past max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    file_name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    sql TEXT NOT NULL,
+                    tables TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        # a sqlite3 connection's own context manager only commits or rolls
+        # back, it never closes the connection
+        conn = sqlite3.connect(os.path.join(self.path, "index.sqlite"), timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def make_key(self, sql, table_metadata=None):
+        """
+        Return the cache key for a query and the tables it reads, or
+        (None, None) when the query cannot be cached.
+
+        Args:
+            sql (str): The query.
+            table_metadata (dict): {table_name: Glue table} already fetched
+                for the query, e.g. by plan_query, to read the versions from.
+        """
+        normalized, tables = normalize_sql(sql)
+        if normalized is None or not tables:
+            return None, None
+        try:
+            if table_metadata and tables <= set(table_metadata):
+                versions = {table: table_version(table_metadata[table]) for table in tables}
+            else:
+                versions = get_table_versions(tables)
+        except Exception as e:
+            print(f"Not caching query, could not read table versions: {e}")
+            return None, None
+        payload = json.dumps({"sql": normalized, "tables": versions}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest(), sorted(tables)
+
+    def get(self, sql, table_metadata=None):
+        """
+        Return the cached result of a query as a DataFrame, or None on a miss.
+        """
+        key, _ = self.make_key(sql, table_metadata)
+        if key is None:
+            return None
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT file_name FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+        try:
+            table = feather.read_table(os.path.join(self.path, row[0]))
+        except (OSError, pa.ArrowInvalid):
+            self.delete(key)
+            return None
+        print(f"Result cache hit for {key[:12]}")
+        return table.to_pandas()
+
+    def put(self, sql, df, table_metadata=None):
+        key, tables = self.make_key(sql, table_metadata)
+        if key is None:
+            return
+        file_name = f"{key}.arrow"
+        file_path = os.path.join(self.path, file_name)
+        tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        feather.write_feather(
+            pa.Table.from_pandas(df, preserve_index=False),
+            tmp_path,
+            compression="zstd",
+        )
+        os.replace(tmp_path, file_path)
+
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    file_name,
+                    os.path.getsize(file_path),
+                    sql,
+                    json.dumps(tables),
+                    now,
+                    now,
+                ),
+            )
+            self._evict(conn)
+
+    def delete(self, key):
+        with self._lock, self._connect() as conn:
+            self._delete_entry(conn, key)
+
+    def clear(self):
+        with self._lock, self._connect() as conn:
+            for (key,) in conn.execute("SELECT key FROM entries").fetchall():
+                self._delete_entry(conn, key)
+
+    def _delete_entry(self, conn, key):
+        row = conn.execute(
+            "SELECT file_name FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        if row is not None:
+            try:
+                os.remove(os.path.join(self.path, row[0]))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute(
+            "SELECT key, size FROM entries ORDER BY last_access"
+        ).fetchall():
+            self._delete_entry(conn, key)
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+result_cache_config = config.get("result_cache", {})
+
+result_cache = None
+if result_cache_config.get("enabled", True):
+    result_cache = ResultCache(
+        path=result_cache_config.get(
+            "path",
+            os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "results"),
+        ),
+        max_bytes=result_cache_config.get("max_bytes", 1024 * 1024 * 1024),
+    )
@@ -1,21 +1,336 @@
 from aws_clients import aws_client, config
+import time
 import pandas as pd
-import io
+from boto3.s3.transfer import TransferConfig
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 
+# Athena result types -> Arrow types. Nested and exotic types stay strings.
+ATHENA_TO_ARROW_TYPES = {
+    "boolean": pa.bool_(),
+    "tinyint": pa.int8(),
+    "smallint": pa.int16(),
+    "integer": pa.int32(),
+    "int": pa.int32(),
+    "bigint": pa.int64(),
+    "real": pa.float32(),
+    "float": pa.float32(),
+    "double": pa.float64(),
+    "date": pa.date32(),
+    "timestamp": pa.timestamp("ms"),
+    "varchar": pa.string(),
+    "char": pa.string(),
+    "string": pa.string(),
+}
 
-def upload_to_s3(buffer, bucket_name, key):
+
+def get_transfer_config():
+    """
+    Build the boto3 TransferConfig for uploads from the aws.s3.transfer
+    settings in config.yaml.
+    """
+    transfer = config["aws"]["s3"].get("transfer", {})
+    return TransferConfig(
+        multipart_threshold=transfer.get("multipart_threshold", 16 * 1024 * 1024),
+        multipart_chunksize=transfer.get("multipart_chunksize", 16 * 1024 * 1024),
+        max_concurrency=transfer.get("max_concurrency", 8),
+        use_threads=True,
+    )
+
+
+def upload_to_s3(buffer, bucket_name, key, transfer_config=None):
+    """
+    Upload a file-like object, split into parallel multipart chunks when it
+    is larger than the multipart threshold.
+
+    Returns:
+        dict: key, bytes, seconds and mb_per_second of the upload.
+    """
     s3_client = aws_client.get_s3_client()
-    s3_client.upload_fileobj(buffer, bucket_name, key)
+    buffer.seek(0, 2)
+    size = buffer.tell()
+    buffer.seek(0)
 
+    start_time = time.monotonic()
+    s3_client.upload_fileobj(
+        buffer, bucket_name, key, Config=transfer_config or get_transfer_config()
+    )
+    seconds = time.monotonic() - start_time
+    mb_per_second = size / 1024**2 / seconds if seconds > 0 else None
+    print(f"Uploaded {key} ({size} bytes) in {seconds:.2f}s")
+    return {
+        "key": key,
+        "bytes": size,
+        "seconds": seconds,
+        "mb_per_second": mb_per_second,
+    }
 
-# get csv results stored in s3.
-#! move to s3 file
-def get_csv_results(execution_id, result_folder):
+
+def upload_many_to_s3(uploads, bucket_name, max_workers=None):
+    """
+    Upload several files in parallel through the shared S3 client.
+
+    Every buffer is closed once its upload finishes or fails, and buffers
+    that were never uploaded are closed before returning. Local paths are
+    opened only when their upload starts, so large batches do not hold every
+    file open at once.
+
+    Args:
+        uploads (list): (buffer or local file path, key) pairs.
+        bucket_name (str): The destination bucket.
+        max_workers (int): Files uploaded at once, defaults to the
+            aws.s3.transfer.max_files setting.
+
+    Returns:
+        list: One dict per upload in the same order, as returned by
+            upload_to_s3, or with an "error" entry if the upload failed.
+    """
+    if not uploads:
+        return []
+    transfer_config = get_transfer_config()
+    if max_workers is None:
+        max_workers = config["aws"]["s3"].get("transfer", {}).get("max_files", 4)
+
+    def upload(item):
+        buffer, key = item
+        try:
+            if isinstance(buffer, str):
+                buffer = open(buffer, "rb")
+            return upload_to_s3(buffer, bucket_name, key, transfer_config)
+        except Exception as e:
+            print(f"Failed to upload {key}: {e}")
+            return {"key": key, "error": str(e)}
+        finally:
+            if not isinstance(buffer, str):
+                buffer.close()
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(uploads))) as pool:
+            return list(pool.map(upload, uploads))
+    finally:
+        # closing twice is harmless, this covers uploads that never started
+        for buffer, _ in uploads:
+            if not isinstance(buffer, str):
+                buffer.close()
+
+
+def list_keys(bucket_name, prefix, suffix=""):
+    """
+    List the keys under a prefix, skipping the hidden and marker files
+    ("_" or "." file names) Athena ignores as well.
+    """
+    s3_client = aws_client.get_s3_client()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    keys = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            file_name = obj["Key"].rpartition("/")[2]
+            if file_name.startswith(("_", ".")) or not file_name.endswith(suffix):
+                continue
+            keys.append(obj["Key"])
+    return keys
+
+
+def delete_keys(bucket_name, keys):
+    s3_client = aws_client.get_s3_client()
+    # delete_objects accepts at most 1000 keys per call
+    for i in range(0, len(keys), 1000):
+        s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={"Objects": [{"Key": key} for key in keys[i : i + 1000]]},
+        )
+
+
+def get_result_schema(execution_id):
+    """
+    Build an Arrow schema from the ResultSetMetadata Athena reports for a query.
+    """
+    athena_client = aws_client.get_athena_client()
+    response = athena_client.get_query_results(
+        QueryExecutionId=execution_id, MaxResults=1
+    )
+    fields = []
+    for column in response["ResultSet"]["ResultSetMetadata"]["ColumnInfo"]:
+        athena_type = column["Type"].lower()
+        if athena_type == "decimal":
+            arrow_type = pa.decimal128(column["Precision"], column["Scale"])
+        else:
+            arrow_type = ATHENA_TO_ARROW_TYPES.get(athena_type, pa.string())
+        fields.append(pa.field(column["Name"], arrow_type))
+    return pa.schema(fields)
+
+
+def read_query_results(
+    execution_id,
+    result_folder,
+    max_rows=None,
+    max_bytes=None,
+    block_size=8 * 1024 * 1024,
+):
+    """
+    Stream a query's CSV result from S3 into a typed Arrow table.
+
+    The object is parsed block by block with the column types Athena reports,
+    so the raw CSV is never held in memory as a whole and no type inference
+    is needed. Reading stops once either cap is reached.
+
+    Args:
+        execution_id (str): The Athena query execution id.
+        result_folder (str): The key prefix Athena writes results to.
+        max_rows (int): Stop after this many rows, None for no cap.
+        max_bytes (int): Stop once the decoded batches reach this size.
+        block_size (int): Bytes of CSV parsed per batch.
+
+    Returns:
+        tuple: (pyarrow.Table, truncated) where truncated is True when a cap
+            cut the result short.
+    """
     s3_client = aws_client.get_s3_client()
     file_name = f"{result_folder}/{execution_id}.csv"
     bucket = config["aws"]["athena"]["output_location"].split("/")[2]
 
+    schema = get_result_schema(execution_id)
     obj = s3_client.get_object(Bucket=bucket, Key=file_name)
-    df = pd.read_csv(io.BytesIO(obj["Body"].read()), encoding="utf8")
-    print(df)
+    body = obj["Body"]
+
+    # Athena writes NULL as an empty unquoted field and '' as a quoted one.
+    # Its timestamps look like 2024-01-01 12:34:56.000, which the ISO-8601
+    # parser reads; strptime formats cannot, Arrow has no %f.
+    convert_options = pacsv.ConvertOptions(
+        column_types=schema,
+        null_values=[""],
+        strings_can_be_null=True,
+        quoted_strings_can_be_null=False,
+        timestamp_parsers=[pacsv.ISO8601],
+    )
+    reader = pacsv.open_csv(
+        pa.PythonFile(body, mode="r"),
+        read_options=pacsv.ReadOptions(block_size=block_size),
+        convert_options=convert_options,
+    )
+
+    batches = []
+    rows = 0
+    nbytes = 0
+    truncated = False
+    try:
+        for batch in reader:
+            if max_rows is not None and rows + batch.num_rows > max_rows:
+                batch = batch.slice(0, max_rows - rows)
+                truncated = True
+            batches.append(batch)
+            rows += batch.num_rows
+            nbytes += batch.nbytes
+            if truncated or (max_bytes is not None and nbytes >= max_bytes):
+                truncated = True
+                break
+    finally:
+        reader.close()
+        body.close()
+
+    table = pa.Table.from_batches(batches, schema=reader.schema)
+    if truncated:
+        print(f"Result of {execution_id} truncated to {rows} rows ({nbytes} bytes)")
+    return table, truncated
+
+
+# get csv results stored in s3.
+def get_csv_results(execution_id, result_folder):
+    athena_config = config["aws"]["athena"]
+    table, truncated = read_query_results(
+        execution_id,
+        result_folder,
+        max_rows=athena_config.get("max_result_rows", 1_000_000),
+        max_bytes=athena_config.get("max_result_bytes", 512 * 1024 * 1024),
+    )
+    df = table.to_pandas()
+    df.attrs["truncated"] = truncated
+    print(f"Fetched {len(df)} rows for {execution_id}")
     return df
+
+
+def delete_prefix(bucket_name, prefix):
+    """
+    Delete every object under a prefix, including hidden and marker files.
+    """
+    s3_client = aws_client.get_s3_client()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    keys = [
+        obj["Key"]
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+        for obj in page.get("Contents", [])
+    ]
+    delete_keys(bucket_name, keys)
+
+
+def read_parquet_results(bucket, prefix, max_rows=None, max_bytes=None, max_workers=8):
+    """
+    Stream the Parquet parts under an S3 prefix into one Arrow table.
+
+    Parts are read in key order, row group by row group, and reading stops
+    once either cap is reached, as in read_query_results. Up to max_workers
+    parts are downloaded ahead of the one being decoded; parts past the cap
+    are never fetched.
+
+    Args:
+        bucket (str): The bucket holding the parts.
+        prefix (str): The key prefix the parts were written to.
+        max_rows (int): Stop after this many rows, None for no cap.
+        max_bytes (int): Stop once the decoded batches reach this size.
+        max_workers (int): Parts downloaded at once.
+
+    Returns:
+        tuple: (pyarrow.Table, truncated) where truncated is True when a cap
+            cut the result short.
+    """
+    s3_client = aws_client.get_s3_client()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    keys = sorted(
+        obj["Key"]
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for obj in page.get("Contents", [])
+        if obj["Size"] > 0
+    )
+    if not keys:
+        return pa.table({}), False
+
+    def download(key):
+        return s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+    batches = []
+    schema = None
+    rows = 0
+    nbytes = 0
+    truncated = False
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(keys))) as pool:
+        pending = [pool.submit(download, key) for key in keys[:max_workers]]
+        next_index = len(pending)
+        try:
+            while pending and not truncated:
+                data = pending.pop(0).result()
+                if next_index < len(keys):
+                    pending.append(pool.submit(download, keys[next_index]))
+                    next_index += 1
+                parquet_file = pq.ParquetFile(BytesIO(data))
+                schema = schema or parquet_file.schema_arrow
+                for batch in parquet_file.iter_batches():
+                    if max_rows is not None and rows + batch.num_rows > max_rows:
+                        batch = batch.slice(0, max_rows - rows)
+                        truncated = True
+                    batches.append(batch)
+                    rows += batch.num_rows
+                    nbytes += batch.nbytes
+                    if truncated or (max_bytes is not None and nbytes >= max_bytes):
+                        truncated = True
+                        break
+        finally:
+            for future in pending:
+                future.cancel()
+
+    table = pa.Table.from_batches(batches, schema=schema)
+    if truncated:
+        print(f"Result under {prefix} truncated to {rows} rows ({nbytes} bytes)")
+    return table, truncated
@@ -0,0 +1,277 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+from aws_clients import config
+from glue import get_table_schemas
+from sql_validator import normalize_sql
+
+
+def schema_fingerprint(tables):
+    """
+    Hash the columns of the given tables from the cached Glue schema, or
+    return None when one of them does not exist.
+    """
+    schemas = get_table_schemas()
+    if any(table not in schemas for table in tables):
+        return None
+    columns = {table: sorted(schemas[table].items()) for table in sorted(tables)}
+    return hashlib.sha256(json.dumps(columns).encode("utf-8")).hexdigest()
+
+
+# "may" is left out, it is far more often a verb than a month in lower case
+MONTHS_AND_DAYS = {
+    "january", "february", "march", "april", "june", "july", "august",
+    "september", "october", "november", "december", "monday", "tuesday",
+    "wednesday", "thursday", "friday", "saturday", "sunday",
+}
+
+
+def question_literals(question):
+    """
+    Collect the parts of a question that usually end up as literals in its
+    SQL: numbers, quoted text, month and day names and capitalised words
+    other than the first of a sentence, such as place or product names.
+
+    Embeddings of "revenue for 2023" and "revenue for 2024" are nearly
+    identical, so two questions are only treated as the same when these
+    match exactly.
+
+    Returns:
+        set: The lower-cased literals.
+    """
+    literals = set(re.findall(r"\d+(?:[.,:/-]\d+)*", question))
+    for single, double in re.findall(r"'([^']+)'|\"([^\"]+)\"", question):
+        literals.add((single or double).lower())
+    for sentence in re.split(r"[.?!]\s+", question):
+        words = re.findall(r"[A-Za-z][\w&-]*", sentence)
+        for index, word in enumerate(words):
+            if word.lower() in MONTHS_AND_DAYS or (
+                index > 0 and word[0].isupper() and word != "I"
+            ):
+                literals.add(word.lower())
+    return literals
+
+
+class SemanticCache:
+    """
+    Reuses the SQL of earlier questions for rephrasings of them.
+
+    Question/SQL pairs are added once the SQL has run successfully, with the
+    question's embedding and a fingerprint of the columns of every table the
+    SQL reads. A lookup returns the pair whose question is the most similar
+    to the new one by cosine similarity, if it reaches threshold, both
+    questions name the same literals (see question_literals) and the
+    tables' columns have not changed since. Entries whose fingerprint no
+    longer matches are dropped when they are found.
+
+    Entries live in SQLite, the embeddings are also kept in memory as one
+    normalised matrix so a lookup is a single matrix-vector product.
+    """
+
+    def __init__(self, path, threshold=0.95, max_entries=5000):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # model id -> (entry ids, normalised embedding matrix), loaded on use
+        self._matrices = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    question TEXT NOT NULL,
+                    sql TEXT NOT NULL,
+                    model_id TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    tables TEXT NOT NULL,
+                    schema_fingerprint TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    last_hit REAL
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        # a sqlite3 connection's own context manager only commits or rolls
+        # back, it never closes the connection
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _load(self, conn, model_id):
+        if model_id not in self._matrices:
+            rows = conn.execute(
+                "SELECT id, embedding FROM entries WHERE model_id = ?", (model_id,)
+            ).fetchall()
+            ids = np.array([row[0] for row in rows], dtype=np.int64)
+            vectors = [np.frombuffer(row[1], dtype=np.float32) for row in rows]
+            matrix = np.vstack(vectors) if vectors else None
+            self._matrices[model_id] = (ids, matrix)
+        return self._matrices[model_id]
+
+    def lookup(self, question, embedding, model_id):
+        """
+        Find a verified SQL query for a question.
+
+        Returns:
+            dict: question, sql and similarity of the matching entry, or None.
+        """
+        vector = self._normalize(embedding)
+        with self._lock, self._connect() as conn:
+            ids, matrix = self._load(conn, model_id)
+            if matrix is None or matrix.shape[1] != vector.shape[0]:
+                self.misses += 1
+                return None
+            similarities = matrix @ vector
+            literals = question_literals(question)
+            # check the closest entries in order until one is still current
+            for index in np.argsort(-similarities):
+                similarity = float(similarities[index])
+                if similarity < self.threshold:
+                    break
+                entry_id = int(ids[index])
+                row = conn.execute(
+                    "SELECT question, sql, tables, schema_fingerprint FROM entries WHERE id = ?",
+                    (entry_id,),
+                ).fetchone()
+                if row is None:
+                    continue
+                cached_question, sql, tables, fingerprint = row
+                if question_literals(cached_question) != literals:
+                    # e.g. the same question about another year or region
+                    continue
+                try:
+                    current = schema_fingerprint(json.loads(tables))
+                except Exception as e:
+                    print(f"Could not check the schema of a cached query: {e}")
+                    break
+                if current != fingerprint:
+                    self.stale += 1
+                    self._delete(conn, [entry_id])
+                    continue
+                conn.execute(
+                    "UPDATE entries SET hits = hits + 1, last_hit = ? WHERE id = ?",
+                    (time.time(), entry_id),
+                )
+                self.hits += 1
+                print(f"Semantic cache hit ({similarity:.3f}): {cached_question}")
+                return {"question": cached_question, "sql": sql, "similarity": similarity}
+            self.misses += 1
+            return None
+
+    def add(self, question, sql, embedding, model_id):
+        """
+        Remember a question together with SQL that ran successfully for it.
+        """
+        _, tables = normalize_sql(sql)
+        if not tables:
+            return
+        fingerprint = schema_fingerprint(tables)
+        if fingerprint is None:
+            return
+        vector = self._normalize(embedding)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "DELETE FROM entries WHERE question = ? AND model_id = ?",
+                (question, model_id),
+            )
+            conn.execute(
+                "INSERT INTO entries (question, sql, model_id, embedding, tables, "
+                "schema_fingerprint, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    question,
+                    sql,
+                    model_id,
+                    vector.tobytes(),
+                    json.dumps(sorted(tables)),
+                    fingerprint,
+                    time.time(),
+                ),
+            )
+            # keep the most recently used entries
+            conn.execute(
+                "DELETE FROM entries WHERE id NOT IN (SELECT id FROM entries "
+                "ORDER BY COALESCE(last_hit, created_at) DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            self._matrices.clear()
+
+    def invalidate(self, tables=None):
+        """
+        Drop the entries that read any of the given tables, or every entry.
+
+        Returns:
+            int: The number of entries dropped.
+        """
+        with self._lock, self._connect() as conn:
+            if tables is None:
+                entry_ids = [row[0] for row in conn.execute("SELECT id FROM entries")]
+            else:
+                tables = {table.lower() for table in tables}
+                entry_ids = [
+                    entry_id
+                    for entry_id, entry_tables in conn.execute(
+                        "SELECT id, tables FROM entries"
+                    )
+                    if tables & set(json.loads(entry_tables))
+                ]
+            self._delete(conn, entry_ids)
+            return len(entry_ids)
+
+    def _delete(self, conn, entry_ids):
+        conn.executemany("DELETE FROM entries WHERE id = ?", [(i,) for i in entry_ids])
+        self._matrices.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._lock, self._connect() as conn:
+            entries, total_hits = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM entries"
+            ).fetchone()
+        return {
+            "entries": entries,
+            "lookups": lookups,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "hits_all_time": total_hits,
+        }
+
+
+semantic_cache_config = config.get("semantic_cache", {})
+
+semantic_cache = None
+if semantic_cache_config.get("enabled", True):
+    semantic_cache = SemanticCache(
+        path=semantic_cache_config.get(
+            "path",
+            os.path.join(
+                os.path.dirname(os.path.dirname(__file__)), "cache", "semantic_cache.sqlite"
+            ),
+        ),
+        threshold=semantic_cache_config.get("threshold", 0.95),
+        max_entries=semantic_cache_config.get("max_entries", 5000),
+    )
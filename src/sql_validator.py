@@ -0,0 +1,326 @@
+import re
+
+try:
+    import sqlglot
+    from sqlglot import exp
+    from sqlglot.errors import ParseError
+    from sqlglot.tokens import TokenType
+except ImportError:  # validation falls back to Athena EXPLAIN
+    sqlglot = None
+
+from glue import get_table_schemas
+from aws_clients import config
+
+VALID = "valid"
+INVALID = "invalid"
+UNSURE = "unsure"
+
+# Functions and function-like keywords of Trino (Athena engine version 3).
+# sqlglot accepts many other dialects' functions and silently rewrites them,
+# so a call to anything outside this list is left to Athena EXPLAIN.
+TRINO_FUNCTIONS = frozenset(
+    """
+    abs acos all_match any_match approx_distinct approx_most_frequent
+    approx_percentile approx_set arbitrary array_agg array_distinct
+    array_except array_intersect array_join array_max array_min array_position
+    array_remove array_sort array_union arrays_overlap asin at_timezone atan
+    atan2 avg bit_count bitwise_and bitwise_and_agg bitwise_not bitwise_or
+    bitwise_or_agg bitwise_xor bool_and bool_or cardinality cast cbrt ceil
+    ceiling char_length character_length checksum chr codepoint coalesce
+    combinations concat concat_ws contains contains_sequence corr cos cosh
+    count count_if covar_pop covar_samp crc32 cume_dist current_date
+    current_time current_timestamp current_timezone date date_add date_diff
+    date_format date_parse date_trunc day day_of_month day_of_week
+    day_of_year degrees dense_rank dow doy e element_at empty_approx_set
+    every exp extract filter first_value flatten floor format format_datetime
+    from_base from_base64 from_hex from_iso8601_date from_iso8601_timestamp
+    from_unixtime from_utf8 geometric_mean greatest grouping hamming_distance
+    histogram hour human_readable_seconds if infinity is_finite is_infinite
+    is_json_scalar is_nan json_array_contains json_array_get
+    json_array_length json_extract json_extract_scalar json_format json_parse
+    json_size kurtosis lag last_day_of_month last_value lead least length
+    levenshtein_distance listagg ln localtime localtimestamp log log10 log2
+    lower lpad ltrim luhn_check map map_agg map_concat map_entries map_filter
+    map_from_entries map_keys map_union map_values map_zip_with max max_by md5
+    merge millisecond min min_by minute mod month multimap_agg nan
+    normal_cdf normalize now nth_value ntile nullif parse_datetime
+    parse_duration percent_rank pi position pow power quarter radians rand
+    random rank reduce regexp_count regexp_extract regexp_extract_all
+    regexp_like regexp_position regexp_replace regexp_split repeat replace
+    reverse round row row_number rpad rtrim second sequence sha1 sha256
+    sha512 shuffle sign sin sinh skewness slice soundex split split_part
+    split_to_map split_to_multimap sqrt starts_with stddev stddev_pop
+    stddev_samp strpos substr substring sum tan tanh timezone_hour
+    timezone_minute to_base to_base64 to_hex to_iso8601 to_milliseconds
+    to_unixtime to_utf8 transform transform_keys transform_values translate
+    trim trim_array truncate try try_cast typeof unnest upper url_decode
+    url_encode url_extract_fragment url_extract_host url_extract_parameter
+    url_extract_path url_extract_port url_extract_protocol url_extract_query
+    uuid value_at_quantile values_at_quantiles var_pop var_samp variance
+    week week_of_year width_bucket with_timezone word_stem xxhash64 year
+    year_of_week yow zip zip_with
+    """.split()
+)
+
+
+def validate_sql(sql, schemas=None):
+    """
+    Check a query locally against the Trino dialect and the cached Glue schema.
+
+    The check is deliberately conservative: it only reports INVALID for
+    problems it can prove (parse errors, unknown tables, unknown columns in a
+    query without nested scopes) and UNSURE whenever it cannot reason about
+    the query, so the caller can fall back to an Athena EXPLAIN. Syntax that
+    sqlglot reads but Trino rejects, such as x::int, ILIKE or functions of
+    other dialects, is UNSURE rather than VALID.
+
+    Args:
+        sql (str): The SQL query to check.
+        schemas (dict): {table: {column: type}}, defaults to get_table_schemas().
+
+    Returns:
+        tuple: (VALID | INVALID | UNSURE, message). The message explains the
+            problem and is empty for VALID.
+    """
+    if sqlglot is None:
+        return UNSURE, "sqlglot is not installed"
+    if not sql or not sql.strip():
+        return INVALID, "The SQL statement is empty."
+
+    try:
+        statements = [s for s in sqlglot.parse(sql, read="trino") if s is not None]
+    except ParseError as e:
+        return INVALID, f"SQL syntax error: {e}"
+    if len(statements) != 1:
+        return INVALID, "Only a single SQL statement can be executed at a time."
+    tree = statements[0]
+
+    problem = find_non_trino_syntax(sql)
+    if problem:
+        return UNSURE, problem
+
+    try:
+        if schemas is None:
+            schemas = get_table_schemas()
+    except Exception as e:
+        return UNSURE, f"Could not load the table schemas: {e}"
+
+    database = config["aws"]["glue"]["database"].lower()
+    cte_names = {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+
+    # alias -> table name for every base table in the query
+    referenced_tables = {}
+    for table in tree.find_all(exp.Table):
+        name = table.name.lower()
+        if not table.db and name in cte_names:
+            continue
+        if table.db and table.db.lower() != database:
+            return UNSURE, f"Table {table.db}.{table.name} is outside database {database}."
+        if name not in schemas:
+            return INVALID, (
+                f"Table '{table.name}' does not exist in database '{database}'. "
+                f"Available tables: {', '.join(sorted(schemas))}"
+            )
+        referenced_tables[(table.alias_or_name or name).lower()] = name
+
+    nested_scopes = any(
+        tree.find(node_type) is not None
+        for node_type in (exp.CTE, exp.Subquery, exp.Unnest, exp.Lambda)
+    )
+    select_aliases = {alias.alias.lower() for alias in tree.find_all(exp.Alias)}
+    known_columns = set()
+    for table_name in referenced_tables.values():
+        if not schemas[table_name]:
+            # e.g. a table the crawler has not filled in yet
+            return UNSURE, f"Table {table_name} has no columns in the catalog."
+        known_columns.update(schemas[table_name])
+
+    for column in tree.find_all(exp.Column):
+        name = column.name.lower()
+        if name == "*":
+            continue
+        # Trino resolves select aliases in ORDER BY only
+        if name in select_aliases and column.find_ancestor(exp.Order) is not None:
+            continue
+        qualifier = column.table.lower()
+        if qualifier in referenced_tables:
+            columns = schemas[referenced_tables[qualifier]]
+        elif qualifier:
+            # qualified by something we do not track, e.g. a derived table
+            return UNSURE, f"Cannot resolve the qualifier of column {column.sql()}."
+        else:
+            columns = known_columns
+        if name in columns:
+            continue
+        if nested_scopes:
+            return UNSURE, f"Column {column.sql()} may come from a nested query."
+        if _in_function_call(column):
+            # e.g. the unit in date_diff(day, ...) parses as a column
+            return UNSURE, f"{column.sql()} may be a keyword argument, not a column."
+        table_names = qualifier and [referenced_tables[qualifier]] or sorted(
+            set(referenced_tables.values())
+        )
+        available = {table: sorted(schemas[table]) for table in table_names}
+        return INVALID, (
+            f"Column '{column.name}' cannot be resolved. Available columns: {available}"
+        )
+
+    return VALID, ""
+
+
+def find_non_trino_syntax(sql):
+    """
+    Look through a query's tokens for syntax of other dialects that sqlglot
+    parses, and would rewrite, but Trino does not accept.
+
+    Returns:
+        str: A description of the first problem found, or None.
+    """
+    tokens = sqlglot.Dialect.get_or_raise("trino").tokenize(sql)
+    for i, token in enumerate(tokens):
+        kind = token.token_type
+        following = tokens[i + 1] if i + 1 < len(tokens) else None
+        if kind == TokenType.DCOLON:
+            return "The :: cast is not Trino syntax, Trino uses CAST(x AS type)."
+        if kind == TokenType.ILIKE:
+            return "ILIKE is not Trino syntax."
+        if kind == TokenType.RLIKE:
+            return f"{token.text.upper()} is not Trino syntax, Trino uses regexp_like."
+        if kind == TokenType.INTERVAL and following and following.token_type != TokenType.STRING:
+            return "Trino interval values must be quoted, e.g. INTERVAL '1' DAY."
+        if (
+            following is not None
+            and following.token_type == TokenType.L_PAREN
+            and kind in (TokenType.VAR, TokenType.LEFT, TokenType.RIGHT)
+            and token.text.lower() not in TRINO_FUNCTIONS
+        ):
+            return f"{token.text} is not a known Trino function."
+    return None
+
+
+def _in_function_call(node):
+    # CASE and AND/OR are functions to sqlglot but not calls with arguments
+    return any(
+        isinstance(parent, exp.Func) and not isinstance(parent, (exp.Connector, exp.Case))
+        for parent in _ancestors(node)
+    )
+
+
+def _ancestors(node):
+    parent = node.parent
+    while parent is not None:
+        yield parent
+        parent = parent.parent
+
+
+def parse_sql(sql):
+    """
+    Parse a single Trino statement, returning None when that is not possible.
+    """
+    if sqlglot is None or not sql:
+        return None
+    try:
+        statements = [s for s in sqlglot.parse(sql, read="trino") if s is not None]
+    except ParseError:
+        return None
+    return statements[0] if len(statements) == 1 else None
+
+
+def get_referenced_tables(tree):
+    """
+    Return the lower-cased names of the base tables a parsed query reads,
+    leaving out CTE names.
+    """
+    cte_names = {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+    return {
+        table.name.lower()
+        for table in tree.find_all(exp.Table)
+        if table.db or table.name.lower() not in cte_names
+    }
+
+
+def normalize_sql(sql):
+    """
+    Canonicalise a query so formatting, comments and identifier case do not
+    matter when comparing two queries.
+
+    Returns:
+        tuple: (normalized_sql, referenced_tables), or (None, None) when the
+            query cannot be parsed.
+    """
+    tree = parse_sql(sql)
+    if tree is None:
+        return None, None
+    normalized = tree.sql(dialect="trino", normalize=True, comments=False)
+    return normalized, get_referenced_tables(tree)
+
+
+def describe_query(tree):
+    """
+    Summarise the shape of the outermost query.
+
+    Set operations (UNION, INTERSECT, EXCEPT) count as selects. Window
+    aggregates such as SUM(x) OVER (...) return a row per input row, so they
+    do not make a query an aggregate.
+
+    Returns:
+        dict: is_select, has_order_by, is_aggregate (an aggregate without
+            GROUP BY, so at most one row), has_group_by, has_limit (LIMIT,
+            LIMIT ALL or FETCH FIRST) and limit (the row count as an int, or
+            None).
+    """
+    is_select = isinstance(tree, (exp.Select, exp.SetOperation))
+    limit = None
+    limit_node = tree.args.get("limit")
+    if limit_node is not None:
+        count = (
+            limit_node.args.get("count")
+            if isinstance(limit_node, exp.Fetch)
+            else limit_node.expression
+        )
+        try:
+            limit = int(count.name)
+        except (AttributeError, ValueError):
+            limit = None
+    has_group_by = tree.args.get("group") is not None
+    return {
+        "is_select": is_select,
+        "has_order_by": tree.args.get("order") is not None,
+        "has_group_by": has_group_by,
+        "is_aggregate": isinstance(tree, exp.Select)
+        and not has_group_by
+        and any(
+            _aggregates_outer_query(agg, tree)
+            for e in tree.expressions
+            for agg in e.find_all(exp.AggFunc)
+        ),
+        "has_limit": limit_node is not None,
+        "limit": limit,
+    }
+
+
+def _aggregates_outer_query(agg, tree):
+    # window aggregates and aggregates of subqueries keep the row count
+    for parent in _ancestors(agg):
+        if parent is tree:
+            return True
+        if isinstance(parent, (exp.Window, exp.Subquery, exp.Select)):
+            return False
+    return False
+
+
+def sql_pattern(sql):
+    """
+    Reduce a query to its shape by replacing every literal with a placeholder,
+    so the same question asked with different values groups together.
+    """
+    tree = parse_sql(sql)
+    if tree is None:
+        # without a parser, mask quoted strings and numbers
+        pattern = re.sub(r"'(?:[^']|'')*'", "?", sql or "")
+        pattern = re.sub(r"\b\d+(?:\.\d+)?\b", "?", pattern)
+        return " ".join(pattern.split())
+    tree = tree.transform(
+        lambda node: exp.Placeholder() if isinstance(node, exp.Literal) else node
+    )
+    return tree.sql(dialect="trino", normalize=True, comments=False)
@@ -0,0 +1,95 @@
+"""
+Measure cold-start import cost of the app's entry points.
+
+Every module is imported in a fresh interpreter with -X importtime, so the
+numbers include everything a Streamlit page load or an ingest worker pays
+before doing any work. Engine construction is measured separately since it
+is deferred to first use.
+
+    python startup_benchmark.py
+    python startup_benchmark.py --repeat 5 --top 15
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = [
+    "aws_clients",
+    "ingest",
+    "athena",
+    "vanna_calls",
+    "engine_registry",
+]
+
+ENGINE_BUILD = "from engine_registry import get_engine; get_engine()"
+
+
+def run_cold(code):
+    """
+    Run code in a fresh interpreter and return its wall clock seconds and the
+    -X importtime report from stderr.
+    """
+    start_time = time.monotonic()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    seconds = time.monotonic() - start_time
+    if completed.returncode != 0:
+        raise Exception(completed.stderr.strip().splitlines()[-1])
+    return seconds, completed.stderr
+
+
+def slowest_imports(report, top=10):
+    """
+    Return the top-level packages with the largest cumulative import time.
+
+    Returns:
+        list: (package, seconds) pairs, slowest first.
+    """
+    packages = {}
+    for line in report.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        cumulative = cumulative.strip()
+        # nested imports are indented below the module that imported them
+        if not cumulative.isdigit() or name.startswith("  "):
+            continue
+        package = name.strip().split(".")[0]
+        packages[package] = max(packages.get(package, 0), int(cumulative) / 1e6)
+    return sorted(packages.items(), key=lambda item: -item[1])[:top]
+
+
+def benchmark(modules=MODULES, repeat=3, top=10):
+    results = []
+    targets = [(module, f"import {module}") for module in modules]
+    targets.append(("engine construction", ENGINE_BUILD))
+    for label, code in targets:
+        try:
+            runs = [run_cold(code) for _ in range(repeat)]
+        except Exception as e:
+            print(f"{label}: failed, {e}")
+            continue
+        median = statistics.median(seconds for seconds, _ in runs)
+        results.append((label, median))
+        print(f"{label}: {median:.2f}s median of {repeat} cold starts")
+        for package, seconds in slowest_imports(runs[-1][1], top):
+            print(f"    {package:<30} {seconds:.3f}s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cold-start import cost.")
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+    benchmark(args.modules, args.repeat, args.top)
@@ -3,13 +3,13 @@ import pandas as pd
 import boto3
 from io import BytesIO, StringIO
 import time
-import chardet
-from utils import convert_df_to_parquet
-from s3 import upload_to_s3
-from glue import create_glue_crawler, run_glue_crawler
+from utils import detect_encoding
+from ingest import run_ingestion, profile_documentation, profile_heading
+from glue import create_glue_crawler, run_glue_crawler, invalidate_schema_cache
 from aws_clients import config
 from athena import generate_database_ddl
-from orchestrator import engine
+from engine_registry import get_engine
+from semantic_cache import semantic_cache
 import traceback
 
 st.sidebar.title("Session State")
@@ -17,6 +17,8 @@ st.sidebar.write(st.session_state)
 
 st.title("Upload Your Data Files")
 
+PREVIEW_ROWS = 1000
+
 
 # Function to load files from session state
 def load_files():
@@ -51,62 +53,150 @@ if st.session_state.uploaded_files:
     st.header("Selected Files to Analyze:")
     for file in st.session_state.uploaded_files:
         st.write(file.name)
-        # Reset file pointer to the beginning
-        file.seek(0)
-        # Read the file as a dataframe with specified encoding
+        # Preview only the first rows so large files are not loaded whole
         try:
-            file_bytes = file.read()
-            # Detect the encoding
-            result = chardet.detect(file_bytes)
-            encoding = result["encoding"]
-            # Convert bytes to string using detected encoding
-            csv_data = file_bytes.decode(encoding)
-            # Convert CSV to Pandas DataFrame
-            df = pd.read_csv(StringIO(csv_data))
-            # Display DataFrame
+            encoding = detect_encoding(file)
+            df = pd.read_csv(file, encoding=encoding, nrows=PREVIEW_ROWS)
             st.dataframe(df)
+            st.caption(f"Showing up to the first {PREVIEW_ROWS} rows")
+            # optional layout so Athena can prune partitions and row groups
+            left, right = st.columns(2)
+            left.selectbox(
+                "Partition by (date or low-cardinality column)",
+                [None] + list(df.columns),
+                key=f"partition_by_{file.name}",
+            )
+            right.selectbox(
+                "Sort files by", [None] + list(df.columns), key=f"sort_by_{file.name}"
+            )
         except Exception as e:
             st.error(f"Error reading CSV file: {e}")
 
+    run_crawler = st.checkbox(
+        "Reconcile with a Glue crawler",
+        value=not config.get("ingest", {}).get("register_tables", True),
+        help="Tables are registered in Glue directly from their schema. "
+        "The crawler is only needed to reconcile changes made outside this app.",
+    )
+
+    force_ingest = st.checkbox(
+        "Re-ingest unchanged files",
+        help="Files whose content and layout match an earlier upload are skipped.",
+    )
+
     if st.button("Add to Data Catalog"):  #! add warning on time and cost
         try:
             with st.status("Adding to Data Catalog...", expanded=True) as status:
-                i = 1
-                for file in st.session_state.uploaded_files:
-                    file_name_no_ext = file.name.split(".")[0]
-
-                    # convert to parquet
-                    st.write(f"Converting file {file.name} to parquet...")
-                    parquet_buffer = convert_df_to_parquet(df)
-
-                    # upload to s3
-                    st.write(f"Uploading file {i} to S3...")
-                    parquet_file_key = f"parquet_data/{config['aws']['glue']['database']}/{file_name_no_ext}/{file_name_no_ext}.parquet"
-                    upload_to_s3(
-                        parquet_buffer, config["aws"]["s3"]["bucket"], parquet_file_key
-                    )
-                    i += 1
-
-                # create & run crawler to add to glue data catalog
-                st.write("Adding to glue data catalog...")
-                crawler_name = f"{config['aws']['glue']['database']}_crawler"
-                s3_target_path = f"s3://{config['aws']['s3']['bucket']}/parquet_data/{config['aws']['glue']['database']}"
-                create_glue_crawler(
-                    crawler_name, config["aws"]["glue"]["database"], s3_target_path
+                files = st.session_state.uploaded_files
+                st.write(f"Converting and uploading {len(files)} files...")
+                progress = st.progress(0.0)
+                completed = []
+
+                def report_result(result):
+                    completed.append(result["name"])
+                    progress.progress(len(completed) / len(files))
+                    if "error" in result:
+                        st.error(f"{result['name']} failed: {result['error']}")
+                    elif result["skipped"]:
+                        st.write(f"{result['name']}: unchanged since the last upload, skipped")
+                    else:
+                        st.write(
+                            f"{result['name']}: converted to {result['files']} files "
+                            f"in {result['convert_seconds']:.1f}s, "
+                            f"uploaded {result['bytes'] / 1024**2:.1f} MB "
+                            f"at {result['mb_per_second'] or 0:.1f} MB/s"
+                        )
+
+                layouts = {
+                    file.name: {
+                        "partition_by": st.session_state.get(f"partition_by_{file.name}"),
+                        "sort_by": st.session_state.get(f"sort_by_{file.name}"),
+                    }
+                    for file in files
+                }
+                results = run_ingestion(
+                    files, on_result=report_result, layouts=layouts, force=force_ingest
                 )
-                run_glue_crawler(crawler_name)
-
-                st.write("Creating ddl...")
-                ddl_statements = generate_database_ddl()
-
-                st.write("Training model...")
-                for table_name, ddl in ddl_statements.items():
-                    print(f"adding table {table_name} to training data")
-                    engine.train(ddl=ddl)
-                print(engine.get_training_data())
-
-                status.update(label="Complete!", state="complete", expanded=True)
-                clear_session_state()
+                failed = [result["name"] for result in results if "error" in result]
+                if len(failed) == len(results):
+                    raise Exception("No files could be ingested")
+                # only tables that actually changed are crawled and trained
+                changed = [
+                    result
+                    for result in results
+                    if "error" not in result and not result["skipped"]
+                ]
+
+                if changed:
+                    # tables are registered in the worker processes, whose
+                    # schema cache is not the one this process validates with
+                    invalidate_schema_cache()
+
+                # tables that were not registered directly need the crawler
+                if any(not result["registered"] for result in changed):
+                    run_crawler = True
+
+                if run_crawler and changed:
+                    # create & run crawler to add to glue data catalog
+                    st.write("Adding to glue data catalog...")
+                    crawler_name = f"{config['aws']['glue']['database']}_crawler"
+                    # only crawl the tables touched by this upload
+                    s3_target_path = [
+                        f"s3://{config['aws']['s3']['bucket']}/{result['prefix']}"
+                        for result in changed
+                    ]
+                    create_glue_crawler(
+                        crawler_name, config["aws"]["glue"]["database"], s3_target_path
+                    )
+                    run_glue_crawler(crawler_name)
+
+                if changed and semantic_cache is not None:
+                    # reused SQL may no longer fit the re-ingested tables
+                    semantic_cache.invalidate([result["table"] for result in changed])
+
+                if changed:
+                    engine = get_engine()
+                    st.write("Creating ddl...")
+                    ddl_statements = generate_database_ddl()
+                    changed_tables = {result["table"].lower() for result in changed}
+
+                    st.write("Training model...")
+                    for table_name, ddl in ddl_statements.items():
+                        if table_name.lower() not in changed_tables:
+                            continue
+                        print(f"adding table {table_name} to training data")
+                        engine.train(ddl=ddl)
+
+                    # replace the earlier column profiles of re-ingested tables
+                    profiled = [result for result in changed if result.get("profile")]
+                    if profiled:
+                        training_data = engine.get_training_data()
+                        for result in profiled:
+                            heading = profile_heading(result["table"])
+                            stale = training_data[
+                                (training_data["training_data_type"] == "documentation")
+                                & training_data["content"].str.startswith(f"{heading} (")
+                            ]
+                            for training_id in stale["id"]:
+                                engine.remove_training_data(training_id)
+                            engine.add_documentation(
+                                profile_documentation(result["table"], result["profile"])
+                            )
+                    print(engine.get_training_data())
+
+                if failed:
+                    status.update(
+                        label=f"Complete, {len(failed)} files failed",
+                        state="error",
+                        expanded=True,
+                    )
+                    # keep the failed files selected so they can be retried
+                    st.session_state.uploaded_files = [
+                        file for file in files if file.name in failed
+                    ]
+                else:
+                    status.update(label="Complete!", state="complete", expanded=True)
+                    clear_session_state()
             st.success(
                 f"Your data is now available in the data catalog and is ready for analysis."
             )
@@ -1,7 +1,14 @@
+import os
 import re
+import tempfile
+import chardet
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 from io import BytesIO
+from glue import arrow_type_to_glue
 
 
 def get_value_from_text(text, key, end_key=False):
@@ -18,10 +25,356 @@ def get_value_from_text(text, key, end_key=False):
     return None  # or a default value
 
 
+class TagStreamParser:
+    """
+    Extracts <tag>...</tag> sections from text that arrives in chunks.
+
+    feed returns the sections a chunk completed, so a caller can act on a
+    section as soon as its closing tag streams in instead of waiting for the
+    whole response. Like get_value_from_text, only the first occurrence of
+    each tag counts.
+    """
+
+    def __init__(
+        self,
+        tags=("thinking", "sql_query", "explanation", "clarification_request"),
+    ):
+        self._pattern = re.compile(
+            f"<({'|'.join(map(re.escape, tags))})>(.*?)</\\1>", re.DOTALL
+        )
+        self.text = ""
+        self.values = {}
+        # sections before this offset have been reported already
+        self._position = 0
+
+    def feed(self, chunk):
+        """
+        Returns:
+            list: (tag, content) pairs completed by this chunk, in order.
+        """
+        self.text += chunk
+        completed = []
+        while True:
+            match = self._pattern.search(self.text, self._position)
+            if match is None:
+                return completed
+            self._position = match.end()
+            tag, content = match.group(1), match.group(2)
+            if tag not in self.values:
+                self.values[tag] = content
+                completed.append((tag, content))
+
+
 def convert_df_to_parquet(df):
     buffer = BytesIO()
     table = pa.Table.from_pandas(df)
     pq.write_table(table, buffer, compression="zstd")
 
     buffer.seek(0)  # Reset buffer pointer to the beginning
-    return buffer
\ No newline at end of file
+    return buffer
+
+
+def detect_encoding(file, sample_size=64 * 1024):
+    """
+    Guess a file's encoding from its first bytes instead of the whole file.
+    """
+    file.seek(0)
+    sample = file.read(sample_size)
+    file.seek(0)
+    encoding = chardet.detect(sample)["encoding"] or "utf8"
+    # ascii is a subset of utf8, and a sample may miss later multibyte characters
+    return "utf8" if encoding.lower() == "ascii" else encoding
+
+
+def convert_csv_to_parquet(
+    file, encoding=None, block_size=16 * 1024 * 1024, spool_size=64 * 1024 * 1024
+):
+    """
+    Convert a CSV file to Parquet one block at a time.
+
+    Blocks are parsed with pyarrow's incremental CSV reader and written as
+    row groups as soon as they are parsed, so memory use is bounded by the
+    block size rather than the file size. The output goes to a spooled temp
+    file that only touches disk once it grows past spool_size.
+
+    Column types are inferred from the first block. When a later block holds
+    a value that does not fit, that column is read as a string and the file
+    is converted again.
+
+    Args:
+        file: A binary file-like object positioned anywhere.
+        encoding (str): The file's encoding, detected from a sample if None.
+        block_size (int): Bytes of CSV parsed per row group.
+        spool_size (int): Bytes kept in memory before spilling to disk.
+
+    Returns:
+        tuple: (buffer, schema) with the buffer positioned at the start.
+    """
+    encoding = encoding or detect_encoding(file)
+    column_types = {}
+    while True:
+        file.seek(0)
+        reader = pacsv.open_csv(
+            file,
+            read_options=pacsv.ReadOptions(encoding=encoding, block_size=block_size),
+            convert_options=pacsv.ConvertOptions(column_types=column_types),
+        )
+        buffer = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        try:
+            write_batches_to_parquet(reader, reader.schema, buffer)
+        except pa.ArrowInvalid as e:
+            buffer.close()
+            # e.g. "In CSV column #3: CSV conversion error to int64: invalid value 'x'"
+            match = re.search(r"In CSV column #(\d+)", str(e))
+            if match is None:
+                raise
+            column = reader.schema.names[int(match.group(1))]
+            if column_types.get(column) == pa.string():
+                raise
+            print(f"Reading column {column} as string: {e}")
+            column_types[column] = pa.string()
+            continue
+        finally:
+            reader.close()
+        buffer.seek(0)
+        return buffer, reader.schema
+
+
+def write_batches_to_parquet(batches, schema, sink, compression="zstd"):
+    """
+    Write an iterable of record batches to a Parquet sink, one row group per
+    batch.
+    """
+    with pq.ParquetWriter(sink, schema, compression=compression) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+
+
+def write_parquet_layout(
+    parquet_file,
+    out_dir,
+    partition_by=None,
+    sort_by=None,
+    max_rows_per_file=5_000_000,
+    row_group_size=500_000,
+    basename="part",
+    max_partitions=1000,
+):
+    """
+    Rewrite a Parquet file as a Hive-partitioned set of size-capped files.
+
+    Rows are streamed into key=value/ directories for the partition column,
+    each file holding at most max_rows_per_file rows. Every file is then
+    sorted on sort_by and rewritten with row groups of row_group_size rows,
+    so Athena can prune partitions and skip row groups by their min/max
+    statistics. Timestamp partition columns are partitioned by their date,
+    in a new <column>_date column.
+
+    Args:
+        parquet_file: Path or file-like object of the source Parquet file.
+        out_dir (str): Local directory to write the layout to.
+        partition_by (str): Column to partition by, None for no partitions.
+        sort_by (str): Column to sort each file by, None to keep row order.
+        max_rows_per_file (int): Upper bound on rows per file.
+        row_group_size (int): Rows per row group.
+        basename (str): File name prefix, made unique per call by the caller.
+        max_partitions (int): Fail rather than write more partitions.
+
+    Returns:
+        tuple: (relative file paths, data schema, partition schema or None).
+    """
+    source = pq.ParquetFile(parquet_file)
+    schema = source.schema_arrow
+    batches = source.iter_batches(batch_size=row_group_size)
+
+    partitioning = None
+    partition_schema = None
+    if partition_by:
+        field = schema.field(partition_by)
+        if pa.types.is_timestamp(field.type):
+            partition_field = pa.field(f"{partition_by}_date", pa.date32())
+            batches = (
+                batch.append_column(
+                    partition_field, pc.cast(batch.column(partition_by), pa.date32())
+                )
+                for batch in batches
+            )
+            schema = schema.append(partition_field)
+        else:
+            partition_field = field
+        partition_schema = pa.schema([partition_field])
+        partitioning = ds.partitioning(partition_schema, flavor="hive")
+
+    parquet_format = ds.ParquetFileFormat()
+    written = []
+    ds.write_dataset(
+        batches,
+        out_dir,
+        schema=schema,
+        format=parquet_format,
+        file_options=parquet_format.make_write_options(compression="zstd"),
+        partitioning=partitioning,
+        basename_template=f"{basename}-{{i}}.parquet",
+        max_rows_per_file=max_rows_per_file,
+        max_rows_per_group=row_group_size,
+        min_rows_per_group=min(row_group_size, max_rows_per_file),
+        max_partitions=max_partitions,
+        existing_data_behavior="overwrite_or_ignore",
+        file_visitor=lambda written_file: written.append(written_file.path),
+    )
+
+    if partition_schema is None:
+        data_schema = schema
+    else:
+        data_schema = schema.remove(schema.get_field_index(partition_field.name))
+    for path in written:
+        table = pq.ParquetFile(path).read()
+        if sort_by:
+            table = table.sort_by(sort_by)
+        pq.write_table(
+            table, path, row_group_size=row_group_size, compression="zstd"
+        )
+
+    paths = sorted(os.path.relpath(path, out_dir) for path in written)
+    return paths, data_schema, partition_schema
+
+
+# strptime format and the equivalent Athena date_parse format
+DATE_FORMATS = [
+    ("%Y-%m-%d", "%Y-%m-%d"),
+    ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%i:%s"),
+    ("%Y/%m/%d", "%Y/%m/%d"),
+    ("%m/%d/%Y", "%m/%d/%Y"),
+    ("%d/%m/%Y", "%d/%m/%Y"),
+    ("%m/%d/%Y %H:%M", "%m/%d/%Y %H:%i"),
+    ("%m/%d/%Y %H:%M:%S", "%m/%d/%Y %H:%i:%s"),
+    ("%d-%m-%Y", "%d-%m-%Y"),
+    ("%d.%m.%Y", "%d.%m.%Y"),
+    ("%Y%m%d", "%Y%m%d"),
+]
+
+
+def detect_date_format(values):
+    """
+    Return the Athena date_parse format every value matches, or None.
+    """
+    if len(values) == 0:
+        return None
+    values = pa.array(values, pa.string())
+    for strptime_format, athena_format in DATE_FORMATS:
+        parsed = pc.strptime(values, format=strptime_format, unit="s", error_is_null=True)
+        if parsed.null_count == 0:
+            return athena_format
+    return None
+
+
+def _is_ordered(data_type):
+    return (
+        pa.types.is_integer(data_type)
+        or pa.types.is_floating(data_type)
+        or pa.types.is_decimal(data_type)
+        or pa.types.is_temporal(data_type)
+    )
+
+
+def _is_categorical(data_type):
+    return (
+        pa.types.is_string(data_type)
+        or pa.types.is_large_string(data_type)
+        or pa.types.is_integer(data_type)
+        or pa.types.is_boolean(data_type)
+        or pa.types.is_date(data_type)
+    )
+
+
+def _to_json(value):
+    return value if value is None or isinstance(value, (bool, int, float, str)) else str(value)
+
+
+def profile_parquet(
+    parquet_file, top_k=5, max_distinct=1000, date_sample_size=1000, batch_size=500_000
+):
+    """
+    Profile every column of a Parquet file in one pass over its row groups.
+
+    Nulls, min/max and value counts are computed with pyarrow compute kernels
+    per batch and merged. Value counts are dropped once a column has more
+    than max_distinct values, so its cardinality is only reported as a lower
+    bound. String columns whose first non-null values all parse as dates get
+    the matching Athena date_parse format.
+
+    Args:
+        parquet_file: Path or file-like object of the Parquet file.
+        top_k (int): Most frequent values kept per low-cardinality column.
+        max_distinct (int): Distinct values counted before giving up.
+        date_sample_size (int): Non-null strings checked for a date format.
+        batch_size (int): Rows decoded at a time.
+
+    Returns:
+        dict: rows and columns, a list of {name, type (the Glue/Athena type
+            name), null_fraction, min, max, distinct, distinct_exceeds,
+            top_values, date_format}.
+            distinct is None for columns whose values are not counted, such
+            as floats.
+    """
+    source = pq.ParquetFile(parquet_file)
+    schema = source.schema_arrow
+    states = {
+        field.name: {"nulls": 0, "min": None, "max": None, "counts": {}, "sample": []}
+        for field in schema
+    }
+    rows = 0
+    for batch in source.iter_batches(batch_size=batch_size):
+        rows += batch.num_rows
+        for field, column in zip(schema, batch.columns):
+            state = states[field.name]
+            state["nulls"] += column.null_count
+            if column.null_count == len(column):
+                continue
+            if _is_ordered(field.type):
+                min_max = pc.min_max(column)
+                low, high = min_max["min"].as_py(), min_max["max"].as_py()
+                state["min"] = low if state["min"] is None else min(state["min"], low)
+                state["max"] = high if state["max"] is None else max(state["max"], high)
+            if _is_categorical(field.type) and state["counts"] is not None:
+                value_counts = pc.value_counts(column.drop_null())
+                counts = state["counts"]
+                for value, count in zip(
+                    value_counts.field("values").to_pylist(),
+                    value_counts.field("counts").to_pylist(),
+                ):
+                    counts[value] = counts.get(value, 0) + count
+                if len(counts) > max_distinct:
+                    state["counts"] = None
+            if pa.types.is_string(field.type) and len(state["sample"]) < date_sample_size:
+                missing = date_sample_size - len(state["sample"])
+                state["sample"].extend(column.drop_null().slice(0, missing).to_pylist())
+
+    columns = []
+    for field in schema:
+        state = states[field.name]
+        counts = state["counts"]
+        top_values = []
+        if counts:
+            top_values = [
+                [_to_json(value), count]
+                for value, count in sorted(counts.items(), key=lambda item: -item[1])[:top_k]
+            ]
+        columns.append(
+            {
+                "name": field.name,
+                "type": arrow_type_to_glue(field.type),
+                "null_fraction": state["nulls"] / rows if rows else 0.0,
+                "min": _to_json(state["min"]),
+                "max": _to_json(state["max"]),
+                "distinct": None
+                if not _is_categorical(field.type)
+                else len(counts) if counts is not None else max_distinct,
+                "distinct_exceeds": counts is None,
+                "top_values": top_values,
+                "date_format": detect_date_format(state["sample"])
+                if pa.types.is_string(field.type)
+                else None,
+            }
+        )
+    return {"rows": rows, "columns": columns}
@@ -0,0 +1,71 @@
+"""
+Shared test setup.
+
+The modules under src/ read config/config.yaml and build boto3 clients when
+they are imported. Tests run without AWS, so a stand-in aws_clients module
+with a small test configuration is installed before any of them is imported.
+Tests hand their fake service clients to the aws_clients fixture.
+"""
+
+import os
+import sys
+import tempfile
+import types
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC)
+
+CACHE_DIR = tempfile.mkdtemp(prefix="ai-data-analysis-tests-")
+
+TEST_CONFIG = {
+    "aws": {
+        "athena": {
+            "output_location": "s3://results-bucket/athena-results",
+            "catalog": "AwsDataCatalog",
+            "default_row_limit": 100,
+        },
+        "glue": {"database": "testdb", "role": "test-role"},
+        "s3": {"bucket": "data-bucket"},
+    },
+    "duckdb": {
+        "enabled": True,
+        "offline": True,
+        "cache_dir": os.path.join(CACHE_DIR, "duckdb"),
+    },
+    "result_cache": {"enabled": False},
+    "query_stats": {"enabled": False},
+}
+
+
+class FakeAWSClients:
+    """
+    Hands out the fake client a test registered for a service, in place of
+    aws_clients.AWSClients.
+    """
+
+    def __init__(self):
+        self.clients = {}
+
+    def __getattr__(self, name):
+        if name.startswith("get_") and name.endswith("_client"):
+            service = name[len("get_") : -len("_client")]
+            return lambda: self.clients[service]
+        raise AttributeError(name)
+
+    def pool_metrics(self):
+        return {}
+
+
+aws_clients_module = types.ModuleType("aws_clients")
+aws_clients_module.config = TEST_CONFIG
+aws_clients_module.aws_client = FakeAWSClients()
+sys.modules["aws_clients"] = aws_clients_module
+
+
+@pytest.fixture
+def aws_clients():
+    fake = aws_clients_module.aws_client
+    fake.clients = {}
+    yield fake.clients
+    fake.clients = {}
@@ -0,0 +1,122 @@
+import os
+import pytest
+
+pytest.importorskip("duckdb")
+pytest.importorskip("sqlglot")
+pytest.importorskip("pandas")
+pq = pytest.importorskip("pyarrow.parquet")
+pa = pytest.importorskip("pyarrow")
+
+import duckdb_executor
+from duckdb_executor import DUCKDB, route_query, execute_query, OBJECTS_FILE
+
+
+def write_table(table_name, rows, partition=None):
+    """
+    Write a local Parquet fixture where the offline executor looks for it.
+    """
+    directory = duckdb_executor.duckdb_executor.table_dir(table_name)
+    if partition:
+        directory = os.path.join(directory, partition)
+    os.makedirs(directory, exist_ok=True)
+    pq.write_table(pa.Table.from_pylist(rows), os.path.join(directory, "part-0.parquet"))
+
+
+def test_offline_queries_route_to_duckdb():
+    backend, reason, tables = route_query("SELECT customer FROM orders_route")
+    assert backend == DUCKDB
+    assert reason == "offline"
+    assert tables == {"orders_route": None}
+
+
+def test_offline_execute_query_reads_local_parquet():
+    write_table(
+        "orders_exec",
+        [
+            {"customer": "a", "amount": 10.0},
+            {"customer": "b", "amount": 5.0},
+            {"customer": "a", "amount": 2.5},
+        ],
+    )
+
+    df = execute_query(
+        "SELECT customer, sum(amount) AS total FROM orders_exec "
+        "GROUP BY customer ORDER BY customer"
+    )
+
+    assert df.to_dict("records") == [
+        {"customer": "a", "total": 12.5},
+        {"customer": "b", "total": 5.0},
+    ]
+    assert not df.attrs.get("truncated")
+
+
+def test_offline_execute_query_reads_hive_partitions():
+    write_table("events_exec", [{"id": 1}], partition="day=2024-01-01")
+    write_table("events_exec", [{"id": 2}, {"id": 3}], partition="day=2024-01-02")
+
+    df = execute_query("SELECT count(*) AS n FROM events_exec WHERE day = '2024-01-02'")
+
+    assert df["n"].tolist() == [2]
+
+
+def test_results_filling_the_injected_limit_are_flagged():
+    # the test config sets default_row_limit to 100
+    write_table("many_rows", [{"id": i} for i in range(150)])
+
+    df = execute_query("SELECT id FROM many_rows")
+
+    assert len(df) == 100
+    assert df.attrs["truncated"]
+    assert df.attrs["row_limit"] == 100
+
+
+class FakeS3:
+    def __init__(self, objects):
+        # key -> (etag, content)
+        self.objects = objects
+        self.downloads = []
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        yield {
+            "Contents": [
+                {"Key": key, "Size": len(content), "ETag": etag}
+                for key, (etag, content) in self.objects.items()
+                if key.startswith(Prefix)
+            ]
+        }
+
+    def download_file(self, bucket, key, path):
+        self.downloads.append(key)
+        with open(path, "wb") as file:
+            file.write(self.objects[key][1])
+
+
+def test_sync_table_downloads_files_rewritten_with_the_same_size(aws_clients, tmp_path):
+    executor = duckdb_executor.duckdb_executor
+    fake = FakeS3(
+        {
+            "data/t/a.parquet": ('"1"', b"aaaa"),
+            "data/t/b.parquet": ('"2"', b"bbbb"),
+        }
+    )
+    aws_clients["s3"] = fake
+    first = str(tmp_path / "version-1")
+    executor.sync_table("s3://bucket/data/t/", first)
+    assert sorted(fake.downloads) == ["data/t/a.parquet", "data/t/b.parquet"]
+    assert os.path.exists(os.path.join(first, OBJECTS_FILE))
+
+    # b is rewritten in place with the same size, a is unchanged
+    fake.objects["data/t/b.parquet"] = ('"3"', b"BBBB")
+    fake.downloads = []
+    second = str(tmp_path / "version-2")
+    executor.sync_table("s3://bucket/data/t/", second, previous=first)
+
+    assert fake.downloads == ["data/t/b.parquet"]
+    with open(os.path.join(second, "a.parquet"), "rb") as file:
+        assert file.read() == b"aaaa"
+    with open(os.path.join(second, "b.parquet"), "rb") as file:
+        assert file.read() == b"BBBB"
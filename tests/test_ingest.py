@@ -0,0 +1,79 @@
+import json
+from io import BytesIO
+import pytest
+
+pytest.importorskip("pyarrow")
+pytest.importorskip("boto3")
+pytest.importorskip("chardet")
+
+from botocore.exceptions import ClientError
+import ingest
+
+
+class FakeS3:
+    """
+    Keeps one object per key with an ETag that changes on every write, and
+    honours IfMatch and IfNoneMatch like S3 conditional writes.
+    """
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.writes = 0
+        self.before_put = None
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey()
+        body, etag = self.objects[Key]
+        return {"Body": BytesIO(body), "ETag": etag}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        if self.before_put is not None:
+            before_put, self.before_put = self.before_put, None
+            before_put()
+        current = self.objects.get(Key)
+        if (IfMatch and (current is None or current[1] != IfMatch)) or (
+            IfNoneMatch == "*" and current is not None
+        ):
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+        self.writes += 1
+        self.objects[Key] = (Body, f'"{self.writes}"')
+
+
+def read_manifest(fake):
+    return json.loads(fake.objects[ingest.manifest_key("testdb")][0])
+
+
+def test_update_manifest_keeps_entries_written_meanwhile(aws_clients, monkeypatch):
+    monkeypatch.setattr(ingest.time, "sleep", lambda seconds: None)
+    fake = FakeS3()
+    aws_clients["s3"] = fake
+    ingest.update_manifest({"orders": {"sha256": "a"}}, "bucket", "testdb")
+
+    # another session writes its entry between our read and our write
+    fake.before_put = lambda: ingest.update_manifest(
+        {"customers": {"sha256": "b"}}, "bucket", "testdb"
+    )
+    ingest.update_manifest({"orders": {"sha256": "c"}}, "bucket", "testdb")
+
+    assert read_manifest(fake) == {
+        "orders": {"sha256": "c"},
+        "customers": {"sha256": "b"},
+    }
+
+
+def test_spool_to_disk_keeps_files_with_the_same_name_apart(tmp_path):
+    first, second = BytesIO(b"first"), BytesIO(b"second")
+    first.name = second.name = "orders.csv"
+
+    first_path, first_digest = ingest.spool_to_disk(first, str(tmp_path))
+    second_path, second_digest = ingest.spool_to_disk(second, str(tmp_path))
+
+    assert first_path != second_path
+    assert first_digest != second_digest
+    with open(first_path, "rb") as file:
+        assert file.read() == b"first"
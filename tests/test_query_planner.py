@@ -0,0 +1,72 @@
+import pytest
+
+pytest.importorskip("sqlglot")
+pytest.importorskip("pyarrow")
+
+import query_planner
+from query_planner import plan_query, _partition_filters
+from sql_validator import parse_sql, describe_query
+
+
+@pytest.fixture(autouse=True)
+def no_glue(monkeypatch):
+    monkeypatch.setattr(query_planner, "get_tables", lambda tables: {})
+
+
+def planned(sql):
+    plan = plan_query(sql)
+    return plan["sql"], plan["limit_injected"]
+
+
+def test_limit_is_injected_into_plain_selects():
+    sql, injected = planned("SELECT a FROM t")
+    assert injected
+    assert sql == "SELECT a FROM t LIMIT 100"
+    assert parse_sql(sql) is not None
+
+
+def test_limit_survives_a_trailing_comment():
+    sql, injected = planned("SELECT a FROM t -- newest first")
+    assert injected
+    assert describe_query(parse_sql(sql))["limit"] == 100
+
+
+def test_set_operations_get_a_limit():
+    sql, injected = planned("SELECT a FROM t UNION ALL SELECT b FROM u")
+    assert injected
+    assert describe_query(parse_sql(sql))["limit"] == 100
+
+
+def test_window_aggregates_get_a_limit():
+    _, injected = planned("SELECT a, sum(b) OVER (PARTITION BY a) FROM t")
+    assert injected
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT a FROM t LIMIT 5",
+        "SELECT a FROM t LIMIT ALL",
+        "SELECT a FROM t FETCH FIRST 5 ROWS ONLY",
+        "SELECT count(*) FROM t",
+        "SELECT a, count(*) FROM t GROUP BY a",
+    ],
+)
+def test_limited_and_aggregate_queries_are_left_alone(sql):
+    assert planned(sql) == (sql, False)
+
+
+def test_fetch_first_counts_as_a_limit():
+    shape = describe_query(parse_sql("SELECT a FROM t FETCH FIRST 5 ROWS ONLY"))
+    assert shape["has_limit"]
+    assert shape["limit"] == 5
+
+
+def test_partition_filters_skip_values_with_quotes():
+    tree = parse_sql(
+        "SELECT * FROM t WHERE region = 'eu' AND city = 'O''Hare' AND day IN ('1', '2')"
+    )
+    assert _partition_filters(tree, {"region", "city", "day"}) == [
+        "region = 'eu'",
+        "day IN ('1', '2')",
+    ]
@@ -0,0 +1,32 @@
+import sqlite3
+import pytest
+
+pytest.importorskip("sqlglot")
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+
+import result_cache
+from result_cache import ResultCache
+
+TABLES = {"t": {"VersionId": "1"}}
+
+
+def test_index_connections_are_closed(tmp_path, monkeypatch):
+    opened = []
+    sqlite_connect = sqlite3.connect
+
+    def connect(*args, **kwargs):
+        conn = sqlite_connect(*args, **kwargs)
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(result_cache.sqlite3, "connect", connect)
+    cache = ResultCache(str(tmp_path))
+    df = pd.DataFrame({"a": [1, 2]})
+    cache.put("SELECT a FROM t", df, table_metadata=TABLES)
+
+    assert cache.get("SELECT a FROM t", table_metadata=TABLES).equals(df)
+    assert opened
+    for conn in opened:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
@@ -0,0 +1,84 @@
+import datetime
+from io import BytesIO
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pytest.importorskip("pandas")
+pytest.importorskip("boto3")
+
+import s3
+
+
+class FakeAthena:
+    def __init__(self, columns):
+        self.columns = columns
+
+    def get_query_results(self, QueryExecutionId, MaxResults):
+        return {
+            "ResultSet": {
+                "ResultSetMetadata": {
+                    "ColumnInfo": [
+                        {"Name": name, "Type": athena_type}
+                        for name, athena_type in self.columns
+                    ]
+                }
+            }
+        }
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key):
+        return {"Body": BytesIO(self.objects[(Bucket, Key)])}
+
+
+def athena_result(aws_clients, columns, csv_text):
+    aws_clients["athena"] = FakeAthena(columns)
+    aws_clients["s3"] = FakeS3(
+        {("results-bucket", "athena-results/exec-1.csv"): csv_text.encode()}
+    )
+
+
+def test_read_query_results_parses_fractional_second_timestamps(aws_clients):
+    athena_result(
+        aws_clients,
+        [("id", "integer"), ("created_at", "timestamp")],
+        '"id","created_at"\n'
+        '"1","2024-01-01 12:34:56.000"\n'
+        '"2","2024-01-02 08:00:00.250"\n'
+        '"3",\n',
+    )
+
+    table, truncated = s3.read_query_results("exec-1", "athena-results")
+
+    assert not truncated
+    assert table.schema.field("created_at").type == pa.timestamp("ms")
+    assert table.column("created_at").to_pylist() == [
+        datetime.datetime(2024, 1, 1, 12, 34, 56),
+        datetime.datetime(2024, 1, 2, 8, 0, 0, 250000),
+        None,
+    ]
+
+
+def test_read_query_results_keeps_empty_strings_apart_from_nulls(aws_clients):
+    athena_result(
+        aws_clients,
+        [("name", "varchar"), ("id", "integer")],
+        '"name","id"\n"a","1"\n"","2"\n,"3"\n',
+    )
+
+    table, _ = s3.read_query_results("exec-1", "athena-results")
+
+    assert table.column("name").to_pylist() == ["a", "", None]
+
+
+def test_read_query_results_stops_at_max_rows(aws_clients):
+    rows = "".join(f'"{i}"\n' for i in range(10))
+    athena_result(aws_clients, [("id", "integer")], '"id"\n' + rows)
+
+    table, truncated = s3.read_query_results("exec-1", "athena-results", max_rows=4)
+
+    assert truncated
+    assert table.column("id").to_pylist() == [0, 1, 2, 3]
@@ -0,0 +1,80 @@
+import pytest
+
+pytest.importorskip("sqlglot")
+pytest.importorskip("pyarrow")
+
+from sql_validator import validate_sql, VALID, INVALID, UNSURE
+
+SCHEMAS = {
+    "orders": {
+        "order_id": "bigint",
+        "customer": "string",
+        "amount": "double",
+        "created_at": "timestamp",
+    }
+}
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT customer, sum(amount) AS total FROM orders GROUP BY customer ORDER BY total DESC",
+        "SELECT CAST(amount AS INTEGER) FROM orders "
+        "WHERE created_at > current_date - INTERVAL '1' DAY",
+        "SELECT date_trunc('month', created_at) AS month, count(*) FROM orders GROUP BY 1",
+        "SELECT sum(amount) OVER (PARTITION BY customer ORDER BY created_at) FROM orders",
+        "SELECT o.customer FROM orders o LEFT JOIN orders p ON o.order_id = p.order_id",
+    ],
+)
+def test_trino_queries_are_valid(sql):
+    assert validate_sql(sql, SCHEMAS) == (VALID, "")
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT amount::int FROM orders",
+        "SELECT * FROM orders WHERE customer ILIKE 'a%'",
+        "SELECT IFNULL(amount, 0) FROM orders",
+        "SELECT LEN(customer) FROM orders",
+        "SELECT * FROM orders WHERE created_at > NOW() - INTERVAL 1 DAY",
+        "SELECT * FROM orders WHERE customer REGEXP 'a'",
+        "SELECT TO_CHAR(created_at, 'YYYY') FROM orders",
+        "SELECT DATEADD(day, 1, created_at) FROM orders",
+    ],
+)
+def test_other_dialects_are_unsure(sql):
+    verdict, message = validate_sql(sql, SCHEMAS)
+    assert verdict == UNSURE
+    assert message
+
+
+def test_unknown_column_is_invalid():
+    verdict, message = validate_sql("SELECT total FROM orders", SCHEMAS)
+    assert verdict == INVALID
+    assert "'total'" in message
+
+
+def test_unknown_table_is_invalid():
+    verdict, _ = validate_sql("SELECT * FROM customers", SCHEMAS)
+    assert verdict == INVALID
+
+
+def test_select_alias_only_resolves_in_order_by():
+    assert validate_sql(
+        "SELECT amount * 2 AS doubled FROM orders ORDER BY doubled", SCHEMAS
+    ) == (VALID, "")
+    verdict, _ = validate_sql(
+        "SELECT amount * 2 AS doubled FROM orders WHERE doubled > 10", SCHEMAS
+    )
+    assert verdict == INVALID
+
+
+def test_unresolved_function_argument_is_unsure():
+    verdict, _ = validate_sql("SELECT json_extract_scalar(payload, '$.x') FROM orders", SCHEMAS)
+    assert verdict == UNSURE
+
+
+def test_table_without_columns_is_unsure():
+    verdict, _ = validate_sql("SELECT id FROM pending", {"pending": {}})
+    assert verdict == UNSURE